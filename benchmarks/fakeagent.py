@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Stand-in gpg-agent for the benchmarks.
+
+Listens on a Unix socket and answers the commands split-gpg2 passes
+through with canned responses shaped like the real agent's, without doing
+any cryptography. PKSIGN and PKDECRYPT take ``--latency`` seconds, like a
+(fast) private key operation would. Only the keygrip :py:data:`GRIP` is
+known.
+
+Used by the other benchmarks, can be run on its own too:
+
+    python3 benchmarks/fakeagent.py /tmp/S.gpg-agent --latency 0.001
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from splitgpg2.codec import escape_D
+
+#: keygrip of the only key the agent has
+GRIP = b'0123456789ABCDEF0123456789ABCDEF01234567'
+
+# fixed "random" values, the filter doesn't look at them
+_r = bytes(range(0x00, 0x20))
+_s = bytes(range(0x20, 0x40))
+
+SIGNATURE = b'(7:sig-val(5:eddsa(1:r32:%s)(1:s32:%s)))' % (_r, _s)
+
+SESSION_KEY = b'(5:value33:@%s)' % _s
+
+#: responses to commands without any further interaction, by command and
+#: arguments (``None`` for any)
+CANNED = {
+    (b'HAVEKEY', GRIP): [b'OK'],
+    (b'HAVEKEY', None): [b'ERR 67108881 No secret key <GPG Agent>'],
+    (b'KEYINFO', GRIP): [b'S KEYINFO ' + GRIP + b' D - - - P - - -', b'OK'],
+    (b'KEYINFO', None): [b'ERR 67108891 Not found <GPG Agent>'],
+    (b'GETINFO', b'version'): [b'D 2.2.40', b'OK'],
+    (b'GETINFO', b'restricted'): [b'OK'],
+    (b'GETINFO', b's2k_count'): [b'D 65536', b'OK'],
+    (b'PKSIGN', None): [b'D ' + escape_D(SIGNATURE), b'OK'],
+}
+
+#: commands acknowledged with a plain OK, whatever the arguments
+ACKNOWLEDGED = (b'RESET', b'OPTION', b'SIGKEY', b'SETKEY', b'SETKEYDESC',
+                b'SETHASH', b'NOP')
+
+UNKNOWN = [b'ERR 67109139 Unknown IPC command <GPG Agent>']
+
+
+class FakeAgent:
+    """Canned responses, see the module documentation"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        #: seconds each PKSIGN and PKDECRYPT takes
+        self.latency = latency
+        #: number of commands handled
+        self.commands = 0
+
+    def respond(self, command: bytes, args: bytes) -> List[bytes]:
+        if command in ACKNOWLEDGED:
+            return [b'OK']
+        if command == b'HAVEKEY' and args.startswith(b'--list'):
+            return [b'D ' + escape_D(bytes.fromhex(GRIP.decode())), b'OK']
+        try:
+            return CANNED[(command, args)]
+        except KeyError:
+            return CANNED.get((command, None), UNKNOWN)
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        writer.write(b'OK Pleased to meet you\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, args = line.rstrip(b'\n').partition(b' ')
+                self.commands += 1
+                if command == b'BYE':
+                    writer.write(b'OK closing connection\n')
+                    break
+                if command == b'PKDECRYPT':
+                    writer.write(b'INQUIRE CIPHERTEXT\n')
+                    while True:
+                        line = await reader.readline()
+                        if not line or line == b'END\n':
+                            break
+                    if not line:
+                        break
+                    await asyncio.sleep(self.latency)
+                    writer.write(b'D ' + escape_D(SESSION_KEY) + b'\nOK\n')
+                    continue
+                if command == b'PKSIGN':
+                    await asyncio.sleep(self.latency)
+                writer.writelines(response + b'\n'
+                                  for response in self.respond(command, args))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(agent: FakeAgent, socket_path: str) -> None:
+    server = await asyncio.start_unix_server(agent.handle, socket_path)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each PKSIGN and PKDECRYPT takes')
+    parser.add_argument('socket_path')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(FakeAgent(args.latency), args.socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Load of many client qubes using one split-gpg2 server at the same time.
+
+Each simulated client qube has its own name (``client_domain``) and GnuPG
+home, a subdirectory named after it like with ``isolated_gnupghome_dirs``.
+It runs connections one after another for ``--duration`` seconds, each a
+key listing, a signature or a decryption (see ``throughput.py``) picked at
+random with the ``--mix`` weights, and waits ``--think-time`` seconds on
+average between them. All the clients are served by one process, like by
+the server daemon, relaying to the agent of ``benchmarks/fakeagent.py``.
+
+Reported are the connections per second of all the clients together, the
+latency percentiles of the connections, and the fairness between the
+clients: Jain's index of the connections each of them got done (1.0 when
+all got the same, 1/N when one got all) and the worst p99 latency of a
+single client.
+
+Several numbers of clients can be given to find how many one server can
+take, each runs in its own process.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/loadgen.py [--mix sign=3,decrypt=1] 1 4 16 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from splitgpg2.agentpool import close_agent_pools
+from splitgpg2.config import ServerConfig
+
+from throughput import MIXES, percentile, prepare, run_session, start_agent
+
+#: default weights of the operations
+DEFAULT_MIX = 'keylist=6,sign=3,decrypt=1'
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    weights = {}
+    for item in value.split(','):
+        mix, _, weight = item.partition('=')
+        if mix not in MIXES:
+            raise argparse.ArgumentTypeError('unknown mix: {}'.format(mix))
+        try:
+            weights[mix] = float(weight or 1)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e)) from e
+        if weights[mix] < 0:
+            raise argparse.ArgumentTypeError(
+                'negative weight of {}'.format(mix))
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError('no operation to run')
+    return weights
+
+
+def jain_index(values: List[float]) -> float:
+    """Jain's fairness index of *values*"""
+    square_sum = sum(value * value for value in values)
+    if not square_sum:
+        return 1.0
+    return sum(values) ** 2 / (len(values) * square_sum)
+
+
+class Client:
+    """One simulated client qube"""
+    def __init__(self, domain: str, config: ServerConfig,
+                 weights: Dict[str, float], think_time: float,
+                 seed: int) -> None:
+        self.domain = domain
+        self.config = config
+        self.mixes = list(weights)
+        self.weights = list(weights.values())
+        self.think_time = think_time
+        self.random = random.Random(seed)
+        #: (mix, latency) of each finished connection
+        self.sessions: List[Tuple[str, float]] = []
+
+    async def run(self, agent_socket: str, deadline: float) -> None:
+        # let the clients start at different times
+        await asyncio.sleep(self.random.uniform(0, self.think_time))
+        while time.perf_counter() < deadline:
+            mix = self.random.choices(self.mixes, self.weights)[0]
+            latency = await run_session(self.config, agent_socket,
+                                        MIXES[mix], self.domain)
+            self.sessions.append((mix, latency))
+            if self.think_time:
+                await asyncio.sleep(
+                    self.random.expovariate(1 / self.think_time))
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        'operations': len(latencies),
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+    }
+
+
+def worker(clients: int, agent_socket: str, weights: Dict[str, float],
+           duration: float, think_time: float, seed: int) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        domains = ['client-{}'.format(i) for i in range(clients)]
+        simulated = [
+            Client(domain, prepare(os.path.join(tmp_dir, 'homes', domain)),
+                   weights, think_time, seed + i)
+            for i, domain in enumerate(domains)]
+        # prepare() points it at the last home
+        os.environ['XDG_CACHE_HOME'] = tmp_dir
+
+        async def run() -> float:
+            # warm up the caches and the agent connection pool
+            await asyncio.gather(*(
+                run_session(client.config, agent_socket, MIXES[mix],
+                            client.domain)
+                for client in simulated for mix in weights))
+            start = time.perf_counter()
+            await asyncio.gather(*(client.run(agent_socket, start + duration)
+                                   for client in simulated))
+            elapsed = time.perf_counter() - start
+            close_agent_pools()
+            return elapsed
+
+        elapsed = asyncio.run(run())
+
+    latencies = [latency for client in simulated
+                 for _, latency in client.sessions]
+    if not latencies:
+        raise RuntimeError('no connection finished in time')
+    per_client = [summarize([latency for _, latency in client.sessions])
+                  for client in simulated if client.sessions]
+    per_mix: Dict[str, List[float]] = {}
+    for client in simulated:
+        for mix, latency in client.sessions:
+            per_mix.setdefault(mix, []).append(latency)
+    return {
+        'clients': clients,
+        'seconds': elapsed,
+        'ops_per_second': len(latencies) / elapsed,
+        **summarize(latencies),
+        'fairness': jain_index([len(client.sessions)
+                                for client in simulated]),
+        'min_client_ops': min(len(client.sessions) for client in simulated),
+        'max_client_ops': max(len(client.sessions) for client in simulated),
+        'worst_client_p99': max(stats['p99'] for stats in per_client),
+        'mixes': {mix: summarize(mix_latencies)
+                  for mix, mix_latencies in per_mix.items()},
+        # in KiB on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix(DEFAULT_MIX),
+                        help='weights of the operations (default: {})'
+                             .format(DEFAULT_MIX))
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run each number of clients for')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='average seconds between the connections of '
+                             'a client, 0 to run them back to back')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each agent PKSIGN/PKDECRYPT takes')
+    parser.add_argument('--agent-socket',
+                        help='use the fake agent already listening there')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random choices')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per number of clients')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('clients', nargs='*', type=int,
+                        help='numbers of client qubes (default: 1 4 16)')
+    args = parser.parse_args()
+    levels = args.clients or [1, 4, 16]
+    if any(clients < 1 for clients in levels):
+        parser.error('there must be at least one client')
+
+    if args.worker:
+        print(json.dumps(worker(levels[0], args.agent_socket, args.mix,
+                                args.duration, args.think_time, args.seed)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        agent: Optional[subprocess.Popen] = None
+        agent_socket = args.agent_socket
+        if agent_socket is None:
+            agent_socket = os.path.join(tmp_dir, 'S.gpg-agent')
+            agent = start_agent(agent_socket, args.latency)
+        try:
+            if not args.json:
+                print('{:>7} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8} {:>12} '
+                      '{:>10}'.format(
+                          'clients', 'ops', 'ops/s', 'p50', 'p99', 'p99.9',
+                          'fairness', 'worst p99', 'peak RSS'))
+            for clients in levels:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker',
+                     '--agent-socket', agent_socket,
+                     '--mix', ','.join('{}={}'.format(mix, weight)
+                                       for mix, weight in args.mix.items()),
+                     '--duration', str(args.duration),
+                     '--think-time', str(args.think_time),
+                     '--seed', str(args.seed), str(clients)],
+                    stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(output)
+                if args.json:
+                    print(json.dumps(result))
+                    continue
+                print('{:>7} {:>8} {:>9.1f} {:>7.2f}ms {:>7.2f}ms '
+                      '{:>7.2f}ms {:>8.3f} {:>10.2f}ms {:>8.1f}MiB'.format(
+                          clients, result['operations'],
+                          result['ops_per_second'], result['p50'] * 1e3,
+                          result['p99'] * 1e3, result['p999'] * 1e3,
+                          result['fairness'],
+                          result['worst_client_p99'] * 1e3,
+                          result['peak_rss'] / 1024))
+        finally:
+            if agent is not None:
+                agent.terminate()
+                agent.wait()
+
+
+if __name__ == '__main__':
+    main()
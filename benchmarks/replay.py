@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Replay recorded Assuan sessions against GpgServer.
+
+Transcripts can be recorded in two ways:
+
+- the I/O trace of split-gpg2 itself: set ``trace_log`` and
+  ``trace_redact = no`` in the config - the D lines are needed to replay
+  the sessions. The client lines are replayed, the agent responses come from
+  the trace, and the output the client gets is compared with what it got
+  back then, so this catches any change in filtering.
+- ``debug-agent-socket``, logging what gpg (or Thunderbird, Evolution, git
+  etc.) and the real agent said, without split-gpg2 in between. The agent
+  responses are used the same way, and the output is compared with what the
+  agent sent - the differences are what split-gpg2 filters or fakes.
+
+Each session (connection) is replayed as fast as possible, through a
+GpgServer over a socketpair, to a stub agent answering each command with the
+responses recorded for the same command line. Signing and decryption are
+autoaccepted. Per-command timings and the differences in the output are
+reported.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/replay.py [--repeat 10] trace.jsonl
+"""
+
+import argparse
+import asyncio
+import difflib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from typing import Any, Dict, IO, List, NamedTuple, Set, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from splitgpg2.agentpool import close_agent_pools
+from splitgpg2.config import ServerConfig
+
+from fakeagent import ACKNOWLEDGED, UNKNOWN
+from throughput import Connection, percentile, prepare
+
+DEFAULT_GREETING = b'OK Pleased to meet you'
+
+#: a line of debug-agent-socket's log
+_debug_log_re = re.compile(
+    r'\A\S+ \S+: (?P<conn>\d+): (?:(?P<dir>>>>|<<<) ?(?P<line>.*)|'
+    r'(?P<event>connected|disconnected))\Z')
+
+_keygrip_re = re.compile(rb'\b[0-9A-F]{40}\b')
+
+
+class Exchange(NamedTuple):
+    """A line sent to the agent, and the agent's response lines until the
+    next one"""
+    request: bytes
+    responses: List[bytes]
+
+
+class Session:
+    """One recorded connection"""
+    exchanges: List[Exchange]
+    client_lines: List[bytes]
+    #: what the client got, including the greeting
+    expected: List[bytes]
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.exchanges = []
+        self.client_lines = []
+        self.expected = []
+
+    def agent_request(self, line: bytes) -> None:
+        self.exchanges.append(Exchange(line, []))
+
+    def agent_response(self, line: bytes) -> None:
+        if self.exchanges:
+            self.exchanges[-1].responses.append(line)
+
+    @property
+    def greeting(self) -> bytes:
+        if self.expected and self.expected[0].startswith(b'OK'):
+            return self.expected[0]
+        return DEFAULT_GREETING
+
+
+def read_trace(lines: List[str]) -> List[Session]:
+    """Sessions from a split-gpg2 trace (``trace_log``)"""
+    sessions: Dict[str, Session] = {}
+    redacted = False
+    for line in lines:
+        record = json.loads(line)
+        conn = record['conn']
+        if record['dir'] == 'open':
+            sessions[conn] = Session('{} ({})'.format(conn, record['client']))
+            continue
+        session = sessions.get(conn)
+        if session is None:
+            # opened before the trace starts
+            continue
+        data = record['line'].encode('latin-1')
+        redacted |= len(data) != record['len']
+        direction = record['dir']
+        if direction == 'C>>>':
+            # an empty line is the client disconnecting
+            if data:
+                session.client_lines.append(data)
+        elif direction == 'C<<<':
+            session.expected.append(data)
+        elif direction == 'A<<<':
+            session.agent_request(data)
+        elif direction == 'A>>>':
+            session.agent_response(data)
+    if redacted:
+        print('warning: the trace is redacted, set trace_redact = no to '
+              'record replayable sessions', file=sys.stderr)
+    return list(sessions.values())
+
+
+def read_debug_log(lines: List[str]) -> List[Session]:
+    """Sessions from a ``debug-agent-socket`` log"""
+    sessions: Dict[str, Session] = {}
+    for line in lines:
+        match = _debug_log_re.match(line)
+        if match is None:
+            # continuation of a multi-line message, or junk
+            continue
+        conn = match.group('conn')
+        if match.group('event') == 'connected':
+            sessions[conn] = Session(conn)
+            continue
+        session = sessions.get(conn)
+        if session is None or match.group('event') is not None:
+            continue
+        data = match.group('line').encode('utf-8', 'surrogateescape')
+        if match.group('dir') == '>>>':
+            session.client_lines.append(data)
+            session.agent_request(data)
+        else:
+            session.expected.append(data)
+            session.agent_response(data)
+    return list(sessions.values())
+
+
+def read_sessions(transcript: IO[str]) -> List[Session]:
+    lines = [line.rstrip('\n') for line in transcript if line.strip()]
+    if lines and lines[0].startswith('{'):
+        return read_trace(lines)
+    return read_debug_log(lines)
+
+
+class StubAgent:
+    """Agent answering from the session being replayed"""
+    pending: List[Exchange]
+    #: responses to each line in any of the sessions, for lines not
+    #: recorded in the current one (for example a response cached back then)
+    fallback: Dict[bytes, List[bytes]]
+
+    def __init__(self, sessions: List[Session]) -> None:
+        self.fallback = {}
+        for session in sessions:
+            for exchange in session.exchanges:
+                self.fallback.setdefault(exchange.request,
+                                         exchange.responses)
+        self.greeting = DEFAULT_GREETING
+        self.pending = []
+        #: lines no response was recorded for
+        self.unmatched: List[bytes] = []
+        self.connections: Set['asyncio.Task[Any]'] = set()
+
+    def begin(self, session: Session) -> None:
+        self.greeting = session.greeting
+        self.pending = list(session.exchanges)
+
+    def respond(self, line: bytes) -> List[bytes]:
+        for i, exchange in enumerate(self.pending):
+            if exchange.request == line:
+                del self.pending[i]
+                return exchange.responses
+        command = line.split(b' ', 1)[0]
+        if command == b'D':
+            # inquired data, reserialized by the filter
+            return []
+        if line in self.fallback:
+            return self.fallback[line]
+        if command in ACKNOWLEDGED:
+            return [b'OK']
+        self.unmatched.append(line)
+        return UNKNOWN
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+        writer.write(self.greeting + b'\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.writelines(response + b'\n' for response
+                                  in self.respond(line.rstrip(b'\n')))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class Result(NamedTuple):
+    session: Session
+    received: List[bytes]
+    #: (command, seconds)
+    timings: List[Tuple[bytes, float]]
+
+
+def is_final(line: bytes) -> bool:
+    return line in (b'OK', b'ERR') or line.startswith((b'OK ', b'ERR ',
+                                                       b'INQUIRE '))
+
+
+async def replay(config: ServerConfig, agent: StubAgent, agent_socket: str,
+                 session: Session) -> Result:
+    agent.begin(session)
+    connection = await Connection.open(config, agent_socket, 'replay')
+    received = [session.greeting]
+    timings = []
+    command = b''
+    start = 0.0
+    for line in session.client_lines:
+        keyword = line.split(b' ', 1)[0]
+        if keyword not in (b'D', b'END', b'CAN'):
+            command = keyword
+            start = time.perf_counter()
+        connection.writer.write(line + b'\n')
+        if keyword == b'D':
+            continue
+        # wait for the final response (or the next inquiry)
+        untrusted_line = b''
+        while True:
+            untrusted_line = await connection.reader.readline()
+            if not untrusted_line.endswith(b'\n'):
+                break
+            received.append(untrusted_line[:-1])
+            if is_final(untrusted_line[:-1]):
+                break
+        if not untrusted_line.endswith(b'\n'):
+            # closed by the server
+            break
+        if not untrusted_line.startswith(b'INQUIRE '):
+            timings.append((command, time.perf_counter() - start))
+    await connection.close()
+    return Result(session, received, timings)
+
+
+def keygrips(sessions: List[Session]) -> List[bytes]:
+    return sorted({grip for session in sessions
+                   for line in session.client_lines
+                   for grip in _keygrip_re.findall(line)})
+
+
+def report(results: List[Result], agent: StubAgent, seconds: float,
+           max_diffs: int) -> bool:
+    timings: Dict[bytes, List[float]] = {}
+    for result in results:
+        for command, elapsed in result.timings:
+            timings.setdefault(command, []).append(elapsed)
+    print('{} sessions in {:.2f}s ({:.1f}/s)'.format(
+        len(results), seconds, len(results) / seconds))
+    print('{:<12} {:>8} {:>10} {:>10} {:>10}'.format(
+        'command', 'count', 'mean', 'p50', 'p99'))
+    for command, values in sorted(timings.items()):
+        values.sort()
+        print('{:<12} {:>8} {:>8.3f}ms {:>8.3f}ms {:>8.3f}ms'.format(
+            command.decode('ascii', 'replace'), len(values),
+            sum(values) / len(values) * 1e3,
+            percentile(values, 0.50) * 1e3, percentile(values, 0.99) * 1e3))
+
+    if agent.unmatched:
+        print('{} agent commands without a recorded response, for example '
+              '{!r}'.format(len(agent.unmatched), agent.unmatched[0]))
+    differing = [result for result in results
+                 if result.received != result.session.expected]
+    print('{} of {} sessions with different output'.format(
+        len(differing), len(results)))
+    shown = set()
+    for result in differing:
+        if len(shown) >= max_diffs:
+            break
+        if result.session.name in shown:
+            # the same session repeated
+            continue
+        shown.add(result.session.name)
+        sys.stdout.writelines(difflib.unified_diff(
+            [line.decode('latin-1') + '\n'
+             for line in result.session.expected],
+            [line.decode('latin-1') + '\n' for line in result.received],
+            'session {} recorded'.format(result.session.name),
+            'session {} replayed'.format(result.session.name)))
+    return not differing
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='replay all the sessions that many times')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='sessions replayed at the same time')
+    parser.add_argument('--diffs', type=int, default=5,
+                        help='show output differences of up to that many '
+                             'sessions')
+    parser.add_argument('transcript', type=argparse.FileType('r'),
+                        help='split-gpg2 trace, or debug-agent-socket log')
+    args = parser.parse_args()
+
+    with args.transcript:
+        sessions = read_sessions(args.transcript)
+    sessions = [session for session in sessions if session.client_lines]
+    if not sessions:
+        parser.error('no sessions found in {}'.format(args.transcript.name))
+
+    async def run(config: ServerConfig, tmp_dir: str) -> \
+            Tuple[List[Result], float, StubAgent]:
+        queue = sessions * args.repeat
+        queue.reverse()
+        results: List[Result] = []
+        agents = []
+        async def worker(number: int) -> None:
+            # each worker has its own agent, to know which session it
+            # answers for
+            agent = StubAgent(sessions)
+            agents.append(agent)
+            socket_path = os.path.join(tmp_dir, 'S.agent{}'.format(number))
+            server = await asyncio.start_unix_server(agent.handle,
+                                                     socket_path)
+            async with server:
+                while queue:
+                    results.append(await replay(config, agent, socket_path,
+                                                queue.pop()))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        # let the agents see the pooled connections closed
+        close_agent_pools()
+        connections = set().union(*(agent.connections for agent in agents))
+        if connections:
+            await asyncio.wait(connections)
+        merged = StubAgent([])
+        for agent in agents:
+            merged.unmatched += agent.unmatched
+        return results, elapsed, merged
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gnupghome = os.path.join(tmp_dir, 'gnupg')
+        config = prepare(gnupghome, keygrips=keygrips(sessions))
+        results, seconds, agent = asyncio.run(run(config, tmp_dir))
+    sys.exit(0 if report(results, agent, seconds, args.diffs) else 1)
+
+
+if __name__ == '__main__':
+    main()
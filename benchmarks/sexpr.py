@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Micro-benchmark of GpgServer.parse_sexpr().
+
+Parses ciphertext S-expressions like the ones gpg sends in PKDECRYPT
+(RSA, ElGamal) of growing size, and ones with a growing number of small
+elements. The time per byte should stay flat - the parser is linear.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/sexpr.py
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from splitgpg2 import GpgServer
+
+
+def mpi(length: int) -> bytes:
+    # like a real ciphertext: random, leading zero byte to keep it positive
+    value = b'\0' + os.urandom(length - 1)
+    return b'%d:%s' % (len(value), value)
+
+
+def rsa_ciphertext(bits: int) -> bytes:
+    return b'(7:enc-val(3:rsa(1:a' + mpi(bits // 8 + 1) + b')))'
+
+
+def elg_ciphertext(bits: int) -> bytes:
+    return (b'(7:enc-val(3:elg(1:a' + mpi(bits // 8 + 1) + b')(1:b' +
+            mpi(bits // 8 + 1) + b')))')
+
+
+def many_elements(count: int) -> bytes:
+    return b'(7:enc-val' + b'(1:a1:b)' * count + b')'
+
+
+def bench(name: str, sexpr: bytes, number: int) -> None:
+    seconds = min(timeit.repeat(lambda: GpgServer.parse_sexpr(sexpr),
+                                number=number, repeat=5)) / number
+    print('{:<28} {:>10} B {:>12.1f} us {:>10.2f} ns/B'.format(
+        name, len(sexpr), seconds * 1e6, seconds * 1e9 / len(sexpr)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=200,
+                        help='parses per measurement')
+    args = parser.parse_args()
+
+    print('{:<28} {:>12} {:>15} {:>13}'.format(
+        'input', 'size', 'time/parse', 'time/byte'))
+    for bits in (2048, 4096, 16384, 65536, 262144):
+        bench('rsa{}'.format(bits), rsa_ciphertext(bits), args.number)
+    for bits in (2048, 4096, 16384, 65536, 262144):
+        bench('elg{}'.format(bits), elg_ciphertext(bits), args.number)
+    for count in (10, 100, 1000, 10000, 100000):
+        bench('{} elements'.format(count), many_elements(count),
+              max(1, args.number // count))
+
+
+if __name__ == '__main__':
+    main()
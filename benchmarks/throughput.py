@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+End-to-end throughput of GpgServer against a stand-in gpg-agent.
+
+Each operation is a whole client connection, like one qrexec call: the
+commands gpg sends for a key listing, a signature or a decryption (see
+:py:data:`MIXES`), over a socketpair to a GpgServer relaying them to the
+agent of ``benchmarks/fakeagent.py``. ``--concurrency`` connections run at
+the same time. Signing and decryption are autoaccepted, and notifications
+are not shown, to measure only the filter and the relay.
+
+Each mix runs in its own process, so the peak RSS reported is the one of
+that mix only. The fake agent runs in another process and its time is not
+counted, except for ``--latency``.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/throughput.py [--concurrency 16] [sign ...]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from splitgpg2 import GpgServer, notify
+from splitgpg2.codec import escape_D
+from splitgpg2.config import ServerConfig
+from splitgpg2.keyindex import KeyEntry, keygrip_index
+from splitgpg2.metrics import flush_metrics
+from splitgpg2.trace import close_tracers
+
+from fakeagent import GRIP
+
+PREAMBLE = [
+    b'OPTION ttyname=/dev/pts/0',
+    b'OPTION ttytype=xterm-256color',
+    b'OPTION lc-ctype=C.UTF-8',
+    b'OPTION allow-pinentry-notify',
+    b'OPTION agent-awareness=2.1.0',
+]
+
+#: client commands of each operation, after the agent greeting
+MIXES = {
+    'keylist': PREAMBLE + [
+        b'HAVEKEY --list=1000',
+        b'KEYINFO ' + GRIP,
+    ],
+    'sign': PREAMBLE + [
+        b'HAVEKEY ' + GRIP,
+        b'KEYINFO ' + GRIP,
+        b'SIGKEY ' + GRIP,
+        b'SETKEYDESC Please+enter+the+passphrase',
+        b'SETHASH 8 ' + b'0123456789ABCDEF' * 4,
+        b'PKSIGN',
+    ],
+    'decrypt': PREAMBLE + [
+        b'HAVEKEY ' + GRIP,
+        b'SETKEY ' + GRIP,
+        b'SETKEYDESC Please+enter+the+passphrase',
+        b'PKDECRYPT',
+    ],
+}
+
+#: client responses to agent inquiries, without the final END
+INQUIRE_DATA = {
+    b'CIPHERTEXT': [b'D ' + escape_D(
+        b'(7:enc-val(4:ecdh(1:s33:@%s)(1:e33:@%s)))' % (
+            bytes(range(0x40, 0x60)), bytes(range(0x60, 0x80))))],
+}
+
+
+class QuietNotifier(notify.Notifier):
+    """Coalesces the notifications, but doesn't show them"""
+    async def send(self, summary: str, body: str, replaces_id: int) -> int:
+        return 0
+
+
+def prepare(gnupghome: str,
+            metrics_textfile: Optional[str] = None,
+            trace_log: Optional[str] = None,
+            keygrips: Iterable[bytes] = (GRIP,)) -> ServerConfig:
+    """Set up this process to serve benchmark connections from
+    *gnupghome*, with the agent having *keygrips*, return their config"""
+    # pylint: disable=protected-access
+    notify._notifier = QuietNotifier()
+    # what `gpg --list-secret-keys` would have told about the agent's keys
+    # (the keygrip doubles as the fingerprint) - the index stays valid as
+    # long as the keyring doesn't change
+    os.environ['XDG_CACHE_HOME'] = gnupghome
+    index = keygrip_index(gnupghome)
+    index.entries = {grip: KeyEntry(grip, b'Benchmark <bench@example.com>',
+                                    None)
+                     for grip in keygrips}
+    index.private_keys = index.list_private_keys()
+    index.state = index.current_state()
+    return ServerConfig(
+        timer_delay={'PKSIGN': -1, 'PKDECRYPT': -1},
+        verbose_notifications=False,
+        allow_keygen=False,
+        gnupghome=gnupghome,
+        source_keyring_dir=None,
+        debug_log=None,
+        metrics_textfile=metrics_textfile,
+        trace_log=trace_log,
+        trace_redact='data',
+        unsupported_options=(),
+    )
+
+
+class Connection:
+    """Client side of a GpgServer connection over a socketpair"""
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    server_task: 'asyncio.Task[None]'
+
+    @classmethod
+    async def open(cls, config: ServerConfig, agent_socket: str,
+                   client_domain: str = 'bench') -> 'Connection':
+        self = cls()
+        client_sock, server_sock = socket.socketpair()
+        server_reader, server_writer = \
+            await asyncio.open_connection(sock=server_sock)
+        server = GpgServer(server_reader, server_writer, client_domain)
+        server.apply_config(config)
+        server.agent_socket_path = agent_socket
+        server.agent_unrestricted_socket_path = agent_socket
+        self.server_task = asyncio.ensure_future(server.run())
+        self.reader, self.writer = \
+            await asyncio.open_connection(sock=client_sock)
+        greeting = await self.reader.readline()
+        if not greeting.startswith(b'OK'):
+            raise RuntimeError('unexpected greeting {!r}'.format(greeting))
+        return self
+
+    async def transact(self, line: bytes) -> List[bytes]:
+        """Send a command, answer inquiries, return the response lines"""
+        self.writer.write(line + b'\n')
+        response = []
+        while True:
+            untrusted_line = await self.reader.readline()
+            if not untrusted_line.endswith(b'\n'):
+                raise RuntimeError('connection closed after {!r}'
+                                   .format(line))
+            response.append(untrusted_line[:-1])
+            if untrusted_line.startswith(b'INQUIRE '):
+                keyword = untrusted_line[8:-1].split(b' ')[0]
+                self.writer.writelines(
+                    data + b'\n' for data in INQUIRE_DATA[keyword])
+                self.writer.write(b'END\n')
+            elif untrusted_line.startswith(b'ERR'):
+                raise RuntimeError('{!r} failed: {!r}'.format(
+                    line, untrusted_line))
+            elif untrusted_line == b'OK\n' or \
+                    untrusted_line.startswith(b'OK '):
+                return response
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.server_task
+
+
+async def run_session(config: ServerConfig, agent_socket: str,
+                      script: List[bytes],
+                      client_domain: str = 'bench') -> float:
+    """Run a whole connection, return the time until its last response"""
+    start = time.perf_counter()
+    connection = await Connection.open(config, agent_socket, client_domain)
+    for line in script:
+        await connection.transact(line)
+    latency = time.perf_counter() - start
+    await connection.close()
+    return latency
+
+
+async def run_load(config: ServerConfig, agent_socket: str,
+                   script: List[bytes], operations: int,
+                   concurrency: int) -> Tuple[List[float], float]:
+    """Run *operations* sessions, *concurrency* at a time, return their
+    latencies and the total time"""
+    latencies: List[float] = []
+    remaining = operations
+    async def client() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            latencies.append(
+                await run_session(config, agent_socket, script))
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * fraction))]
+
+
+def worker(mix: str, agent_socket: str, operations: int,
+           concurrency: int,
+           metrics_textfile: Optional[str] = None,
+           trace_log: Optional[str] = None) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as gnupghome:
+        config = prepare(gnupghome, metrics_textfile, trace_log)
+        script = MIXES[mix]
+        async def run() -> Tuple[List[float], float]:
+            # warm up the caches and the agent connection pool
+            await run_load(config, agent_socket, script, concurrency,
+                           concurrency)
+            return await run_load(config, agent_socket, script, operations,
+                                  concurrency)
+        latencies, seconds = asyncio.run(run())
+    flush_metrics()
+    close_tracers()
+    latencies.sort()
+    return {
+        'mix': mix,
+        'operations': len(latencies),
+        'ops_per_second': len(latencies) / seconds,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'mean': statistics.fmean(latencies),
+        # in KiB on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def start_agent(socket_path: str, latency: float) -> subprocess.Popen:
+    """Start ``fakeagent.py`` and wait for it to listen"""
+    agent = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(__file__),
+                                     'fakeagent.py'),
+        '--latency', str(latency), socket_path])
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            return agent
+        if agent.poll() is not None:
+            break
+        time.sleep(0.05)
+    agent.kill()
+    raise RuntimeError('fake agent failed to start')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='connections at the same time')
+    parser.add_argument('--operations', type=int, default=2000,
+                        help='connections per mix')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each agent PKSIGN/PKDECRYPT takes')
+    parser.add_argument('--agent-socket',
+                        help='use the fake agent already listening there')
+    parser.add_argument('--metrics-textfile',
+                        help='enable metrics, to measure their overhead')
+    parser.add_argument('--trace-log',
+                        help='enable the I/O trace, to measure its overhead')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per mix')
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('mixes', nargs='*', metavar='mix',
+                        help='one of: {} (default: all)'.format(
+                            ', '.join(MIXES)))
+    args = parser.parse_args()
+    mixes = args.mixes or list(MIXES)
+    for mix in mixes:
+        if mix not in MIXES:
+            parser.error('unknown mix: {}'.format(mix))
+
+    if args.worker:
+        print(json.dumps(worker(mixes[0], args.agent_socket,
+                                args.operations, args.concurrency,
+                                args.metrics_textfile, args.trace_log)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        agent: Optional[subprocess.Popen] = None
+        agent_socket = args.agent_socket
+        if agent_socket is None:
+            agent_socket = os.path.join(tmp_dir, 'S.gpg-agent')
+            agent = start_agent(agent_socket, args.latency)
+        try:
+            if not args.json:
+                print('{:<10} {:>8} {:>10} {:>10} {:>10} {:>12}'.format(
+                    'mix', 'ops', 'ops/s', 'p50', 'p99', 'peak RSS'))
+            for mix in mixes:
+                extra_args = []
+                if args.metrics_textfile is not None:
+                    extra_args += ['--metrics-textfile',
+                                   os.path.abspath(args.metrics_textfile)]
+                if args.trace_log is not None:
+                    extra_args += ['--trace-log',
+                                   os.path.abspath(args.trace_log)]
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker',
+                     '--agent-socket', agent_socket,
+                     '--operations', str(args.operations),
+                     '--concurrency', str(args.concurrency),
+                     *extra_args, mix],
+                    stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(output)
+                if args.json:
+                    print(json.dumps(result))
+                    continue
+                print('{:<10} {:>8} {:>10.1f} {:>8.2f}ms {:>8.2f}ms '
+                      '{:>9.1f}MiB'.format(
+                          mix, result['operations'], result['ops_per_second'],
+                          result['p50'] * 1e3, result['p99'] * 1e3,
+                          result['peak_rss'] / 1024))
+        finally:
+            if agent is not None:
+                agent.terminate()
+                agent.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -29,27 +29,40 @@ This implements the server part. See README for details.
 # pylint: disable=fixme,too-few-public-methods,missing-class-docstring
 
 import asyncio
-import configparser
 import enum
-import glob
+import importlib
 import logging
 import os
-import pathlib
 import re
-import shutil
-import signal
-import socket
-import string
 import subprocess
 import sys
 import time
 from typing import Optional, Dict, Callable, Awaitable, Tuple, Pattern, List, \
-     Union, Any, TypeVar, Set, TYPE_CHECKING, Coroutine, Sequence, cast
-
+     Union, Any, TypeVar, Set, TYPE_CHECKING, Coroutine, Sequence, NamedTuple, \
+     cast
+
+from .agentpool import agent_pool, close_agent_pools
+from .agentsockets import AgentSocketCache, AgentSockets
+from .assuan import AssuanLineReader
+from .config import ConfigSnapshots
+from . import codec
+from .notify import notifier
+from .responsecache import CacheKey, KeyringState, response_cache
+# pylint: disable=unused-import
+from .config import TIMER_NAMES, \
+    load_config_files as load_config_files
+from .keyindex import BaseKeyInfo, KeyInfo, SubKeyInfo, KeygripIndex, \
+    keygrip_index
+# pylint: enable=unused-import
 from .stdiostream import StdoutWriterProtocol
 
 if TYPE_CHECKING:
+    import configparser
     from typing_extensions import Protocol
+    from .autoaccept import AutoacceptStore
+    from .config import ServerConfig
+    from .metrics import CommandTiming, Metrics
+    from .trace import ConnectionTrace
     from typing import TypeAlias
     SExpr: TypeAlias = Union[List['SExpr'], bytes]
     class ArgCallback(Protocol):
@@ -62,25 +75,62 @@ if TYPE_CHECKING:
         def __call__(self, *, untrusted_sexp: 'SExpr') -> None:
             pass
 
+# names moved to modules imported only when needed
+_lazy_names = {
+    'known_eddsa_curves': 'keygen',
+    'known_safeecdh_curves': 'keygen',
+    'known_other_curves': 'keygen',
+}
+
+def autoaccept_store() -> 'AutoacceptStore':
+    """See :py:func:`splitgpg2.autoaccept.autoaccept_store` - imported only
+    when a command needs a confirmation"""
+    # pylint: disable=import-outside-toplevel
+    from .autoaccept import autoaccept_store as store
+    return store()
+
+def __getattr__(name: str) -> Any:
+    try:
+        module = _lazy_names[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'
+                             .format(__name__, name)) from None
+    return getattr(importlib.import_module('.' + module, __name__), name)
+
 # pylint: disable=invalid-name
 T = TypeVar('T', List['SExpr'], bytes)
 
 # from assuan.h
 ASSUAN_LINELENGTH = 1002
 
-known_eddsa_curves = { b'Ed25519', b'Ed448' }
+# flow control on the connection to the client: once more than the high
+# water mark is queued, relaying agent responses waits until it is down to
+# the low water mark
+CLIENT_WRITE_HIGH_WATER = 64 * 1024
+CLIENT_WRITE_LOW_WATER = 16 * 1024
+
+# Commands that may be pipelined - when the client sends several of them
+# back to back, they are passed to the agent in one go (or answered without
+# asking it), and the responses are sent back in order. Neither of them
+# involves an inquire or the user.
+PIPELINED_COMMANDS = (
+    b'RESET',
+    b'OPTION',
+    b'GETINFO',
+    b'HAVEKEY',
+    b'KEYINFO',
+    b'SETHASH',
+    b'NOP',
+    b'SETKEYDESC',
+    b'SCD',
+    b'AGENT_ID',
+)
 
-known_safeecdh_curves = { b'Curve25519', b'X448' }
+# how many D lines an inquire response may span
+MAX_INQUIRE_DATA_LINES = 16
 
-known_other_curves = {
-    b'NIST P-256',
-    b'NIST P-384',
-    b'NIST P-521',
-    b'brainpoolP256r1',
-    b'brainpoolP384r1',
-    b'brainpoolP512r1',
-    b'secp256k1',
-}
+# how long to wait for notifications to be shown before exiting
+NOTIFY_FLUSH_TIMEOUT = 1.0
 
 class GPGErrorCode:
     # see gpg-error.h
@@ -124,36 +174,6 @@ class HashAlgo:
         self.name = name
         self.len = length
 
-class BaseKeyInfo:
-    """
-    Base class for KeyInfo and SubKeyInfo.  Do not use as a type for variables;
-    use ``Union[KeyInfo, SubKeyInfo]`` instead.
-    """
-    fingerprint: Optional[bytes]
-    keygrip: Optional[bytes]
-    capabilities: bytes
-    __slots__ = ('fingerprint', 'keygrip', 'capabilities')
-    def __init__(self, capabilities: bytes) -> None:
-        self.fingerprint = None
-        self.keygrip = None
-        self.capabilities = capabilities
-
-class SubKeyInfo(BaseKeyInfo):
-    key: 'KeyInfo'
-    __slots__ = ('key',)
-    def __init__(self, capabilities: bytes, key: 'KeyInfo'):
-        super().__init__(capabilities)
-        self.key = key
-
-class KeyInfo(BaseKeyInfo):
-    subkeys: List[SubKeyInfo]
-    first_uid: Optional[bytes]
-    __slots__ = ('subkeys', 'first_uid')
-    def __init__(self, capabilities: bytes):
-        super().__init__(capabilities)
-        self.first_uid = None
-        self.subkeys = []
-
 @enum.unique
 class ServerState(enum.Enum):
     # pylint: disable=invalid-name
@@ -175,6 +195,16 @@ def extract_args(untrusted_line: bytes, sep: bytes = b' ') -> Tuple[bytes, Optio
 # none of our uses allow 0, so do not allow it
 _int_re: re.Pattern[bytes] = re.compile(rb'\A[1-9][0-9]*\Z')
 _hash_regex = re.compile(rb'\A[0-9A-F]+\Z')
+_sexpr_literal_re = re.compile(rb'[0-9a-zA-Z-_]+')
+
+def _translate_table(allowed: bytes) -> bytes:
+    """Table for bytes.translate() replacing bytes not in *allowed*
+    with '.'"""
+    return bytes(c if c in allowed else ord('.') for c in range(256))
+
+# printable ASCII, without whitespace other than space
+_log_io_table = _translate_table(bytes(range(0x20, 0x7f)))
+_key_desc_table = _translate_table(bytes(range(0x20, 0x7e)) + b'\n')
 
 def sanitize_int(untrusted_arg: bytes, min_value: int, max_value: int) -> int:
     """
@@ -193,6 +223,175 @@ def sanitize_int(untrusted_arg: bytes, min_value: int, max_value: int) -> int:
         raise Filtered
     return res
 
+class SExprParser:
+    """
+    Incremental S-expression parser, for inquire data sent in several
+    D lines.  Feed it the (unescaped) data as it arrives with :py:meth:`feed`,
+    :py:attr:`complete` tells when the top level list is closed, and
+    :py:meth:`finish` returns the result once there is no more data.
+
+    Only the unparsed rest of the input is buffered - an incomplete token at
+    the end of a chunk waits for the next one.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    # This parser is only good enough to parse the sexpr gpg generates. It does
+    # *not* implement http://people.csail.mit.edu/rivest/Sexp.txt fully. Since
+    # we send the reserialized form this should be safe.
+
+    #: what to skip before the next token
+    SKIP_NOTHING = 0
+    SKIP_SPACE = 1  # a single space, after a literal
+    SKIP_SPACES = 2  # any number of spaces, after ')'
+
+    stack: List[List['SExpr']]
+    current: List['SExpr']
+    #: length of the string starting at the beginning of the buffer, if its
+    #: length prefix was parsed already
+    string_length: Optional[int]
+
+    def __init__(self, max_size: int = sys.maxsize) -> None:
+        self.max_size = max_size
+        self.buffer = bytearray()
+        #: bytes fed so far, and already parsed (not in the buffer anymore)
+        self.size = 0
+        self.parsed = 0
+        self.stack = []
+        self.current = []
+        self.skip = self.SKIP_NOTHING
+        self.string_length = None
+        # a literal needs to be followed by no newline at all
+        self.seen_literal = False
+
+    @property
+    def complete(self) -> bool:
+        """The top level list is closed - more data may still follow, and
+        make the whole thing invalid"""
+        return (not self.stack and len(self.current) == 1 and
+                isinstance(self.current[0], list))
+
+    def feed(self, untrusted_data: bytes) -> None:
+        self.size += len(untrusted_data)
+        if self.size > self.max_size:
+            raise ValueError("sexpr too long")
+        if self.seen_literal and b'\n' in untrusted_data:
+            raise ValueError("Invalid literal")
+        self.buffer += untrusted_data
+        self.parse(final=False)
+
+    def finish(self) -> 'SExpr':
+        self.parse(final=True)
+        if self.string_length is not None:
+            # the string doesn't fit in the data
+            raise Filtered
+        if self.stack:
+            raise ValueError("missing closing parenthesis")
+        if len(self.current) != 1:
+            raise ValueError("sexpr top level shold have exactly one element")
+        if not isinstance(self.current[0], list):
+            # We assume this in serialize_sexpr and at least for gpg this seems
+            # to be true.
+            raise ValueError("sexpr top level shold be a list")
+        return self.current[0]
+
+    def parse(self, final: bool) -> None:
+        """Parse as much of the buffer as possible"""
+        # Single pass over the input, keeping the lists being parsed on an
+        # explicit stack - no recursion and no copies of the remaining input.
+        untrusted_buf = self.buffer
+        end = len(untrusted_buf)
+        last_newline = untrusted_buf.rfind(b'\n')
+        pos = 0
+        while True:
+            if self.string_length is not None:
+                if end - pos < self.string_length:
+                    break
+                self.current.append(
+                    bytes(untrusted_buf[pos:pos + self.string_length]))
+                pos += self.string_length
+                self.string_length = None
+            if pos >= end:
+                break
+            char = untrusted_buf[pos]
+            if self.skip != self.SKIP_NOTHING:
+                if char == 0x20:
+                    pos += 1
+                    if self.skip == self.SKIP_SPACE:
+                        self.skip = self.SKIP_NOTHING
+                    continue
+                self.skip = self.SKIP_NOTHING
+            next_pos: Optional[int]
+            if char == 0x29: # ')'
+                next_pos = self.close_list(pos)
+            elif 0x30 <= char <= 0x40:
+                next_pos = self.parse_string_length(untrusted_buf, pos, final)
+            elif char == 0x28: # '('
+                self.stack.append(self.current)
+                self.current = []
+                next_pos = pos + 1
+            else:
+                next_pos = self.parse_literal(untrusted_buf, pos,
+                                              last_newline, final)
+            if next_pos is None:
+                # incomplete token, wait for the next chunk
+                break
+            pos = next_pos
+        del untrusted_buf[:pos]
+        self.parsed += pos
+
+    def close_list(self, pos: int) -> int:
+        if not self.stack:
+            raise ValueError("garbage at end of sexpr")
+        if len(self.stack) > 20:
+            # This limit is arbitrary. The motivation is to avoid
+            # problems if gpg-agent would recurse too much based on
+            # sexpr nesting **and** would jump the guard page (for
+            # example through a big stack allocation). This is
+            # borderline too paranoid, but for now we accepted it.
+            raise ValueError("sexpr has too big nesting depth")
+        finished = self.current
+        self.current = self.stack.pop()
+        self.current.append(finished)
+        self.skip = self.SKIP_SPACES
+        return pos + 1
+
+    def parse_string_length(self, untrusted_buf: bytearray, pos: int,
+                            final: bool) -> Optional[int]:
+        colon = untrusted_buf.find(b':', pos)
+        if colon == -1:
+            if final:
+                raise ValueError("missing length of a string")
+            return None
+        self.string_length = sanitize_int(
+            bytes(untrusted_buf[pos:colon]), 1,
+            self.max_size - self.parsed - colon - 1)
+        return colon + 1
+
+    def parse_literal(self, untrusted_buf: bytearray, pos: int,
+                      last_newline: int, final: bool) -> Optional[int]:
+        match = _sexpr_literal_re.match(untrusted_buf, pos)
+        if match is None or last_newline >= pos:
+            raise ValueError("Invalid literal")
+        if match.end() == len(untrusted_buf) and not final:
+            # may continue in the next chunk
+            return None
+        self.current.append(bytes(match.group()))
+        self.seen_literal = True
+        self.skip = self.SKIP_SPACE
+        return match.end()
+
+
+class PipelinedCommand(NamedTuple):
+    #: command line to send to the agent, ``None`` for a response given
+    #: without asking the agent
+    command: Optional[bytes]
+    #: the response, in the latter case
+    response: Sequence[bytes]
+    #: where to store the agent response in the response cache, if at all
+    cache_key: Optional[CacheKey]
+    keyring_state: Optional[KeyringState]
+
+
 class GpgServer:
     """
     Protocol class for interacting with remote client connecting to split-gpg2.
@@ -211,20 +410,27 @@ class GpgServer:
     log_io_enable: bool
     gnupghome: str
     client_reader: asyncio.StreamReader
+    client_lines: AssuanLineReader
     client_writer: asyncio.StreamWriter
     client_domain: str
     hash_algos: Dict[int, HashAlgo]
-    keygrip_map: Dict[bytes, Union[KeyInfo, SubKeyInfo]]
     inquire_commands: Dict[bytes, Callable[[bytes], Awaitable[bool]]]
     options: Dict[bytes, Tuple[OptionHandlingType, Optional[bytes]]]
     commands: Dict[bytes, 'NoneCallback']
-    seen_data: bool
+    inquire_data: Optional[SExprParser]
+    inquire_data_lines: int
+    inquire_data_sent: bool
     config_loaded: bool
     agent_unrestricted_socket_path: Optional[str]
     agent_socket_path: Optional[str]
-    agent_reader: Optional[asyncio.StreamReader]
+    agent_reader: Optional[AssuanLineReader]
     agent_writer: Optional[asyncio.StreamWriter]
+    client_lookahead: Optional['asyncio.Task[bytes]']
+    pipeline: List[PipelinedCommand]
     source_keyring_dir: Optional[str]
+    metrics: Optional['Metrics']
+    timing: Optional['CommandTiming']
+    trace: Optional['ConnectionTrace']
     log: logging.Logger
 
     cache_nonce_regex: re.Pattern[bytes] = re.compile(rb'\A[0-9A-F]{24}\Z')
@@ -238,20 +444,27 @@ class GpgServer:
                  'log_io_enable',
                  'gnupghome',
                  'client_reader',
+                 'client_lines',
+                 'pipeline',
                  'client_writer',
                  'client_domain',
                  'hash_algos',
-                 'keygrip_map',
                  'inquire_commands',
                  'options',
                  'commands',
-                 'seen_data',
+                 'inquire_data',
+                 'inquire_data_lines',
+                 'inquire_data_sent',
                  'config_loaded',
                  'agent_socket_path',
                  'agent_unrestricted_socket_path',
                  'agent_reader',
                  'agent_writer',
+                 'client_lookahead',
                  'source_keyring_dir',
+                 'metrics',
+                 'timing',
+                 'trace',
                  'log')
 
     def __init__(self, reader: asyncio.StreamReader,
@@ -268,150 +481,88 @@ class GpgServer:
         self.log_io_enable = False
         self.gnupghome = '' # placeholder
         self.source_keyring_dir = None
+        #: where to count commands, ``None`` if not enabled
+        self.metrics = None
+        #: phases of the command being handled, if counted
+        self.timing = None
+        #: I/O trace of this connection, ``None`` if not enabled
+        self.trace = None
 
         self.client_reader = reader
+        self.client_lines = AssuanLineReader(reader)
+        #: commands queued while more of them are pipelined, see
+        #: :py:meth:`flush_pipeline`
+        self.pipeline = []
         self.client_writer = writer
         self.client_domain = client_domain
         self.commands = self.default_commands()
         self.options = self.default_options()
         self.hash_algos = self.default_hash_algos()
-        self.keygrip_map = {}
 
         self.log = logging.getLogger('splitgpg2.Server')
         self.agent_socket_path = None
         self.agent_unrestricted_socket_path = None
-        self.agent_reader: Optional[asyncio.StreamReader] = None
+        self.agent_reader: Optional[AssuanLineReader] = None
         self.agent_writer: Optional[asyncio.StreamWriter] = None
+        #: line read from the client while waiting for it to disconnect,
+        #: see :py:meth:`wait_for_disconnect`
+        self.client_lookahead = None
 
-        self.seen_data = False
+        self.inquire_data = None
+        self.inquire_data_lines = 0
+        self.inquire_data_sent = False
         self.config_loaded = False
 
         if debug_log:
-            handler = logging.FileHandler(debug_log)
-            self.log.addHandler(handler)
+            # the logger is shared by all connections of a long-running
+            # daemon, add the handler only once
+            debug_log = os.path.abspath(debug_log)
+            if not any(isinstance(h, logging.FileHandler) and
+                       h.baseFilename == debug_log
+                       for h in self.log.handlers):
+                self.log.addHandler(logging.FileHandler(debug_log))
             self.log.setLevel(logging.DEBUG)
             self.log_io_enable = True
 
-    def _parse_timer_val(self, value: str, option_name: str) -> Optional[int]:
-        if value == 'no':
-            return None
-        if value == 'yes':
-            return -1
-        try:
-            int_value = int(value)
-            if int_value <= 0:
-                raise ValueError(value)
-        except ValueError as e:
-            self.log.error(
-                "Invalid value '%s' for '%s' config option",
-                str(e), option_name
-            )
-            raise
-        return int_value
-
-    def _parse_bool_val(self, value: str, option_name: str) -> bool:
-        if value == 'no':
-            return False
-        if value == 'yes':
-            return True
-        self.log.error(
-            "Invalid value '%s' for '%s' config option",
-            value, option_name
-        )
-        raise ValueError(value)
-
-    def setup_subkey_keyring(self) -> None:
-        assert self.source_keyring_dir is not None
-        shutil.rmtree(self.gnupghome)
-        os.mkdir(self.gnupghome, 0o700)
-        xferflags = ('gpg', '--no-armor', '--batch', '--with-colons',
-                     '--no-tty', '--disable-dirmngr')
-        export_cmd = xferflags + ('--export-secret-subkeys', '--homedir',
-                                  self.source_keyring_dir)
-        import_cmd = xferflags + ('--import', '--homedir', self.gnupghome,)
-        self.log.info('Creating subkeys-only keyring in %r from original keyring %r',
-                      self.gnupghome, self.source_keyring_dir)
-        with subprocess.Popen(export_cmd,
-                              stdout=subprocess.PIPE,
-                              stdin=subprocess.DEVNULL,
-                              stderr=subprocess.PIPE) as exporter, (
-             subprocess.Popen(import_cmd,
-                              stdin=exporter.stdout,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)) as importer:
-            pass
-        if exporter.returncode or importer.returncode:
-            self.log.warning('Unable to export keys.  If your key has a '
-                             'passphrase, you might want to save it to a '
-                             'file and use passphrase-file and '
-                             'pinentry-mode loopback in gpg.conf.')
-            self.log.warning("Exporter output: %s", exporter.stderr)
-            self.log.warning("Importer output: %s %s",
-                             importer.stdout, importer.stderr)
-        self.log.info('Subkey-only keyring %r created',
-                      self.gnupghome)
-
-    def load_config(self, config: configparser.SectionProxy) -> None:
+    async def sync_keyring(self) -> None:
+        """Bring the subkeys-only keyring up to date, see
+        :py:mod:`splitgpg2.keyringsync`"""
+        if self.source_keyring_dir is None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from .keyringsync import keyring_sync
+        await keyring_sync(self.source_keyring_dir, self.gnupghome).ensure()
+
+    def load_config(self, config: 'configparser.SectionProxy') -> None:
+        # pylint: disable=import-outside-toplevel
+        from .config import compile_config
+        self.apply_config(compile_config(config, self.client_domain, self.log))
+
+    def apply_config(self, config: 'ServerConfig') -> None:
+        """Use an already validated config, see
+        :py:func:`splitgpg2.config.compile_config`"""
         self.config_loaded = True
-        default_autoaccept = config.get('autoaccept', 'no')
-        for timer_name in TIMER_NAMES:
-            timer_value = config.get(timer_name + '_autoaccept',
-                default_autoaccept)
-            self.timer_delay[timer_name] = self._parse_timer_val(
-                timer_value, 'autoaccept')
-
-        self.verbose_notifications = self._parse_bool_val(
-            config.get('verbose_notifications', 'no'), 'verbose_notifications')
-
-        self.allow_keygen = self._parse_bool_val(
-            config.get('allow_keygen', 'no'), 'allow_keygen')
-
-        gnupghome = config.get('gnupghome', None)
-        if gnupghome is None:
-            if 'isolated_gnupghome_dirs' in config:
-                gnupghome = os.path.expanduser(os.path.join(
-                    config['isolated_gnupghome_dirs'],
-                    self.client_domain))
-            else:
-                gnupghome = os.getenv('GNUPGHOME')
-                if gnupghome is None:
-                    gnupghome = os.path.expanduser('~/.gnupg')
-        if not gnupghome.startswith('/'):
-            raise ValueError('GnuPG home directory {!r} is not '
-                             'absolute!'.format(gnupghome))
-        self.gnupghome = gnupghome
-
-        # warn about unknown options, to easier spot typos, but don't refuse to
-        # start, to allow extensibility
-        supported_options = (
-            'autoaccept',
-            'pksign_autoaccept',
-            'pkdecrypt_autoaccept',
-            'verbose_notifications',
-            'allow_keygen',
-            'gnupghome',
-            'source_keyring_dir',
-            'isolated_gnupghome_dirs',
-            # handled in main()
-            'debug_log',
-        )
-        for option in config:
-            if option not in supported_options:
-                self.log.warning('Unsupported config option: %s', option)
+        self.timer_delay.update(config.timer_delay)
+        self.verbose_notifications = config.verbose_notifications
+        self.allow_keygen = config.allow_keygen
+        self.gnupghome = config.gnupghome
+        self.source_keyring_dir = config.source_keyring_dir
+        if config.metrics_textfile is not None:
+            # pylint: disable=import-outside-toplevel
+            from .metrics import metrics
+            self.metrics = metrics(config.metrics_textfile)
+        if config.trace_log is not None:
+            # pylint: disable=import-outside-toplevel
+            from .trace import tracer
+            self.trace = tracer(config.trace_log).connection(
+                self.client_domain, config.trace_redact)
+
+        for option in config.unsupported_options:
+            self.log.warning('Unsupported config option: %s', option)
         self.log.info('Using GnuPG home directory %s', self.gnupghome)
         os.makedirs(self.gnupghome, 0o700, exist_ok=True)
 
-        source_keyring_dir = config.get('source_keyring_dir')
-        if source_keyring_dir is not None:
-            if source_keyring_dir != 'no':
-                self.source_keyring_dir = os.path.expanduser(source_keyring_dir)
-        else:
-            self.source_keyring_dir = self.gnupghome
-
         if self.source_keyring_dir is not None:
-            if not self.source_keyring_dir.startswith('/'):
-                raise ValueError('Source keyring directory {!r} is not '
-                                 'absolute!'.format(self.source_keyring_dir))
             self.gnupghome += '/qubes-auto-keyring'
             try:
                 os.makedirs(self.gnupghome, 0o700)
@@ -421,16 +572,20 @@ class GpgServer:
                 if stat1.st_ino == stat2.st_ino and stat1.st_dev == stat2.st_dev:
                     raise ValueError('{!r} and {!r} are the same directory'
                                      .format(self.gnupghome, self.source_keyring_dir)) from None
-                if stat1.st_mtime <= stat2.st_mtime:
-                    return
-            self.setup_subkey_keyring()
+            # the keys are synced when the connection starts, see
+            # sync_keyring()
 
     async def run(self) -> None:
+        await self.sync_keyring()
         await self.connect_agent()
         try:
-            while not self.client_reader.at_eof():
+            while self.client_lookahead is not None or \
+                    not self.client_lines.at_eof():
                 await self.handle_command()
         finally:
+            for fut in self.notify_on_disconnect:
+                if isinstance(fut, asyncio.Future) and not fut.done():
+                    fut.set_result(None)
             # close connection to the real gpg agent too
             if self.agent_writer is not None:
                 self.agent_writer.close()
@@ -439,51 +594,73 @@ class GpgServer:
             await self.client_writer.wait_closed()
 
     def log_io(self, prefix: str, untrusted_msg: bytes) -> None:
+        if self.trace is not None:
+            self.trace.record(prefix, untrusted_msg)
         if not self.log_io_enable:
             return
-        allowed = string.printable.\
-            replace('\t', '').\
-            replace('\n', '').\
-            replace('\r', '').\
-            replace('\f', '').\
-            replace('\v', '')
-        allowed_bytes = allowed.encode('ascii')
-        self.log.warning('%s: %s', prefix, ''.join(
-            chr(c) if c in allowed_bytes else '.'
-            for c in untrusted_msg.strip()))
+        self.log.warning('%s: %s', prefix, untrusted_msg.strip().
+                         translate(_log_io_table).decode('ascii'))
 
     def homedir_opts(self) -> List[str]:
         if self.gnupghome:
             return ['--homedir', self.gnupghome]
         return []
 
-    async def connect_agent(self) -> None:
-        assert self.config_loaded, 'Config not loaded?'
+    async def gpgconf(self, *args: str) -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            'gpgconf', *self.homedir_opts(), *args,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        stdout, _ = await proc.communicate()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(
+                proc.returncode, ['gpgconf', *args])
+        return stdout
+
+    async def launch_agent(self) -> None:
         try:
-            subprocess.check_call(
-                ['gpgconf', *self.homedir_opts(), '--launch', 'gpg-agent'])
+            await self.gpgconf('--launch', 'gpg-agent')
         except subprocess.CalledProcessError as e:
             raise StartFailed from e
 
-        dirs = subprocess.check_output(
-            ['gpgconf', *self.homedir_opts(), '--list-dirs', '-o/dev/stdout'])
-        unrestricted_socket_field = b'agent-socket'
-        socket_field = unrestricted_socket_field if self.allow_keygen else b'agent-extra-socket'
+    async def list_agent_sockets(self) -> AgentSockets:
+        dirs = await self.gpgconf('--list-dirs', '-o/dev/stdout')
+        sockets: Dict[bytes, str] = {}
         # search for agent-socket:/run/user/1000/gnupg/S.gpg-agent
         for d in dirs.splitlines():
             key, value = d.split(b':')
-            if key == socket_field:
-                self.agent_socket_path = value.decode("UTF-8", "surrogateescape")
-            if key == unrestricted_socket_field:
-                self.agent_unrestricted_socket_path = value.decode("UTF-8", "surrogateescape")
-            if ((self.agent_unrestricted_socket_path is not None) and
-                (self.agent_socket_path is not None)):
-                break
-        else:
-            raise RuntimeError("bad output from gpgconf")
+            if key in (b'agent-socket', b'agent-extra-socket'):
+                sockets[key] = value.decode("UTF-8", "surrogateescape")
+        try:
+            return AgentSockets(sockets[b'agent-socket'],
+                                sockets[b'agent-extra-socket'])
+        except KeyError:
+            raise RuntimeError("bad output from gpgconf") from None
 
-        self.agent_reader, self.agent_writer = await asyncio.open_unix_connection(
-                path=self.agent_socket_path)
+    async def connect_agent(self) -> None:
+        assert self.config_loaded, 'Config not loaded?'
+        sockets: Optional[AgentSockets] = None
+        cache = agent_socket_cache()
+        if self.agent_socket_path is None:
+            sockets = cache.get(self.gnupghome)
+            if sockets is None:
+                sockets = await self.list_agent_sockets()
+            self.agent_unrestricted_socket_path = sockets.socket
+            self.agent_socket_path = \
+                sockets.socket if self.allow_keygen else sockets.extra_socket
+        try:
+            agent_reader, self.agent_writer = \
+                await asyncio.open_unix_connection(path=self.agent_socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # start the agent only if it isn't running already
+            self.log.info('gpg-agent not running at %s, launching it',
+                          self.agent_socket_path)
+            cache.invalidate(self.gnupghome)
+            await self.launch_agent()
+            agent_reader, self.agent_writer = \
+                await asyncio.open_unix_connection(path=self.agent_socket_path)
+        self.agent_reader = AssuanLineReader(agent_reader)
+        if sockets is not None:
+            cache.put(self.gnupghome, sockets)
 
         if self.verbose_notifications:
             self.notify('connected')
@@ -517,18 +694,47 @@ class GpgServer:
                 return
 
             untrusted_cmd, untrusted_args = extract_args(untrusted_line)
+            if self.metrics is not None:
+                self.start_timing(untrusted_cmd)
             try:
                 command = self.commands[untrusted_cmd]
             except KeyError as e:
                 raise Filtered from e
+            if untrusted_cmd not in PIPELINED_COMMANDS:
+                await self.flush_pipeline()
             await command(untrusted_args=untrusted_args)
+            if not self.client_lines.pending:
+                # no more commands already sent by the client
+                await self.flush_pipeline()
+            self.end_timing('ok')
         except Filtered as e:
+            self.end_timing('filtered')
             self.log.exception(e)
+            # responses to the commands before go first
+            try:
+                await self.flush_pipeline()
+            except Exception:  # pylint: disable=broad-except
+                pass
             self.close_on_filtered_error(e)
         except BaseException as e:  # pylint: disable=broad-except
+            self.end_timing('error')
             self.log.exception(e)
             self.close('error')
 
+    def start_timing(self, untrusted_cmd: bytes) -> None:
+        # pylint: disable=import-outside-toplevel
+        from .metrics import CommandTiming
+        # only known commands are counted by name
+        self.timing = CommandTiming(untrusted_cmd.decode('ascii')
+                                    if untrusted_cmd in self.commands
+                                    else 'unknown')
+
+    def end_timing(self, result: str) -> None:
+        if self.timing is not None:
+            assert self.metrics is not None
+            self.metrics.observe(self.timing, self.client_domain, result)
+            self.timing = None
+
     async def handle_inquire(self, inquire_commands: Dict[bytes, 'ArgCallback']) -> bool:
         untrusted_line = await self.read_one_line_from_client()
         try:
@@ -598,52 +804,136 @@ class GpgServer:
             11: HashAlgo('sha224', 56),
         }
 
-    @staticmethod
-    def notify(msg: str) -> None:
-        try:
-            # TODO: call into dbus directly
-            subprocess.call(['notify-send', 'split-gpg2: {}'.format(msg)])
-        except FileNotFoundError:
-            pass
+    def notify(self, msg: str) -> None:
+        notifier().notify(msg, self.client_domain)
 
-    def request_timer(self, name: str) -> None:
+    async def request_timer(self, name: str) -> None:
         now = time.time()
         delay = self.timer_delay[name]
-        timestamp_path = self.timestamp_path(name)
+        assert self.agent_socket_path is not None
+        store = autoaccept_store()
         if delay is not None:
             if delay < 0:
                 self.notify('command {} automatically allowed'.format(name))
                 return
-            try:
-                mtime = timestamp_path.stat().st_mtime
-                if mtime + delay > now:
-                    self.notify('command {} automatically allowed'.format(name))
-                    return
-            except FileNotFoundError:
-                pass
+            granted = store.granted_at(self.agent_socket_path, name,
+                                       self.client_domain)
+            if granted is not None and granted + delay > now:
+                self.notify('command {} automatically allowed'.format(name))
+                return
 
         short_msg = "split-gpg2: '{}' wants to execute {}".format(
             self.client_domain, name)
         question = '{}\nDo you want to allow this{}?'.format(
             short_msg,
             'for the next {}s'.format(delay) if delay is not None else '')
-        if subprocess.call(['zenity', '--question', '--title', short_msg,
-                            '--text', question, '--timeout', '30']) != 0:
+        start = time.perf_counter()
+        try:
+            allowed = await self.ask_user(short_msg, question)
+        finally:
+            if self.timing is not None:
+                self.timing.add('prompt', start)
+        if not allowed:
             raise Filtered
 
         self.notify('command {} allowed'.format(name))
-        timestamp_path.touch()
+        store.grant(self.agent_socket_path, name, self.client_domain,
+                    time.time())
+
+    async def ask_user(self, title: str, question: str) -> bool:
+        """Show a confirmation prompt, without blocking other connections.
+
+        If the client disconnects while the prompt is shown, the prompt is
+        closed and :py:class:`ConnectionResetError` is raised.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            'zenity', '--question', '--title', title,
+            '--text', question, '--timeout', '30',
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        answer = asyncio.ensure_future(proc.wait())
+        disconnect = asyncio.ensure_future(self.wait_for_disconnect())
+        try:
+            await asyncio.wait((answer, disconnect),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not answer.done():
+                raise ConnectionResetError(
+                    'client disconnected while waiting for confirmation')
+        finally:
+            disconnect.cancel()
+            if not answer.done():
+                proc.kill()
+                await answer
+        return proc.returncode == 0
+
+    async def wait_for_disconnect(self) -> None:
+        """Wait until the client disconnects.
+
+        The client is not supposed to send anything while waiting for a
+        command response, but if it does, the line is kept for
+        :py:meth:`read_one_line_from_client`.
+        """
+        if self.client_lookahead is None:
+            self.client_lookahead = asyncio.ensure_future(
+                self.client_lines.readline())
+        if await asyncio.shield(self.client_lookahead):
+            # can't look further without buffering the client input,
+            # rely on run() signalling the end of the connection
+            disconnected = asyncio.get_running_loop().create_future()
+            self.notify_on_disconnect.add(disconnected)
+            try:
+                await disconnected
+            finally:
+                self.notify_on_disconnect.discard(disconnected)
+
+    def autoaccept_grants(self) -> Dict[str, float]:
+        """Commands currently automatically allowed for the client, with
+        the time until which they are"""
+        assert self.agent_socket_path is not None
+        now = time.time()
+        grants = {}
+        for grant in autoaccept_store().list(self.client_domain):
+            delay = self.timer_delay.get(grant.name)
+            if grant.agent_socket_path != self.agent_socket_path or \
+                    delay is None or delay < 0:
+                continue
+            if grant.granted + delay > now:
+                grants[grant.name] = grant.granted + delay
+        return grants
 
-    def timestamp_path(self, name: str) -> pathlib.Path:
-        return pathlib.Path('{}_split-gpg2-timestamp_{}_{}'.format(
-            self.agent_socket_path, name, self.client_domain))
+    def revoke_autoaccept(self, name: Optional[str] = None) -> None:
+        """Ask again before the next *name* (or any) command"""
+        for grant in autoaccept_store().revoke(self.client_domain, name):
+            self.log.info('Revoked autoaccept of %s for %s',
+                          grant.name, grant.client_domain)
 
     def client_write(self, data: bytes) -> None:
         self.log_io('C <<<', data)
         self.client_writer.write(data)
 
+    def client_writelines(self, lines: Sequence[bytes]) -> None:
+        if self.log_io_enable or self.trace is not None:
+            for line in lines:
+                self.log_io('C <<<', line)
+        self.client_writer.writelines(lines)
+
+    async def client_drain(self) -> None:
+        """Wait for the client to catch up, if too much data is queued for
+        it (see :py:data:`CLIENT_WRITE_HIGH_WATER`)"""
+        start = time.perf_counter()
+        await self.client_writer.drain()
+        if self.timing is not None:
+            self.timing.add('client', start)
+
     async def read_one_line_from_client(self) -> bytes:
-        untrusted_line = await self.client_reader.readline()
+        start = time.perf_counter()
+        if self.client_lookahead is not None:
+            untrusted_line = await self.client_lookahead
+            self.client_lookahead = None
+        else:
+            untrusted_line = await self.client_lines.readline()
+        if self.timing is not None:
+            # reading the command itself is not timed, only inquired data
+            self.timing.add('client', start)
         untrusted_line = untrusted_line.rstrip(b'\n')
         # pylint: disable=arguments-differ
         if len(untrusted_line) > ASSUAN_LINELENGTH:
@@ -654,12 +944,50 @@ class GpgServer:
     async def send_inquire(self, inquire: bytes,
             inquire_commands: Dict[bytes, 'ArgCallback']) -> None:
         self.client_write(b'INQUIRE ' + inquire + b'\n')
-        self.seen_data = False
+        self.inquire_data = None
+        self.inquire_data_lines = 0
+        self.inquire_data_sent = False
         while await self.handle_inquire(inquire_commands):
             pass
 
     def fake_respond(self, response: bytes) -> None:
-        self.client_write(response + b'\n')
+        self.respond([response + b'\n'])
+
+    def respond(self, lines: Sequence[bytes]) -> None:
+        """Send a response not coming from the agent right now - after
+        responses to the pipelined commands before, if any"""
+        if self.pipeline:
+            self.pipeline.append(PipelinedCommand(None, lines, None, None))
+        else:
+            self.client_writelines(lines)
+
+    async def flush_pipeline(self) -> None:
+        """Send the queued commands to the agent in one go, and pass the
+        responses to the client in order"""
+        if not self.pipeline:
+            return
+        assert self.agent_reader is not None, "no reader?"
+        assert self.agent_writer is not None, "no writer?"
+        pipeline, self.pipeline = self.pipeline, []
+        commands = [entry.command for entry in pipeline
+                    if entry.command is not None]
+        if commands:
+            self.agent_write(b''.join(commands), self.agent_writer)
+        for entry in pipeline:
+            if entry.command is None:
+                self.client_writelines(entry.response)
+                continue
+            recorded: Optional[List[bytes]] = \
+                [] if entry.cache_key is not None else None
+            while await self.handle_agent_response({}, self.agent_reader,
+                                                   recorded):
+                pass
+            if recorded is not None:
+                assert entry.cache_key is not None
+                assert entry.keyring_state is not None
+                response_cache().put(entry.cache_key, entry.keyring_state,
+                                     recorded)
+        await self.client_drain()
 
     @staticmethod
     def verify_keygrip_arguments(min_count: int, max_count: int,
@@ -683,17 +1011,11 @@ class GpgServer:
         return b' '.join(untrusted_args_list)
 
     def sanitize_key_desc(self, untrusted_args: bytes) -> bytes:
-        untrusted_args = untrusted_args.replace(b'+', b' ')
-        untrusted_args = re.sub(
-            rb'%[0-9A-F]{2}',
-            lambda m: bytes([int(m.group(0)[1:].decode('ascii'), 16)]),
-            untrusted_args
-        )
-        allowed_ascii = list(range(0x20, 0x7e)) + [0x0a]
+        untrusted_args = codec.percent_unescape(
+            untrusted_args.replace(b'+', b' '))
         args = "Message from '{}':\n{}".format(
             self.client_domain,
-            ''.join((chr(c) if c in allowed_ascii else '.')
-                    for c in untrusted_args)
+            untrusted_args.translate(_key_desc_table).decode('ascii')
         )
         return args.replace('%', '%25').\
             replace('+', '%2B').\
@@ -759,12 +1081,14 @@ class GpgServer:
         # upper keygrip limit is arbitary
         args = self.verify_keygrip_arguments(1, 200, untrusted_args, True)
         unrestricted = args.startswith(b'--list') and not self.allow_keygen
-        await self.send_agent_command(b'HAVEKEY', args, unrestricted)
+        await self.send_agent_command(b'HAVEKEY', args, unrestricted,
+                                      cache=True)
 
     async def command_KEYINFO(self, untrusted_args: Optional[bytes]) -> None:
         args = self.verify_keygrip_arguments(1, 1, untrusted_args, True)
         unrestricted = args.startswith(b'--list') and not self.allow_keygen
-        await self.send_agent_command(b'KEYINFO', args, unrestricted)
+        await self.send_agent_command(b'KEYINFO', args, unrestricted,
+                                      cache=True)
 
     async def command_GENKEY(self, untrusted_args: Optional[bytes]) -> None:
         if not self.allow_keygen:
@@ -812,123 +1136,51 @@ class GpgServer:
         await self.send_agent_command(b'SETKEY', args)
         await self.setkeydesc(args)
 
+    @property
+    def keygrip_index(self) -> KeygripIndex:
+        return keygrip_index(
+            self.gnupghome or os.getenv('GNUPGHOME') or
+            os.path.expanduser('~/.gnupg'))
+
     async def setkeydesc(self, keygrip: bytes) -> None:
-        key: Union[KeyInfo, SubKeyInfo]
-        info = self.keygrip_map.get(keygrip)
-        if info is None:
-            self.update_keygrip_map()
-            info = self.keygrip_map.get(keygrip)
+        start = time.perf_counter()
+        info = await self.keygrip_index.lookup(keygrip)
+        if self.timing is not None:
+            self.timing.add('keyindex', start)
 
         if info is None:
             if not self.allow_keygen:
                 raise Filtered
             desc = b'Keygrip: ' + keygrip
         else:
-            if isinstance(info, SubKeyInfo):
-                key = info.key
-                subkey_desc = b'\nSubkey Fingerprint: %s' % info.fingerprint
+            if info.subkey_fingerprint is not None:
+                subkey_desc = b'\nSubkey Fingerprint: %s' % info.subkey_fingerprint
             else:
-                key = info
                 subkey_desc = b''
-            assert key is not None, 'no key?'
 
             desc = b'%s\nFingerprint: %s%s' % (
-                    (b'UID: ' + key.first_uid.split(b'\n')[0])
-                    if key.first_uid is not None
+                    (b'UID: ' + info.first_uid.split(b'\n')[0])
+                    if info.first_uid is not None
                     else b'',
-                    key.fingerprint,
+                    info.fingerprint,
                     subkey_desc)
 
         assert self.agent_writer is not None, "no writer?"
         self.agent_write(b'SETKEYDESC %s\n' % self.percent_plus_escape(desc), self.agent_writer)
 
         assert self.agent_reader is not None
+        start = time.perf_counter()
         untrusted_line = await self.agent_reader.readline()
+        if self.timing is not None:
+            self.timing.add('agent', start)
         untrusted_line = untrusted_line.rstrip(b'\n')
         self.log_io('A >>>', untrusted_line)
         if untrusted_line != b'OK':
             raise ProtocolError('SETKEYDESC failed')
 
-    @staticmethod
-    def estream_unescape(escaped: bytes) -> bytes:
-        """Undo es_write_sanitized()"""
-
-        char_map = { b'\\': b'\\',
-                     b'n': b'\n',
-                     b'r': b'\r',
-                     b'f': b'\f',
-                     b'v': b'\v',
-                     b'b': b'\b',
-                     b'0': b'\0'}
-        def map_back(match: re.Match[bytes]) -> bytes:
-            char = match.group(1)
-            if char in char_map:
-                return char_map[char]
-            return bytes([int(char[1:2], 16)])
-
-
-        return re.sub(rb'\\(\\|n|r|f|v|b|0|x[0-9a-f]{2})', map_back, escaped)
-
     @staticmethod
     def percent_plus_escape(to_escape: bytes) -> bytes:
-        unescaped_ascii = [
-            c for c in range(0x20, 0x7e)
-            if c not in list(b'+"% ')]
-        def esc(char: int) -> bytes:
-            if char in unescaped_ascii:
-                return bytes([char])
-            if char == ord(' '):
-                return b'+'
-            return b'%%%02x' % char
-        return b''.join(esc(c) for c in to_escape)
-
-    def update_keygrip_map(self) -> None:
-        out = subprocess.check_output([
-            'gpg', *self.homedir_opts(), '--list-secret-keys', '--with-colons'
-        ])
-        keys: List[KeyInfo] = []
-        primary_key: Optional[KeyInfo] = None
-        subkey: Optional[SubKeyInfo] = None
-        for line in out.split(b"\n"):
-            fields = line.split(b":")
-            if fields[0] in [b"sec", b"ssb", b""]:
-                if subkey is not None:
-                    assert primary_key is not None, 'bad output from GnuPG'
-                    subkey.key = primary_key
-                    primary_key.subkeys.append(subkey)
-                    subkey = None
-            if fields[0] in [b"sec", b""] and primary_key is not None:
-                keys.append(primary_key)
-            if fields[0] == b"sec":
-                primary_key = KeyInfo(fields[11])
-            elif fields[0] == b"ssb":
-                assert primary_key is not None, 'subkey before primary key?'
-                subkey = SubKeyInfo(fields[11], primary_key)
-            elif fields[0] == b"fpr":
-                assert primary_key is not None, 'bad output from GnuPG'
-                if subkey is None:
-                    primary_key.fingerprint = fields[9]
-                else:
-                    subkey.fingerprint = fields[9]
-            elif fields[0] == b"grp":
-                assert primary_key is not None, 'bad output from GnuPG'
-                if subkey is None:
-                    primary_key.keygrip = fields[9]
-                else:
-                    subkey.keygrip = fields[9]
-            elif fields[0] == b"uid":
-                assert primary_key is not None, 'uid before primary key?'
-                if primary_key.first_uid is None:
-                    primary_key.first_uid = self.estream_unescape(fields[9])
-
-        new_keygrip_map: Dict[bytes, Union[KeyInfo, SubKeyInfo]] = {}
-        for key in keys:
-            assert key.keygrip is not None, 'no keygrip'
-            new_keygrip_map[key.keygrip] = key
-            for subkey in key.subkeys:
-                assert subkey.keygrip is not None, 'no subkey keygrip'
-                new_keygrip_map[subkey.keygrip] = subkey
-        self.keygrip_map = new_keygrip_map
+        return codec.percent_plus_escape(to_escape)
 
     async def command_SETKEYDESC(self, untrusted_args: Optional[bytes]) -> None:
         # Fake a positive respose. We always send a SETKEYDESC after
@@ -944,7 +1196,7 @@ class GpgServer:
     async def command_PKDECRYPT(self, untrusted_args: Optional[bytes]) -> None:
         if untrusted_args is not None:
             raise Filtered
-        self.request_timer('PKDECRYPT')
+        await self.request_timer('PKDECRYPT')
         await self.send_agent_command(b'PKDECRYPT', None)
 
     async def command_SETHASH(self, untrusted_args: Optional[bytes]) -> None:
@@ -980,7 +1232,7 @@ class GpgServer:
                 raise Filtered
         args = untrusted_args
 
-        self.request_timer('PKSIGN')
+        await self.request_timer('PKSIGN')
 
         # String checked to be '-- ' followed by a cache nonce
         await self.send_agent_command(b'PKSIGN', args)
@@ -991,7 +1243,7 @@ class GpgServer:
             raise Filtered
         args = untrusted_args
 
-        await self.send_agent_command(b'GETINFO', args)
+        await self.send_agent_command(b'GETINFO', args, cache=True)
 
     async def command_BYE(self, untrusted_args: Optional[bytes]) -> None:
         if untrusted_args is not None:
@@ -1038,34 +1290,110 @@ class GpgServer:
         return {}
 
     async def send_agent_command(self, command: bytes, args: Optional[bytes],
-                                 unrestricted: bool=False) -> None:
-        """ Sends command to local gpg agent and handle the response """
+                                 unrestricted: bool=False,
+                                 cache: bool=False) -> None:
+        """ Sends command to local gpg agent and handle the response
+
+        With *cache*, the response may be served from (and is stored in)
+        the response cache - only for read-only queries.
+        """
         expected_inquires = self.get_inquires_for_command(command)
         assert self.agent_reader is not None, "no reader?"
         assert self.agent_writer is not None, "no writer?"
-        if unrestricted and not self.allow_keygen:
-            reader, writer = await asyncio.open_unix_connection(
-                    self.agent_unrestricted_socket_path)
-            await self.read_hello(reader)
+        cmd_with_args = self.agent_command_line(command, args)
+        pooled = unrestricted and not self.allow_keygen
+        cache_key: Optional[CacheKey] = None
+        keyring_state: Optional[KeyringState] = None
+        if cache:
+            cache_key, keyring_state = \
+                self.response_cache_key(command, args, pooled)
+            if await self.respond_from_cache(cache_key, keyring_state):
+                return
+        if command in PIPELINED_COMMANDS and not expected_inquires and \
+                not pooled and self.client_lines.pending:
+            # more commands are waiting already, send them all together
+            self.pipeline.append(PipelinedCommand(
+                cmd_with_args, (), cache_key, keyring_state))
+            return
+        await self.flush_pipeline()
+        recorded: Optional[List[bytes]] = [] if cache else None
+        if pooled:
+            await self.send_pooled_agent_command(
+                cmd_with_args, expected_inquires, recorded)
         else:
-            reader, writer = self.agent_reader, self.agent_writer
+            await self.exchange_agent_command(
+                cmd_with_args, expected_inquires, self.agent_reader,
+                self.agent_writer, recorded)
+        if recorded is not None:
+            assert cache_key is not None and keyring_state is not None
+            response_cache().put(cache_key, keyring_state, recorded)
+
+    def agent_command_line(self, command: bytes,
+                           args: Optional[bytes]) -> bytes:
+        if args:
+            if not self.command_argument_regex.match(args):
+                raise AssertionError("BUG: corrupt command about to be sent to agent!")
+            return command + b' ' + args + b'\n'
+        return command + b'\n'
+
+    def response_cache_key(self, command: bytes, args: Optional[bytes],
+                           pooled: bool) -> Tuple[CacheKey, KeyringState]:
+        socket_path = self.agent_unrestricted_socket_path \
+            if pooled else self.agent_socket_path
+        assert socket_path is not None
+        return (socket_path, command, args), \
+            self.keygrip_index.current_state()
+
+    async def respond_from_cache(self, cache_key: CacheKey,
+                                 keyring_state: KeyringState) -> bool:
+        """Send the cached response, if there is one - return whether it
+        was sent"""
+        assert self.agent_reader is not None
+        cached = response_cache().get(cache_key, keyring_state)
+        # don't hide the agent going away
+        if cached is None or self.agent_reader.at_eof():
+            return False
+        self.respond(cached)
+        await self.client_drain()
+        return True
+
+    async def send_pooled_agent_command(
+            self, cmd_with_args: bytes,
+            expected_inquires: Dict[bytes, 'ArgCallback'],
+            recorded: Optional[List[bytes]]) -> None:
+        """Send a command over a pooled unrestricted agent connection"""
+        assert self.agent_unrestricted_socket_path is not None
+        # the pool outlives this connection, don't let it keep the server
+        pool = agent_pool(self.agent_unrestricted_socket_path,
+                          GpgServer.read_hello)
+        start = time.perf_counter()
+        pool_conn = await pool.acquire()
+        if self.timing is not None:
+            self.timing.add('agent', start)
         try:
-            if args:
-                if not self.command_argument_regex.match(args):
-                    raise AssertionError("BUG: corrupt command about to be sent to agent!")
-                cmd_with_args = command + b' ' + args + b'\n'
-            else:
-                cmd_with_args = command + b'\n'
-            self.agent_write(cmd_with_args, writer)
-            while True:
-                more_expected = await self.handle_agent_response(expected_inquires, reader)
-                if not more_expected:
-                    break
-        finally:
-            if reader is not self.agent_reader:
-                writer.close()
+            await self.exchange_agent_command(
+                cmd_with_args, expected_inquires, pool_conn.reader,
+                pool_conn.writer, recorded)
+        except BaseException:
+            pool.discard(pool_conn)
+            raise
+        pool.release(pool_conn)
+
+    async def exchange_agent_command(
+            self, cmd_with_args: bytes,
+            expected_inquires: Dict[bytes, 'ArgCallback'],
+            reader: AssuanLineReader, writer: asyncio.StreamWriter,
+            recorded: Optional[List[bytes]]) -> None:
+        """Send a command and handle the whole response"""
+        self.agent_write(cmd_with_args, writer)
+        while True:
+            more_expected = await self.handle_agent_response(
+                expected_inquires, reader, recorded)
+            if not more_expected:
+                break
 
-    async def read_hello(self, agent_reader: asyncio.StreamReader) -> bytes:
+    @staticmethod
+    async def read_hello(agent_reader: AssuanLineReader) -> bytes:
         while True:
             line = await agent_reader.readline()
             if not line.endswith(b'\n'):
@@ -1086,32 +1414,65 @@ class GpgServer:
 
     async def handle_agent_response(self,
                                     expected_inquires: Dict[bytes, 'ArgCallback'],
-                                    agent_reader: asyncio.StreamReader) -> bool:
-        """ Receive and handle one agent response. Return whether there are
-        more expected """
+                                    agent_reader: AssuanLineReader,
+                                    recorded: Optional[List[bytes]] = None) -> bool:
+        """ Receive and handle agent response lines, as many as are available
+        - a run of D/S lines is passed to the client in one go. Return whether
+        there are more expected. Lines passed to the client are appended to
+        *recorded*, if given. """
         assert self.client_writer is not None
         if self.client_writer.is_closing():
             # If something went wrong, agent might send back junk.
             # Discard all remaining data from agent and return.
-            while await agent_reader.read(1024):
-                pass
+            await agent_reader.discard()
             return False
         # We generally consider the agent as trusted. But since the client can
         # determine part of the response we handle this here as untrusted.
-        untrusted_line = await agent_reader.readline()
-        untrusted_line = untrusted_line.rstrip(b'\n')
-        self.log_io('A >>>', untrusted_line)
-        if untrusted_line.startswith(b'#'):
-            # Comment, ignore
-            return True
+        start = time.perf_counter()
+        untrusted_lines = await agent_reader.read_lines() or [b'']
+        if self.timing is not None:
+            self.timing.add('agent', start)
+        relay: List[bytes] = []
+        for i, untrusted_line in enumerate(untrusted_lines):
+            self.log_io('A >>>', untrusted_line)
+            if untrusted_line.startswith(b'#'):
+                # Comment, ignore
+                continue
+            if untrusted_line[:2] in (b'D ', b'S ') or \
+                    untrusted_line in (b'D', b'S'):
+                # passthrough to the client
+                relay.append(untrusted_line + b'\n')
+                continue
+            # end of the run - leave the rest for later
+            agent_reader.unread(untrusted_lines[i + 1:])
+            await self.relay_to_client(relay, recorded)
+            return await self.handle_agent_final_response(
+                expected_inquires, untrusted_line, recorded)
+        await self.relay_to_client(relay, recorded)
+        return True
+
+    async def relay_to_client(self, lines: List[bytes],
+                              recorded: Optional[List[bytes]]) -> None:
+        if not lines:
+            return
+        self.client_writelines(lines)
+        if recorded is not None:
+            recorded.extend(lines)
+        # don't read more from the agent than the client can take
+        await self.client_drain()
+
+    async def handle_agent_final_response(
+            self, expected_inquires: Dict[bytes, 'ArgCallback'],
+            untrusted_line: bytes, recorded: Optional[List[bytes]]) -> bool:
+        """Handle a response line other than D/S, see
+        :py:meth:`handle_agent_response`"""
         untrusted_res, untrusted_args = extract_args(untrusted_line)
-        if untrusted_res in (b'D', b'S'):
-            # passthrough to the client
-            self.client_write(untrusted_line + b'\n')
-            return True
         if untrusted_res in (b'OK', b'ERR'):
             # passthrough to the client and signal command complete
             self.client_write(untrusted_line + b'\n')
+            if recorded is not None:
+                recorded.append(untrusted_line + b'\n')
+            await self.client_drain()
             return False
         if untrusted_res == b'INQUIRE':
             if not untrusted_args:
@@ -1265,109 +1626,68 @@ class GpgServer:
                                       untrusted_args=untrusted_args)
 
     def inquire_command_D_KEYGEN(self, *, untrusted_args: bytes) -> Coroutine[object, object, bool]:
-        def validate_bits_len(untrusted_sexp: 'SExpr') -> None:
-            untrusted_bits = self.check_letter_bytes(b'nbits', untrusted_sexp)
-            sanitize_int(untrusted_bits, 1024, 4096)
-
-        def check_curve_flags(untrusted_curve: bytes, untrusted_flags: List['SExpr']) -> None:
-            if untrusted_flags == [b'nocomp']:
-                # Always allowed
-                return
-            if untrusted_curve in known_eddsa_curves:
-                allowed_flags = (b'eddsa', b'comp')
-            elif untrusted_curve in known_safeecdh_curves:
-                allowed_flags = (b'comp', b'djb-tweak')
-            elif untrusted_curve in known_other_curves:
-                raise ValueError('Invalid flags for non-Edwards curve')
-            else:
-                raise ValueError('Unknown elliptic curve')
-            if len(untrusted_flags) > 2:
-                raise ValueError('Too many flags for Edwards curve')
-            if b'comp' not in untrusted_flags:
-                raise ValueError('Edwards curve keys must be compressed')
-            for untrusted_flag in untrusted_flags:
-                if untrusted_flag not in allowed_flags:
-                    raise ValueError('Forbidden flag sent')
-
-        def validate_keygen_sexp(*, untrusted_sexp: 'SExpr') -> None:
-            """
-            Check that the ``untrusted_sexp`` is a valid set of key generation
-            parameters.
-            """
-            untrusted_sexp = self.check_letter_list(b'genkey', untrusted_sexp)
-            if len(untrusted_sexp) < 2:
-                raise ValueError('No key parameters')
-            untrusted_alg = untrusted_sexp[0]
-            if untrusted_alg == b'ecc':
-                if len(untrusted_sexp) != 3:
-                    raise ValueError('invalid elliptic curve parameters')
-                untrusted_curve = self.check_letter_bytes(b'curve', untrusted_sexp[1])
-                untrusted_flags = untrusted_sexp[2]
-                if not isinstance(untrusted_flags, list):
-                    raise ValueError('Flags must be a list')
-                if len(untrusted_flags) < 2 or untrusted_flags[0] != b'flags':
-                    raise ValueError(
-                            "Key generation flags must begin with b'flags'")
-                check_curve_flags(untrusted_curve, untrusted_flags[1:])
-            elif untrusted_alg in (b'rsa', b'openpgp-elg'):
-                if len(untrusted_sexp) != 2:
-                    raise ValueError('invalid ElGamel or RSA parameters')
-                validate_bits_len(untrusted_sexp[1])
-            elif untrusted_alg == b'dsa':
-                if (len(untrusted_sexp) != 3 or
-                    untrusted_sexp[2] != [b'qbits', b'256']):
-                    raise ValueError('invalid DSA parameters')
-                validate_bits_len(untrusted_sexp[1])
-            else:
-                raise ValueError('refusing to generate key with unknown algorithm')
-
+        # pylint: disable=import-outside-toplevel
+        from .keygen import validate_keygen_sexp
         return self.inquire_command_D(validate_keygen_sexp,
                                       untrusted_args=untrusted_args)
 
     async def inquire_command_D(self, validate_sexp: 'SExprValidator', *,
                                 untrusted_args: bytes) -> bool:
-        # We parse and then reserialize the sexpr. Currently we assume that the
-        # sexpr fits in one assuan line. This line length also implicitly
-        # limits the sexpr sizes.
+        # We parse and then reserialize the sexpr. It may span several D
+        # lines, it is parsed as they arrive and sent to the agent as soon as
+        # it is complete (and valid). Anything after it is rejected at END at
+        # the latest. The limit on the number of lines implicitly limits the
+        # sexpr sizes.
 
-        if self.seen_data:
+        if self.inquire_data_lines >= MAX_INQUIRE_DATA_LINES:
             raise Filtered
+        self.inquire_data_lines += 1
+        if self.inquire_data is None:
+            self.inquire_data = SExprParser(
+                MAX_INQUIRE_DATA_LINES * ASSUAN_LINELENGTH)
         try:
-            untrusted_sexp = self.parse_sexpr(self.unescape_D(untrusted_args))
+            self.inquire_data.feed(self.unescape_D(untrusted_args))
+            if self.inquire_data_sent or not self.inquire_data.complete:
+                return True
+            untrusted_sexp = self.inquire_data.current[0]
             validate_sexp(untrusted_sexp=untrusted_sexp)
         except ValueError as e:
             raise Filtered from e
         args = untrusted_sexp
 
         assert self.agent_writer is not None, "no writer?"
-        self.agent_write(b'D ' + self.escape_D(self.serialize_sexpr(args)) + b'\n',
+        self.agent_write(b''.join(self.escape_D_lines(self.serialize_sexpr(args))),
                          self.agent_writer)
-        self.seen_data = True
+        self.inquire_data_sent = True
         return True
 
     @staticmethod
     def unescape_D(untrusted_arg: bytes) -> bytes:
-        return re.sub(
-            rb'%[0-9A-F]{2}',
-            lambda m: bytes([int(m.group(0)[1:], 16)]),
-            untrusted_arg
-        )
+        return codec.percent_unescape(untrusted_arg)
+
+    @classmethod
+    def escape_D_lines(cls, data: bytes) -> List[bytes]:
+        """Escape *data* and split it into D lines fitting the line length"""
+        escaped = cls.escape_D(data)
+        # 'D ' and the newline
+        max_len = ASSUAN_LINELENGTH - 4
+        lines = []
+        pos = 0
+        while pos < len(escaped):
+            cut = min(pos + max_len, len(escaped))
+            # don't split an escape sequence
+            percent = escaped.rfind(b'%', max(pos, cut - 2), cut)
+            if percent != -1 and cut < len(escaped):
+                cut = percent
+            lines.append(b'D ' + escaped[pos:cut] + b'\n')
+            pos = cut
+        return lines
 
     @staticmethod
     def escape_D(data: bytes) -> bytes:
-        # Like gpg we only escape those chars that are really necessary. Since
-        # the data normally contains binary data it's likely that gpg-agent's
-        # parser works fine with strange chars, so it doesn't makes much sense
-        # to be more protective here.
-        return data.replace(b'%', b'%25').\
-                    replace(b'\r', b'%0d').\
-                    replace(b'\n', b'%0a')
+        return codec.escape_D(data)
 
 
-    # This parser is only good enough to parse the sexpr gpg generates. It does
-    # *not* implement http://people.csail.mit.edu/rivest/Sexp.txt fully. Since
-    # we send the reserialized form this should be safe.
-
     @classmethod
     def parse_sexpr(cls, untrusted_arg: bytes) -> 'SExpr':
         # pylint: disable=unidiomatic-typecheck
@@ -1375,51 +1695,9 @@ class GpgServer:
             raise TypeError("invalid type in parse_sexpr")
         if len(untrusted_arg) == 0:
             raise ValueError("no sexpr")
-        sexpr, rest = cls._parse_sexpr(untrusted_arg, 0)
-        if len(rest) != 0:
-            raise ValueError("garbage at end of sexpr")
-        if len(sexpr) != 1:
-            raise ValueError("sexpr top level shold have exactly one element")
-        if not isinstance(sexpr[0], list):
-            # We assume this in serialize_sexpr and at least for gpg this seems
-            # to be true.
-            raise ValueError("sexpr top level shold be a list")
-        return sexpr[0]
-
-    @classmethod
-    def _parse_sexpr(cls, untrusted_arg: bytes, nesting: int) -> Tuple[List['SExpr'], bytes]:
-        if not untrusted_arg:
-            if nesting > 0:
-                raise ValueError("missing closing parenthesis")
-            return ([], b'')
-        if untrusted_arg[0] == ord(')'):
-            if nesting == 0:
-                return ([], untrusted_arg)
-            if nesting > 20:
-                # This limit is arbitrary. The motivation is to avoid problems
-                # if gpg-agent would recurse too much based on sexpr nesting
-                # **and** would jump the guard page (for example through a big
-                # stack allocation). This is borderline too paranoid, but for
-                # now we accepted it.
-                raise ValueError("sexpr has too big nesting depth")
-            return ([], untrusted_arg[1:].lstrip(b' '))
-
-        rest: bytes
-        value: Union[List['SExpr'], bytes]
-        if 0x30 <= untrusted_arg[0] <= 0x40:
-            length_s, rest = untrusted_arg.split(b':', 1)
-            length = sanitize_int(length_s, 1, len(rest))
-            value, rest = rest[0:length], rest[length:]
-        elif untrusted_arg[0] == ord('('):
-            value, rest = cls._parse_sexpr(untrusted_arg[1:], nesting + 1)
-        else:
-            match = re.match(rb'\A([0-9a-zA-Z-_]+) ?(.*)\Z', untrusted_arg)
-            if match is None:
-                raise ValueError("Invalid literal")
-            value, rest = match.group(1), match.group(2)
-
-        rest_parsed, new_rest = cls._parse_sexpr(rest, nesting)
-        return ([value] + rest_parsed, new_rest)
+        parser = SExprParser()
+        parser.feed(untrusted_arg)
+        return parser.finish()
 
     @classmethod
     def serialize_sexpr(cls, sexpr: 'SExpr') -> bytes:
@@ -1439,6 +1717,13 @@ class GpgServer:
     async def inquire_command_END(self, *, untrusted_args: bytes) -> bool:
         if untrusted_args:
             raise Filtered('unexpected arguments to END')
+        if self.inquire_data is not None:
+            try:
+                self.inquire_data.finish()
+            except ValueError as e:
+                raise Filtered from e
+            if not self.inquire_data_sent:
+                raise Filtered
         assert self.agent_writer is not None, "no writer?"
         self.agent_write(b'END\n', self.agent_writer)
         return False
@@ -1446,68 +1731,86 @@ class GpgServer:
     # endregion
 
 
-TIMER_NAMES = (
-    'PKSIGN',
-    'PKDECRYPT',
-)
+def runtime_dir() -> str:
+    return os.environ.get('XDG_RUNTIME_DIR') or \
+        '/run/user/{}'.format(os.getuid())
 
-def open_stdinout_connection(*,
-    loop: Optional[asyncio.AbstractEventLoop]=None) -> \
+
+_agent_socket_cache: Optional[AgentSocketCache] = None
+
+
+def agent_socket_cache() -> AgentSocketCache:
+    """Agent socket cache shared by all connections of this process"""
+    # pylint: disable=global-statement
+    global _agent_socket_cache
+    if _agent_socket_cache is None:
+        cache_dir = runtime_dir()
+        _agent_socket_cache = AgentSocketCache(
+            os.path.join(cache_dir, 'split-gpg2', 'agent-sockets.json')
+            if os.path.isdir(cache_dir) else None)
+    return _agent_socket_cache
+
+async def open_pipe_connection(read_pipe: Any, write_pipe: Any) -> \
     Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
-    if loop is None:
-        loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
 
     reader = asyncio.StreamReader(loop=loop)
-    loop.run_until_complete(loop.connect_read_pipe(
+    await loop.connect_read_pipe(
         lambda: asyncio.StreamReaderProtocol(reader, loop=loop),
-        sys.stdin.buffer))
+        read_pipe)
 
-    write_transport, write_protocol = loop.run_until_complete(
-            loop.connect_write_pipe(
-                lambda: StdoutWriterProtocol(loop),
-                sys.stdout.buffer))
+    write_transport, write_protocol = await loop.connect_write_pipe(
+            lambda: StdoutWriterProtocol(loop),
+            write_pipe)
+    write_transport.set_write_buffer_limits(CLIENT_WRITE_HIGH_WATER,
+                                            CLIENT_WRITE_LOW_WATER)
     writer = asyncio.StreamWriter(write_transport, write_protocol, None, loop)
 
     return reader, writer
 
 
-def load_config_files(client_domain: str) -> configparser.SectionProxy:
-    config_dir_basename = 'qubes-split-gpg2'
-    config_basename = 'qubes-split-gpg2.conf'
-    config_dir_system = os.path.join('/etc/', config_basename)
-    ## Using the xdg module makes it difficult to mode xdg_config_home.
-    xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or \
-            os.path.join(os.path.expanduser('~'), '.config')
-    config_dir_user = xdg_config_home + '/' + config_dir_basename
-    config = configparser.ConfigParser()
-    config_list = []
-    config_list.append(config_dir_system)
-    config_extra_list = sorted(glob.glob(config_dir_user + '/conf.d/*.conf'))
-    for extra_config_file in config_extra_list:
-        config_list.append(extra_config_file)
-    config_list.append(config_dir_user + '/' + config_basename)
-    config.read(config_list)
-    section = 'client:' + client_domain
-    # 'DEFAULTS' section is special, values there serve as defaults
-    # for other sections
-    if config.has_section(section):
-        return config[section]
-    return config['DEFAULT']
+def open_stdinout_connection(*,
+    loop: Optional[asyncio.AbstractEventLoop]=None) -> \
+    Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    return loop.run_until_complete(open_pipe_connection(
+        sys.stdin.buffer, sys.stdout.buffer))
+
+
+_config_snapshots: Optional[ConfigSnapshots] = None
+
+
+def config_snapshots() -> ConfigSnapshots:
+    """Compiled config snapshots shared by all connections of this process"""
+    # pylint: disable=global-statement
+    global _config_snapshots
+    if _config_snapshots is None:
+        cache_dir = runtime_dir()
+        _config_snapshots = ConfigSnapshots(
+            os.path.join(cache_dir, 'split-gpg2')
+            if os.path.isdir(cache_dir) else None)
+    return _config_snapshots
 
 
 def main() -> None:
     os.umask(0o0077)
     client_domain = os.environ['QREXEC_REMOTE_DOMAIN']
-    config = load_config_files(client_domain)
+    try:
+        config = config_snapshots().load(client_domain)
+    except ValueError:
+        print("Error in a config file, aborting", file=sys.stderr)
+        sys.exit(2)
 
     asyncio.set_event_loop(asyncio.new_event_loop())
     loop = asyncio.get_event_loop()
     reader, writer = open_stdinout_connection(loop=loop)
     server = GpgServer(reader, writer, client_domain,
-        debug_log=config.get('debug_log'))
+        debug_log=config.debug_log)
 
     try:
-        server.load_config(config)
+        server.apply_config(config)
     except ValueError:
         print("Error in a config file, aborting", file=sys.stderr)
         sys.exit(2)
@@ -1515,3 +1818,19 @@ def main() -> None:
     connection_terminated = loop.create_future()
     server.notify_on_disconnect.add(connection_terminated)
     loop.run_until_complete(server.run())
+    loop.run_until_complete(notifier().flush(NOTIFY_FLUSH_TIMEOUT))
+    loop.run_until_complete(notifier().close())
+    # nothing to write back if these were never needed
+    autoaccept = sys.modules.get(__name__ + '.autoaccept')
+    if autoaccept is not None:
+        loop.run_until_complete(autoaccept.autoaccept_store().flush())
+    keyringsync = sys.modules.get(__name__ + '.keyringsync')
+    if keyringsync is not None:
+        loop.run_until_complete(keyringsync.flush_keyring_syncs())
+    metrics = sys.modules.get(__name__ + '.metrics')
+    if metrics is not None:
+        metrics.flush_metrics()
+    trace = sys.modules.get(__name__ + '.trace')
+    if trace is not None:
+        trace.close_tracers()
+    close_agent_pools()
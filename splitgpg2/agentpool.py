@@ -0,0 +1,186 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Pool of connections to the unrestricted agent socket.
+
+Some commands (HAVEKEY/KEYINFO --list) need the unrestricted agent socket
+even if the client is otherwise connected to the restricted one. Instead of
+connecting (and waiting for the agent greeting) for each of them, already
+established connections are kept around. A connection is RESET after each
+use (in the background, not delaying the command), and idle ones are closed
+after :py:data:`IDLE_TIMEOUT` seconds.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from .assuan import AssuanLineReader
+
+MAX_IDLE = 4
+IDLE_TIMEOUT = 30.0
+
+Handshake = Callable[[AssuanLineReader], Awaitable[bytes]]
+
+
+class PooledConnection:
+    __slots__ = ('reader', 'writer', 'last_used')
+
+    def __init__(self, reader: AssuanLineReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.last_used = 0.0
+
+    def healthy(self) -> bool:
+        # the agent closes the connection when it exits, which is noticed
+        # as soon as the event loop sees the EOF
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AgentConnectionPool:
+    # settings, the connections and their housekeeping
+    # pylint: disable=too-many-instance-attributes
+    idle: List[PooledConnection]
+    resetting: Set['asyncio.Task[None]']
+    evict_handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self, socket_path: str, handshake: Handshake,
+                 max_idle: int = MAX_IDLE,
+                 idle_timeout: float = IDLE_TIMEOUT) -> None:
+        self.socket_path = socket_path
+        #: reads the agent greeting on a new connection
+        self.handshake = handshake
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.resetting = set()
+        self.evict_handle = None
+        self.log = logging.getLogger('splitgpg2.AgentConnectionPool')
+
+    async def acquire(self) -> PooledConnection:
+        """Get a connection, ready for a command"""
+        now = asyncio.get_running_loop().time()
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.healthy() and now - conn.last_used < self.idle_timeout:
+                return conn
+            conn.close()
+        stream_reader, writer = await asyncio.open_unix_connection(
+            self.socket_path)
+        reader = AssuanLineReader(stream_reader)
+        try:
+            await self.handshake(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return PooledConnection(reader, writer)
+
+    def release(self, conn: PooledConnection) -> None:
+        """Give back a connection, after a successfully completed command"""
+        task = asyncio.ensure_future(self.reset(conn))
+        self.resetting.add(task)
+        task.add_done_callback(self.resetting.discard)
+
+    @staticmethod
+    def discard(conn: PooledConnection) -> None:
+        """Give back a connection in an unknown state"""
+        conn.close()
+
+    async def reset(self, conn: PooledConnection) -> None:
+        try:
+            conn.writer.write(b'RESET\n')
+            while True:
+                line = await asyncio.wait_for(conn.reader.readline(),
+                                              self.idle_timeout)
+                if line == b'OK\n' or line.startswith(b'OK '):
+                    break
+                if not line.endswith(b'\n') or not (
+                        line.startswith(b'#') or line.startswith(b'S ')):
+                    raise ConnectionError(
+                        'unexpected RESET response {!r}'.format(line))
+        except (OSError, asyncio.TimeoutError) as e:
+            self.log.info('Dropping agent connection: %s', e)
+            conn.close()
+            return
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+        if len(self.idle) >= self.max_idle:
+            conn.close()
+            return
+        loop = asyncio.get_running_loop()
+        conn.last_used = loop.time()
+        self.idle.append(conn)
+        if self.evict_handle is None:
+            self.evict_handle = loop.call_later(self.idle_timeout, self.evict)
+
+    def evict(self) -> None:
+        """Close connections idle for too long"""
+        loop = asyncio.get_running_loop()
+        self.evict_handle = None
+        now = loop.time()
+        keep = []
+        for conn in self.idle:
+            if conn.healthy() and now - conn.last_used < self.idle_timeout:
+                keep.append(conn)
+            else:
+                conn.close()
+        self.idle = keep
+        if self.idle:
+            oldest = min(conn.last_used for conn in self.idle)
+            self.evict_handle = loop.call_at(oldest + self.idle_timeout,
+                                             self.evict)
+
+    def close(self) -> None:
+        if self.evict_handle is not None:
+            self.evict_handle.cancel()
+            self.evict_handle = None
+        for task in self.resetting:
+            task.cancel()
+        for conn in self.idle:
+            conn.close()
+        self.idle = []
+
+
+_pools: Dict[Tuple[asyncio.AbstractEventLoop, str], AgentConnectionPool] = {}
+
+
+def agent_pool(socket_path: str, handshake: Handshake) -> AgentConnectionPool:
+    """Connection pool for *socket_path*, shared by all connections"""
+    key = (asyncio.get_running_loop(), socket_path)
+    try:
+        return _pools[key]
+    except KeyError:
+        # connections are bound to the event loop
+        for other_key in [k for k in _pools if k[0].is_closed()]:
+            del _pools[other_key]
+        pool = _pools[key] = AgentConnectionPool(socket_path, handshake)
+        return pool
+
+
+def close_agent_pools() -> None:
+    for (loop, _), pool in _pools.items():
+        if not loop.is_closed():
+            pool.close()
+    _pools.clear()
@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Cache of gpg-agent socket paths, so connecting to the agent doesn't need
+to call gpgconf each time.
+
+The cache is keyed by GnuPG home directory and stored on disk, to be shared
+by all server processes. An entry is valid only as long as the socket it was
+recorded for exists - if the agent is restarted, or the socket is removed,
+the entry is ignored and the socket paths are looked up again.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import json
+import os
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class AgentSockets(NamedTuple):
+    #: 'agent-socket' - the unrestricted one
+    socket: str
+    #: 'agent-extra-socket' - the restricted one
+    extra_socket: str
+
+
+class AgentSocketCache:
+    entries: Dict[str, Tuple[AgentSockets, Tuple[int, int, int]]]
+    path: Optional[str]
+    file_mtime: Optional[int]
+
+    def __init__(self, path: Optional[str]) -> None:
+        #: file to persist the cache to, ``None`` to keep it in memory only
+        self.path = path
+        self.entries = {}
+        self.file_mtime = None
+
+    @staticmethod
+    def socket_id(socket_path: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(socket_path)
+        except OSError:
+            return None
+        # inode numbers get reused, include creation time too
+        return (stat.st_dev, stat.st_ino, stat.st_ctime_ns)
+
+    def load(self) -> None:
+        """(Re)load the cache file, if it was changed by another process."""
+        if self.path is None:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.file_mtime:
+            return
+        try:
+            with open(self.path, encoding='utf-8') as cache_file:
+                data = json.load(cache_file)
+            self.entries = {
+                gnupghome: (AgentSockets(*sockets),
+                            (sock_id[0], sock_id[1], sock_id[2]))
+                for gnupghome, (sockets, sock_id) in data.items()}
+        except (OSError, ValueError, TypeError):
+            # just a cache, start from scratch
+            self.entries = {}
+        self.file_mtime = mtime
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        # don't let entries for gone (for example temporary) GnuPG homes
+        # accumulate
+        self.entries = {
+            gnupghome: (sockets, sock_id)
+            for gnupghome, (sockets, sock_id) in self.entries.items()
+            if self.socket_id(sockets.socket) == sock_id}
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), 0o700, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(tmp_path, self.path)
+            self.file_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            # not fatal, the cache works in memory anyway
+            pass
+
+    def get(self, gnupghome: str) -> Optional[AgentSockets]:
+        self.load()
+        try:
+            sockets, sock_id = self.entries[gnupghome]
+        except KeyError:
+            return None
+        if self.socket_id(sockets.socket) != sock_id:
+            # agent restarted or gone
+            return None
+        return sockets
+
+    def put(self, gnupghome: str, sockets: AgentSockets) -> None:
+        sock_id = self.socket_id(sockets.socket)
+        if sock_id is None:
+            return
+        # pick up entries added by other processes
+        self.load()
+        if self.entries.get(gnupghome) == (sockets, sock_id):
+            return
+        self.entries[gnupghome] = (sockets, sock_id)
+        self.save()
+
+    def invalidate(self, gnupghome: str) -> None:
+        self.load()
+        if self.entries.pop(gnupghome, None) is not None:
+            self.save()
@@ -0,0 +1,106 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Reading Assuan lines in bulk.
+
+Responses of gpg-agent can be long runs of D/S lines. Instead of awaiting
+each line separately, :py:class:`AssuanLineReader` reads whatever is
+available (up to :py:data:`READ_CHUNK_SIZE`) and splits it into lines in one
+go. Lines the caller isn't interested in yet can be put back with
+:py:meth:`AssuanLineReader.unread`.
+"""
+
+import asyncio
+from typing import List, Sequence
+
+READ_CHUNK_SIZE = 16 * 1024
+
+# way more than ASSUAN_LINELENGTH, same as asyncio.StreamReader
+LINE_LIMIT = 64 * 1024
+
+
+class AssuanLineReader:
+    """Line reader on top of :py:class:`asyncio.StreamReader`
+
+    Once wrapped, the stream must not be read directly anymore - this
+    buffers data read from it."""
+    pending: List[bytes]
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 chunk_size: int = READ_CHUNK_SIZE) -> None:
+        self.reader = reader
+        self.chunk_size = chunk_size
+        #: complete lines, without the newline
+        self.pending = []
+        #: start of an incomplete line
+        self.partial = bytearray()
+        #: the last line in :py:attr:`pending` is incomplete (at EOF)
+        self.truncated = False
+
+    def at_eof(self) -> bool:
+        return not self.pending and not self.partial and self.reader.at_eof()
+
+    async def read_lines(self) -> List[bytes]:
+        """Return all complete lines available, at least one - without
+        the newline. At EOF, return the incomplete line left, if any, and
+        then an empty list."""
+        while not self.pending:
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                if not self.partial:
+                    return []
+                self.pending.append(bytes(self.partial))
+                self.partial.clear()
+                self.truncated = True
+                break
+            if b'\n' in data:
+                lines = data.split(b'\n')
+                if self.partial:
+                    lines[0] = bytes(self.partial) + lines[0]
+                    self.partial.clear()
+                self.partial += lines.pop()
+                self.pending = lines
+            else:
+                self.partial += data
+            if len(self.partial) > LINE_LIMIT:
+                raise ValueError('line too long')
+        lines, self.pending = self.pending, []
+        return lines
+
+    def unread(self, lines: Sequence[bytes]) -> None:
+        """Put back *lines* (as returned by :py:meth:`read_lines`), to be
+        returned again first"""
+        self.pending[0:0] = lines
+
+    async def readline(self) -> bytes:
+        """Like :py:meth:`asyncio.StreamReader.readline`: one line, with the
+        newline, or without it if the connection is closed before"""
+        lines = await self.read_lines()
+        if not lines:
+            return b''
+        self.unread(lines[1:])
+        if self.truncated and not self.pending:
+            return lines[0]
+        return lines[0] + b'\n'
+
+    async def discard(self) -> None:
+        """Drop everything until EOF"""
+        self.pending = []
+        self.partial.clear()
+        while await self.reader.read(self.chunk_size):
+            pass
@@ -0,0 +1,203 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Autoaccept state - when the user last allowed a qube to use given command.
+
+On disk the state is kept the same way as before, as timestamp files next to
+the agent socket (``<agent_socket>_split-gpg2-timestamp_<name>_<domain>``),
+so approvals survive restarts.  Changes are written back in the background,
+until then they are served from memory (shared by all connections of the
+server daemon).  Otherwise the files are checked on each use, so removing one
+by hand revokes the approval right away.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+TIMESTAMP_MARKER = '_split-gpg2-timestamp_'
+
+_timestamp_file_re = re.compile(
+    r'\A(?P<socket>.+)' + TIMESTAMP_MARKER +
+    r'(?P<name>[A-Z]+)_(?P<domain>[A-Za-z0-9_.-]+)\Z')
+
+
+class Grant(NamedTuple):
+    agent_socket_path: str
+    #: command name, like 'PKSIGN'
+    name: str
+    client_domain: str
+    #: when the user allowed it (seconds since the epoch)
+    granted: float
+
+
+def timestamp_path(agent_socket_path: str, name: str,
+                   client_domain: str) -> str:
+    return '{}{}{}_{}'.format(agent_socket_path, TIMESTAMP_MARKER,
+                              name, client_domain)
+
+
+def _write_timestamp(path: str, granted: float) -> None:
+    with open(path, 'a', encoding='ascii'):
+        pass
+    os.utime(path, (granted, granted))
+
+
+def _remove_timestamp(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+GrantKey = Tuple[str, str, str]
+
+
+class AutoacceptStore:
+    #: approval times last seen, ``None`` if there is no approval
+    grants: Dict[GrantKey, Optional[float]]
+    #: grants with changes not written to disk yet, and how many
+    unsaved: Dict[GrantKey, int]
+    #: directories with agent sockets seen so far
+    socket_dirs: Set[str]
+    pending: Set['asyncio.Future[None]']
+    executor: Optional[concurrent.futures.ThreadPoolExecutor]
+
+    def __init__(self) -> None:
+        self.grants = {}
+        self.unsaved = {}
+        self.socket_dirs = set()
+        self.pending = set()
+        self.executor = None
+        self.log = logging.getLogger('splitgpg2.AutoacceptStore')
+
+    def clear(self) -> None:
+        """Forget the in-memory state, except changes not written yet"""
+        self.grants = {key: granted for key, granted in self.grants.items()
+                       if key in self.unsaved}
+
+    def granted_at(self, agent_socket_path: str, name: str,
+                   client_domain: str) -> Optional[float]:
+        """Time the user last allowed *name* for *client_domain*"""
+        key = (agent_socket_path, name, client_domain)
+        if key in self.unsaved:
+            return self.grants[key]
+        self.socket_dirs.add(os.path.dirname(agent_socket_path))
+        try:
+            granted: Optional[float] = os.stat(
+                timestamp_path(*key)).st_mtime
+        except FileNotFoundError:
+            granted = None
+        self.grants[key] = granted
+        return granted
+
+    def grant(self, agent_socket_path: str, name: str, client_domain: str,
+              granted: float) -> None:
+        key = (agent_socket_path, name, client_domain)
+        self.socket_dirs.add(os.path.dirname(agent_socket_path))
+        self.grants[key] = granted
+        self.write_back(key, _write_timestamp, timestamp_path(*key), granted)
+
+    def list(self, client_domain: str) -> List[Grant]:
+        """Approvals given to *client_domain*, regardless of whether they
+        are still valid - that depends on its autoaccept settings"""
+        keys = {key for key in self.grants if key[2] == client_domain}
+        keys.update(self.timestamp_files(client_domain))
+        grants = []
+        for key in keys:
+            granted = self.granted_at(*key)
+            if granted is not None:
+                grants.append(Grant(*key, granted))
+        return sorted(grants)
+
+    def revoke(self, client_domain: str,
+               name: Optional[str] = None) -> List[Grant]:
+        """Revoke approvals of *client_domain* (only for command *name*,
+        if given), return the revoked ones"""
+        revoked = [grant for grant in self.list(client_domain)
+                   if name is None or grant.name == name]
+        for grant in revoked:
+            key = (grant.agent_socket_path, grant.name, grant.client_domain)
+            self.grants[key] = None
+            self.write_back(key, _remove_timestamp, timestamp_path(*key))
+        return revoked
+
+    def timestamp_files(self, client_domain: str) -> List[GrantKey]:
+        """Grants of *client_domain* with a timestamp file"""
+        keys = []
+        for socket_dir in self.socket_dirs:
+            try:
+                names = os.listdir(socket_dir)
+            except FileNotFoundError:
+                continue
+            for file_name in names:
+                match = _timestamp_file_re.match(file_name)
+                if match is None or match.group('domain') != client_domain:
+                    continue
+                keys.append((os.path.join(socket_dir, match.group('socket')),
+                             match.group('name'), client_domain))
+        return keys
+
+    def write_back(self, key: GrantKey, func: Callable[..., None],
+                   *args: object) -> None:
+        if self.executor is None:
+            # a single thread, so the writes are done in order
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='autoaccept')
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+        self.pending.add(future)
+        self.unsaved[key] = self.unsaved.get(key, 0) + 1
+        future.add_done_callback(functools.partial(self.write_done, key))
+
+    def write_done(self, key: GrantKey,
+                   future: 'asyncio.Future[None]') -> None:
+        self.pending.discard(future)
+        self.unsaved[key] -= 1
+        if not self.unsaved[key]:
+            del self.unsaved[key]
+        if not future.cancelled() and future.exception() is not None:
+            # the in-memory state is still valid, it just won't survive
+            # a restart
+            self.log.warning('Failed to save autoaccept state: %s',
+                             future.exception())
+
+    async def flush(self) -> None:
+        """Wait for the state to be written to disk"""
+        loop = asyncio.get_running_loop()
+        pending = [future for future in self.pending
+                   if future.get_loop() is loop]
+        if pending:
+            await asyncio.wait(pending)
+
+
+_store: Optional[AutoacceptStore] = None  # pylint: disable=invalid-name
+
+
+def autoaccept_store() -> AutoacceptStore:
+    """Autoaccept state shared by all connections"""
+    global _store  # pylint: disable=global-statement
+    if _store is None:
+        _store = AutoacceptStore()
+    return _store
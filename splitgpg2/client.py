@@ -0,0 +1,460 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Part of split-gpg2.
+
+Client side: listens on the gpg-agent socket and passes each connection
+to the server domain over a qubes.Gpg2 call (a *channel*). By default every
+connection gets its own channel, closed when the connection ends.
+
+Optionally (*reuse*) channels are kept instead of making a new qrexec call
+for every connection: when a local connection ends between two commands, the
+channel is reset (``RESET``, passed through by the server to its gpg-agent)
+and kept for the next connection. The ``BYE`` of a local client is answered
+here, the channel stays open. This is off by default - the qrexec policy is
+evaluated only when a channel is opened, so with an ``ask`` policy the user
+would confirm the first connection only, not each of them.
+
+A channel that is in the middle of a command when its local connection ends,
+or that doesn't answer the ``RESET`` with ``OK``, is closed instead. Idle
+channels are closed after :py:data:`IDLE_TIMEOUT`, so the server picks up
+configuration changes.
+
+Responses to key listing queries (HAVEKEY, KEYINFO), which gpg and mail
+clients repeat a lot, are cached for :py:data:`CACHE_TTL` seconds and
+answered here, without asking the server. The cache is dropped after GENKEY,
+and on SIGHUP.
+
+Optionally a few channels can be opened in advance (*prewarm*). This is off
+by default - each open channel is a qubes.Gpg2 call, which may need to be
+confirmed by the user, depending on the qrexec policy.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+from typing import Any, List, Optional, Sequence, Set
+
+from .assuan import AssuanLineReader
+from .responsecache import ResponseCache
+
+#: how long an unused channel is kept open, in seconds
+IDLE_TIMEOUT = 60.0
+
+#: how many unused channels are kept open at most
+MAX_IDLE = 4
+
+#: how long responses to :py:data:`CACHED_COMMANDS` are reused, in seconds
+CACHE_TTL = 10.0
+
+#: read-only queries answered from the cache
+CACHED_COMMANDS = (b'HAVEKEY', b'KEYINFO')
+
+#: commands after which cached responses may be wrong
+INVALIDATING_COMMANDS = (b'GENKEY',)
+
+
+def is_final_response(line: bytes) -> bool:
+    return line == b'OK' or line.startswith(b'OK ') or \
+        line == b'ERR' or line.startswith(b'ERR ')
+
+
+class ChannelClosed(Exception):
+    pass
+
+
+class Channel:
+    """One qubes.Gpg2 call"""
+    process: 'asyncio.subprocess.Process'
+    reader: AssuanLineReader
+    greeting: bytes
+    watcher: Optional['asyncio.Task[None]']
+
+    def __init__(self, process: 'asyncio.subprocess.Process') -> None:
+        assert process.stdout is not None
+        self.process = process
+        self.reader = AssuanLineReader(process.stdout)
+        self.greeting = b''
+        self.watcher = None
+
+    def write(self, lines: Sequence[bytes]) -> None:
+        assert self.process.stdin is not None
+        try:
+            self.process.stdin.writelines(line + b'\n' for line in lines)
+        except ConnectionError as e:
+            raise ChannelClosed from e
+
+    async def drain(self) -> None:
+        assert self.process.stdin is not None
+        try:
+            await self.process.stdin.drain()
+        except ConnectionError as e:
+            raise ChannelClosed from e
+
+    async def read_lines(self) -> List[bytes]:
+        lines = await self.reader.read_lines()
+        if not lines or self.reader.truncated:
+            raise ChannelClosed
+        return lines
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.cancel()
+            self.watcher = None
+        assert self.process.stdin is not None
+        # the server exits on EOF
+        self.process.stdin.close()
+
+
+# the settings are kept next to the state they apply to
+# pylint: disable=too-many-instance-attributes
+class ClientAgent:
+    idle: List[Channel]
+    tasks: Set['asyncio.Task[Any]']
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, command: Sequence[str], *, prewarm: int = 0,
+                 max_idle: int = MAX_IDLE,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 cache_ttl: float = CACHE_TTL,
+                 reuse: bool = False) -> None:
+        #: command making a qubes.Gpg2 call, on stdin/stdout
+        self.command = command
+        #: keep channels for later connections, instead of a new qrexec
+        #: call (and policy check) for each
+        self.reuse = reuse
+        #: unused channels to keep ready
+        self.prewarm = prewarm
+        self.max_idle = max(max_idle, prewarm)
+        self.idle_timeout = idle_timeout
+        #: responses to :py:data:`CACHED_COMMANDS`, ``None`` if disabled
+        self.cache = ResponseCache(cache_ttl) if cache_ttl > 0 else None
+        self.idle = []
+        self.opening = 0
+        #: background tasks - channels being opened in advance, or waiting
+        #: for their qrexec call to finish
+        self.tasks = set()
+        self.log = logging.getLogger('splitgpg2.Client')
+
+    async def open_channel(self) -> Channel:
+        process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        channel = Channel(process)
+        try:
+            # the server sends the agent hello when it's ready
+            lines = await channel.read_lines()
+        except (ChannelClosed, ValueError):
+            self.close_channel(channel)
+            raise ChannelClosed from None
+        if not lines[0].startswith(b'OK'):
+            self.close_channel(channel)
+            raise ChannelClosed
+        channel.greeting = lines[0] + b'\n'
+        channel.reader.unread(lines[1:])
+        return channel
+
+    def close_channel(self, channel: Channel) -> None:
+        channel.close()
+        task = asyncio.ensure_future(channel.process.wait())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def get_channel(self) -> Channel:
+        while self.idle:
+            channel = self.idle.pop()
+            watcher = channel.watcher
+            assert watcher is not None
+            channel.watcher = None
+            watcher.cancel()
+            # it's reading from the channel, let it finish
+            await asyncio.wait([watcher])
+            if not channel.reader.pending and \
+                    not channel.reader.reader.at_eof():
+                self.replenish()
+                return channel
+            self.close_channel(channel)
+        channel = await self.open_channel()
+        self.replenish()
+        return channel
+
+    def put_idle(self, channel: Channel) -> None:
+        if len(self.idle) >= self.max_idle:
+            self.close_channel(channel)
+            return
+        channel.watcher = asyncio.ensure_future(self.watch_idle(channel))
+        self.idle.append(channel)
+
+    async def watch_idle(self, channel: Channel) -> None:
+        """Close *channel* when it times out, or the server says anything or
+        goes away while it's not used"""
+        timed_out = False
+        try:
+            await asyncio.wait_for(channel.reader.read_lines(),
+                                   self.idle_timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        except (ValueError, ConnectionError):
+            pass
+        if channel in self.idle:
+            self.idle.remove(channel)
+        channel.watcher = None
+        self.close_channel(channel)
+        # but don't keep reopening channels the server closes right away
+        if timed_out:
+            self.replenish()
+
+    def replenish(self) -> None:
+        """Open channels in the background, up to :py:attr:`prewarm`"""
+        while len(self.idle) + self.opening < self.prewarm:
+            self.opening += 1
+            task = asyncio.ensure_future(self.prewarm_channel())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def prewarm_channel(self) -> None:
+        try:
+            channel = await self.open_channel()
+        except (ChannelClosed, OSError) as e:
+            self.log.warning('Failed to open a channel in advance: %r', e)
+            return
+        finally:
+            self.opening -= 1
+        self.put_idle(channel)
+
+    async def recycle(self, channel: Channel) -> None:
+        """Reset *channel* for the next connection, close it if that
+        fails"""
+        try:
+            channel.write([b'RESET'])
+            await channel.drain()
+            lines = await channel.read_lines()
+            if lines[0] == b'OK' or lines[0].startswith(b'OK '):
+                channel.reader.unread(lines[1:])
+                self.put_idle(channel)
+                return
+        except (ChannelClosed, ValueError):
+            pass
+        self.close_channel(channel)
+
+    @staticmethod
+    async def read_response(channel: Channel,
+                            local: AssuanLineReader) -> Optional[List[bytes]]:
+        """Read response lines from *channel*, or return ``None`` if the
+        local connection is closed first - so that the server sees it too
+        (and for example stops asking the user for confirmation)"""
+        read = asyncio.ensure_future(channel.read_lines())
+        if not local.pending:
+            watch = asyncio.ensure_future(local.read_lines())
+            await asyncio.wait([read, watch],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not watch.done():
+                watch.cancel()
+                await asyncio.wait([watch])
+            elif watch.exception() is None and watch.result():
+                # pipelined command, keep it for later
+                local.unread(watch.result())
+            else:
+                read.cancel()
+                await asyncio.wait([read])
+                return None
+        return await read
+
+    def invalidate_cache(self) -> None:
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def relay_response(self, channel: Channel,
+                             local: AssuanLineReader,
+                             local_writer: asyncio.StreamWriter,
+                             recorded: Optional[List[bytes]] = None) -> bool:
+        """Relay the response to a command, including any inquires. Return
+        whether the local connection is still fine. If *recorded* is given,
+        add the lines relayed to it."""
+        while True:
+            lines = await self.read_response(channel, local)
+            if lines is None:
+                return False
+            for index, line in enumerate(lines):
+                if is_final_response(line) or line.startswith(b'INQUIRE '):
+                    channel.reader.unread(lines[index + 1:])
+                    del lines[index + 1:]
+                    break
+            if recorded is not None:
+                recorded.extend(line + b'\n' for line in lines)
+            local_writer.writelines(line + b'\n' for line in lines)
+            await local_writer.drain()
+            if is_final_response(lines[-1]):
+                return True
+            if lines[-1].startswith(b'INQUIRE '):
+                if not await self.relay_inquire(channel, local):
+                    return False
+
+    @staticmethod
+    async def relay_inquire(channel: Channel,
+                            local: AssuanLineReader) -> bool:
+        """Relay the local client's data up to ``END`` or ``CAN``"""
+        while True:
+            lines = await local.read_lines()
+            if not lines or local.truncated:
+                return False
+            for index, line in enumerate(lines):
+                if line in (b'END', b'CAN') or line.startswith(b'CAN '):
+                    local.unread(lines[index + 1:])
+                    channel.write(lines[:index + 1])
+                    await channel.drain()
+                    return True
+            channel.write(lines)
+            await channel.drain()
+
+    async def relay_session(self, channel: Channel,
+                            local_reader: asyncio.StreamReader,
+                            local_writer: asyncio.StreamWriter) -> bool:
+        """Relay one local connection. Return whether it ended between
+        commands, leaving the channel usable"""
+        local = AssuanLineReader(local_reader)
+        local_writer.write(channel.greeting)
+        while True:
+            lines = await local.read_lines()
+            if not lines or local.truncated:
+                # an incomplete last line is not passed on
+                return True
+            line = lines[0]
+            local.unread(lines[1:])
+            if line == b'BYE' or line.startswith(b'BYE '):
+                local_writer.write(b'OK closing connection\n')
+                await local_writer.drain()
+                return True
+            command, _, args = line.partition(b' ')
+            # one server only, no need for an agent socket path in the key
+            # (nor a keyring state, the cache is dropped explicitly)
+            cache_key = ('', command, args)
+            recorded: Optional[List[bytes]] = None
+            if self.cache is not None and command in CACHED_COMMANDS:
+                cached = self.cache.get(cache_key, [])
+                if cached is not None:
+                    local_writer.writelines(cached)
+                    await local_writer.drain()
+                    continue
+                recorded = []
+            channel.write([line])
+            await channel.drain()
+            try:
+                if not await self.relay_response(channel, local, local_writer,
+                                                 recorded):
+                    return False
+            finally:
+                if command in INVALIDATING_COMMANDS:
+                    self.invalidate_cache()
+            if self.cache is not None and recorded is not None and \
+                    not any(line.startswith(b'INQUIRE ') for line in recorded):
+                self.cache.put(cache_key, [], recorded)
+
+    async def handle_connection(self, local_reader: asyncio.StreamReader,
+                                local_writer: asyncio.StreamWriter) -> None:
+        channel: Optional[Channel] = None
+        clean = False
+        try:
+            channel = await self.get_channel()
+            clean = await self.relay_session(channel, local_reader,
+                                             local_writer)
+        except (ChannelClosed, OSError) as e:
+            self.log.info('Connection failed: %r', e)
+        except ValueError as e:
+            # line too long
+            self.log.warning('Connection failed: %s', e)
+        finally:
+            local_writer.close()
+        if channel is not None:
+            if clean and self.reuse:
+                await self.recycle(channel)
+            else:
+                self.close_channel(channel)
+
+    async def close(self) -> None:
+        for channel in self.idle:
+            self.close_channel(channel)
+        self.idle.clear()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+
+async def serve(agent: ClientAgent, socket_path: str) -> None:
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    server = await asyncio.start_unix_server(agent.handle_connection,
+                                             socket_path)
+    agent.replenish()
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        await agent.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='split-gpg2 client - listens on the gpg-agent socket')
+    parser.add_argument('--prewarm', type=int, default=0,
+                        help='number of unused channels to keep open in '
+                        'advance (default: %(default)s)')
+    parser.add_argument('--max-idle', type=int, default=MAX_IDLE,
+                        help='number of unused channels to keep open at '
+                        'most (default: %(default)s)')
+    parser.add_argument('--reuse', action='store_true',
+                        help='keep qubes.Gpg2 calls open for later '
+                        'connections - each call is checked against the '
+                        'qrexec policy only once')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help='how long to reuse responses to key listing '
+                        'queries, in seconds, 0 to disable '
+                        '(default: %(default)s)')
+    parser.add_argument('server_domain')
+    parser.add_argument('agent_socket')
+    args = parser.parse_args()
+
+    os.umask(0o0077)
+    logging.basicConfig(level=logging.WARNING)
+    agent = ClientAgent(
+        ['qrexec-client-vm', args.server_domain, 'qubes.Gpg2'],
+        prewarm=args.prewarm, max_idle=args.max_idle,
+        cache_ttl=args.cache_ttl, reuse=args.reuse)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    serve_task = asyncio.ensure_future(serve(agent, args.agent_socket))
+    loop.add_signal_handler(signal.SIGHUP, agent.invalidate_cache)
+    loop.add_signal_handler(signal.SIGTERM, serve_task.cancel)
+    loop.add_signal_handler(signal.SIGINT, serve_task.cancel)
+    try:
+        loop.run_until_complete(serve_task)
+    except asyncio.CancelledError:
+        pass
+    loop.close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Configuration files, and their compiled form.
+
+The config files are parsed with :py:mod:`configparser` and validated by
+:py:func:`compile_config` into a :py:class:`ServerConfig` - everything a
+connection needs, already checked. To not parse all the files for each
+connection, the compiled config of each client domain is kept as a snapshot
+(see :py:class:`ConfigSnapshots`), valid as long as none of the config files
+(path, modification time and size) nor the environment it depends on
+changed. :py:mod:`configparser` is imported only when the files need to be
+parsed.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, \
+    TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import configparser
+
+TIMER_NAMES = (
+    'PKSIGN',
+    'PKDECRYPT',
+)
+
+SUPPORTED_OPTIONS = (
+    'autoaccept',
+    'pksign_autoaccept',
+    'pkdecrypt_autoaccept',
+    'verbose_notifications',
+    'allow_keygen',
+    'gnupghome',
+    'source_keyring_dir',
+    'isolated_gnupghome_dirs',
+    'debug_log',
+    'metrics_textfile',
+    'trace_log',
+    'trace_redact',
+)
+
+#: bump when :py:class:`ServerConfig` changes, to ignore older snapshots
+SNAPSHOT_VERSION = 3
+
+#: config files modified less than that many seconds before they were
+#: parsed are not snapshotted - another change within the same timestamp
+#: granularity would go unnoticed
+SNAPSHOT_MIN_AGE = 2.0
+
+
+class ServerConfig(NamedTuple):
+    timer_delay: Dict[str, Optional[int]]
+    verbose_notifications: bool
+    allow_keygen: bool
+    #: GnuPG home directory, without the ``qubes-auto-keyring`` suffix
+    gnupghome: str
+    source_keyring_dir: Optional[str]
+    debug_log: Optional[str]
+    #: where to write command metrics, see :py:mod:`splitgpg2.metrics`
+    metrics_textfile: Optional[str]
+    #: where to write the I/O trace, see :py:mod:`splitgpg2.trace`
+    trace_log: Optional[str]
+    trace_redact: str
+    #: options not in :py:data:`SUPPORTED_OPTIONS`, to warn about
+    unsupported_options: Tuple[str, ...]
+
+
+def config_files() -> List[str]:
+    """Config files to read, in order"""
+    config_dir_basename = 'qubes-split-gpg2'
+    config_basename = 'qubes-split-gpg2.conf'
+    config_dir_system = os.path.join('/etc/', config_basename)
+    ## Using the xdg module makes it difficult to mode xdg_config_home.
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.config')
+    config_dir_user = xdg_config_home + '/' + config_dir_basename
+    config_list = []
+    config_list.append(config_dir_system)
+    # same as glob('conf.d/*.conf'), without importing glob
+    try:
+        config_extra_list = sorted(
+            config_dir_user + '/conf.d/' + name
+            for name in os.listdir(config_dir_user + '/conf.d')
+            if name.endswith('.conf') and not name.startswith('.'))
+    except OSError:
+        config_extra_list = []
+    for extra_config_file in config_extra_list:
+        config_list.append(extra_config_file)
+    config_list.append(config_dir_user + '/' + config_basename)
+    return config_list
+
+
+def load_config_files(client_domain: str,
+                      files: Optional[List[str]] = None) -> \
+        'configparser.SectionProxy':
+    # pylint: disable=import-outside-toplevel
+    import configparser
+    config = configparser.ConfigParser()
+    config.read(config_files() if files is None else files)
+    section = 'client:' + client_domain
+    # 'DEFAULTS' section is special, values there serve as defaults
+    # for other sections
+    if config.has_section(section):
+        return config[section]
+    return config['DEFAULT']
+
+
+def parse_timer_val(value: str, option_name: str,
+                    log: logging.Logger) -> Optional[int]:
+    if value == 'no':
+        return None
+    if value == 'yes':
+        return -1
+    try:
+        int_value = int(value)
+        if int_value <= 0:
+            raise ValueError(value)
+    except ValueError as e:
+        log.error(
+            "Invalid value '%s' for '%s' config option",
+            str(e), option_name
+        )
+        raise
+    return int_value
+
+
+def parse_bool_val(value: str, option_name: str,
+                   log: logging.Logger) -> bool:
+    if value == 'no':
+        return False
+    if value == 'yes':
+        return True
+    log.error(
+        "Invalid value '%s' for '%s' config option",
+        value, option_name
+    )
+    raise ValueError(value)
+
+
+def compile_config(config: 'configparser.SectionProxy', client_domain: str,
+                   log: logging.Logger) -> ServerConfig:
+    """Validate *config*, raise :py:exc:`ValueError` if it's invalid"""
+    timer_delay: Dict[str, Optional[int]] = {}
+    default_autoaccept = config.get('autoaccept', 'no')
+    for timer_name in TIMER_NAMES:
+        timer_value = config.get(timer_name.lower() + '_autoaccept',
+            default_autoaccept)
+        timer_delay[timer_name] = parse_timer_val(
+            timer_value, 'autoaccept', log)
+
+    verbose_notifications = parse_bool_val(
+        config.get('verbose_notifications', 'no'), 'verbose_notifications',
+        log)
+
+    allow_keygen = parse_bool_val(
+        config.get('allow_keygen', 'no'), 'allow_keygen', log)
+
+    gnupghome = config.get('gnupghome', None)
+    if gnupghome is None:
+        if 'isolated_gnupghome_dirs' in config:
+            gnupghome = os.path.expanduser(os.path.join(
+                config['isolated_gnupghome_dirs'],
+                client_domain))
+        else:
+            gnupghome = os.getenv('GNUPGHOME')
+            if gnupghome is None:
+                gnupghome = os.path.expanduser('~/.gnupg')
+    if not gnupghome.startswith('/'):
+        raise ValueError('GnuPG home directory {!r} is not '
+                         'absolute!'.format(gnupghome))
+
+    source_keyring_dir: Optional[str] = None
+    source_keyring_option = config.get('source_keyring_dir')
+    if source_keyring_option is not None:
+        if source_keyring_option != 'no':
+            source_keyring_dir = os.path.expanduser(source_keyring_option)
+    else:
+        source_keyring_dir = gnupghome
+    if source_keyring_dir is not None and \
+            not source_keyring_dir.startswith('/'):
+        raise ValueError('Source keyring directory {!r} is not '
+                         'absolute!'.format(source_keyring_dir))
+
+    metrics_textfile = config.get('metrics_textfile') or None
+    if metrics_textfile is not None:
+        metrics_textfile = os.path.expanduser(metrics_textfile)
+        if not metrics_textfile.startswith('/'):
+            raise ValueError('Metrics textfile {!r} is not '
+                             'absolute!'.format(metrics_textfile))
+
+    trace_log = config.get('trace_log') or None
+    if trace_log is not None:
+        trace_log = os.path.expanduser(trace_log)
+        if not trace_log.startswith('/'):
+            raise ValueError('Trace log {!r} is not '
+                             'absolute!'.format(trace_log))
+    # same as splitgpg2.trace.REDACT_POLICIES, without importing it
+    trace_redact = config.get('trace_redact', 'data')
+    if trace_redact not in ('no', 'data', 'args'):
+        log.error("Invalid value '%s' for '%s' config option",
+                  trace_redact, 'trace_redact')
+        raise ValueError(trace_redact)
+
+    # warn about unknown options, to easier spot typos, but don't refuse to
+    # start, to allow extensibility
+    unsupported_options = tuple(option for option in config
+                                if option not in SUPPORTED_OPTIONS)
+
+    return ServerConfig(
+        timer_delay=timer_delay,
+        verbose_notifications=verbose_notifications,
+        allow_keygen=allow_keygen,
+        gnupghome=gnupghome,
+        source_keyring_dir=source_keyring_dir,
+        debug_log=config.get('debug_log'),
+        metrics_textfile=metrics_textfile,
+        trace_log=trace_log,
+        trace_redact=trace_redact,
+        unsupported_options=unsupported_options,
+    )
+
+
+def snapshot_key(client_domain: str, files: List[str]) -> List[Any]:
+    """Everything :py:func:`compile_config` output depends on"""
+    sources: List[Any] = []
+    for path in files:
+        try:
+            stat = os.stat(path)
+            sources.append([path, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            sources.append([path, None, None])
+    return [SNAPSHOT_VERSION, client_domain, sources,
+            os.getenv('GNUPGHOME'), os.path.expanduser('~')]
+
+
+class ConfigSnapshots:
+    """Compiled configs, one file per client domain"""
+    path: Optional[str]
+    log: logging.Logger
+
+    def __init__(self, path: Optional[str]) -> None:
+        #: directory to keep snapshots in, ``None`` to not keep any
+        self.path = path
+        self.log = logging.getLogger('splitgpg2.Server')
+
+    def snapshot_path(self, client_domain: str) -> Optional[str]:
+        if self.path is None:
+            return None
+        return os.path.join(self.path, 'config-{}.json'.format(client_domain))
+
+    def get(self, client_domain: str, key: List[Any]) -> \
+            Optional[ServerConfig]:
+        path = self.snapshot_path(client_domain)
+        if path is None:
+            return None
+        try:
+            with open(path, encoding='utf-8') as snapshot_file:
+                data = json.load(snapshot_file)
+            if data['key'] != key:
+                return None
+            config = ServerConfig(*data['config'])
+            return config._replace(
+                unsupported_options=tuple(config.unsupported_options))
+        except (OSError, ValueError, TypeError, KeyError):
+            # just a cache, parse the files again
+            return None
+
+    def put(self, client_domain: str, key: List[Any],
+            config: ServerConfig, parse_time: float) -> None:
+        path = self.snapshot_path(client_domain)
+        if path is None:
+            return
+        newest = max((mtime for _, mtime, _ in key[2] if mtime is not None),
+                     default=0)
+        if newest > (parse_time - SNAPSHOT_MIN_AGE) * 1e9:
+            return
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+                json.dump({'key': key, 'config': config}, snapshot_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # not fatal, the files will be parsed next time too
+            pass
+
+    def load(self, client_domain: str) -> ServerConfig:
+        """Compiled config for *client_domain*, from the snapshot if it's
+        still valid, otherwise from the config files. Raise
+        :py:exc:`ValueError` if the config is invalid."""
+        files = config_files()
+        key = snapshot_key(client_domain, files)
+        config = self.get(client_domain, key)
+        if config is not None:
+            return config
+        parse_time = time.time()
+        config = compile_config(load_config_files(client_domain, files),
+                                client_domain, self.log)
+        self.put(client_domain, key, config, parse_time)
+        return config
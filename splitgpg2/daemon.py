@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Part of split-gpg2.
+
+Long-running server daemon. Instead of starting a new interpreter for each
+qubes.Gpg2 call, the qrexec service hands its stdin/stdout over to this
+daemon (see split-gpg2-handoff), which then runs a :py:class:`GpgServer`
+for that connection. Keygrip indexes (see :py:mod:`splitgpg2.keyindex`)
+and agent socket paths (see :py:func:`agent_socket_cache`) are kept between
+connections, the config is loaded from its snapshot (see
+:py:class:`splitgpg2.config.ConfigSnapshots`) for each of them.
+
+Handoff protocol: the client sends the calling qube name, with its stdin and
+stdout file descriptors attached (SCM_RIGHTS). When the connection is
+finished the daemon sends back a single byte - the exit status.
+"""
+
+# pylint: disable=missing-function-docstring,consider-using-f-string
+
+import asyncio
+import contextlib
+import logging
+import os
+import re
+import signal
+import socket
+import struct
+import sys
+from typing import BinaryIO, List, Set, Tuple
+
+from . import GpgServer, config_snapshots, open_pipe_connection, \
+    runtime_dir, NOTIFY_FLUSH_TIMEOUT
+from .agentpool import close_agent_pools
+from .autoaccept import autoaccept_store
+from .keyindex import drop_keygrip_indexes
+from .keyringsync import flush_keyring_syncs
+from .metrics import flush_metrics
+from .notify import notifier
+from .responsecache import response_cache
+from .trace import close_tracers
+
+# systemd socket activation, see sd_listen_fds(3)
+SD_LISTEN_FDS_START = 3
+
+HANDOFF_MAX_MSG = 256
+
+_domain_re = re.compile(rb'\A[A-Za-z0-9_.-]{1,31}\Z')
+
+
+def socket_path() -> str:
+    return os.path.join(runtime_dir(), 'split-gpg2', 'server.sock')
+
+
+class Daemon:
+    connections: Set['asyncio.Task[None]']
+    log: logging.Logger
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.connections = set()
+        self.log = logging.getLogger('splitgpg2.Daemon')
+
+    def reload(self) -> None:
+        self.log.info('Dropping cached state')
+        drop_keygrip_indexes()
+        autoaccept_store().clear()
+        response_cache().clear()
+
+    async def serve_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self.sock)
+            task = asyncio.ensure_future(self.handle_handoff(conn))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+
+    async def receive_handoff(self, conn: socket.socket) -> \
+            Tuple[str, List[int]]:
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def readable() -> None:
+            if not ready.done():
+                ready.set_result(None)
+
+        loop.add_reader(conn.fileno(), readable)
+        try:
+            await ready
+        finally:
+            loop.remove_reader(conn.fileno())
+        untrusted_msg, fds, _, _ = socket.recv_fds(conn, HANDOFF_MAX_MSG, 2)
+        if len(fds) != 2 or not _domain_re.match(untrusted_msg):
+            for received_fd in fds:
+                os.close(received_fd)
+            raise ValueError('invalid handoff request')
+        return untrusted_msg.decode('ascii'), fds
+
+    async def handle_handoff(self, conn: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            conn.setblocking(False)
+            pid, uid, _ = struct.unpack('3i', conn.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+            if uid != os.getuid():
+                raise PermissionError(
+                    'handoff from pid {} of another user'.format(pid))
+            client_domain, fds = await self.receive_handoff(conn)
+            status = await self.serve(client_domain, fds)
+            await loop.sock_sendall(conn, bytes([status]))
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.exception(e)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def open_pipes(fds: List[int]) -> Tuple[BinaryIO, BinaryIO]:
+        """File objects for the received stdin and stdout, on failure none
+        of the descriptors is left open"""
+        try:
+            read_pipe = os.fdopen(fds[0], 'rb', buffering=0)
+        except OSError:
+            for pipe_fd in fds:
+                with contextlib.suppress(OSError):
+                    os.close(pipe_fd)
+            raise
+        try:
+            write_pipe = os.fdopen(fds[1], 'wb', buffering=0)
+        except OSError:
+            read_pipe.close()
+            with contextlib.suppress(OSError):
+                os.close(fds[1])
+            raise
+        return read_pipe, write_pipe
+
+    async def serve(self, client_domain: str, fds: List[int]) -> int:
+        try:
+            read_pipe, write_pipe = self.open_pipes(fds)
+        except OSError as e:
+            self.log.exception(e)
+            return 1
+        try:
+            reader, writer = await open_pipe_connection(read_pipe, write_pipe)
+        except OSError as e:
+            self.log.exception(e)
+            read_pipe.close()
+            write_pipe.close()
+            return 1
+        try:
+            try:
+                # the snapshot is checked against the config files each time
+                config = config_snapshots().load(client_domain)
+                server = GpgServer(reader, writer, client_domain,
+                                   debug_log=config.debug_log)
+                server.apply_config(config)
+            except ValueError:
+                self.log.error('Error in a config file, aborting')
+                writer.close()
+                return 2
+            await server.run()
+            return 0
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.exception(e)
+            writer.close()
+            return 1
+        finally:
+            # the reading side is not closed by GpgServer.run() on all paths
+            # pylint: disable=protected-access
+            transport = getattr(reader, '_transport', None)
+            if transport is not None:
+                transport.close()
+
+
+def listen_socket() -> socket.socket:
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and \
+            int(os.environ.get('LISTEN_FDS', '0')) >= 1:
+        return socket.socket(fileno=SD_LISTEN_FDS_START)
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    return sock
+
+
+def main() -> None:
+    os.umask(0o0077)
+    logging.basicConfig(level=logging.INFO)
+    daemon = Daemon(listen_socket())
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGHUP, daemon.reload)
+    serve_task = asyncio.ensure_future(daemon.serve_forever())
+    loop.add_signal_handler(signal.SIGTERM, serve_task.cancel)
+    loop.add_signal_handler(signal.SIGINT, serve_task.cancel)
+    try:
+        loop.run_until_complete(serve_task)
+    except asyncio.CancelledError:
+        pass
+    if daemon.connections:
+        loop.run_until_complete(asyncio.wait(daemon.connections))
+    loop.run_until_complete(notifier().flush(NOTIFY_FLUSH_TIMEOUT))
+    loop.run_until_complete(notifier().close())
+    loop.run_until_complete(autoaccept_store().flush())
+    loop.run_until_complete(flush_keyring_syncs())
+    flush_metrics()
+    close_tracers()
+    close_agent_pools()
+    loop.close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
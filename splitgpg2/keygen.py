@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Validation of key generation parameters (the KEYPARAM inquire of GENKEY).
+
+Key generation is rare (and disabled by default, see ``allow_keygen``), so
+this is imported only when needed.
+"""
+
+from typing import List, TYPE_CHECKING
+
+from . import GpgServer, sanitize_int
+
+if TYPE_CHECKING:
+    from . import SExpr
+
+known_eddsa_curves = { b'Ed25519', b'Ed448' }
+
+known_safeecdh_curves = { b'Curve25519', b'X448' }
+
+known_other_curves = {
+    b'NIST P-256',
+    b'NIST P-384',
+    b'NIST P-521',
+    b'brainpoolP256r1',
+    b'brainpoolP384r1',
+    b'brainpoolP512r1',
+    b'secp256k1',
+}
+
+
+def validate_bits_len(untrusted_sexp: 'SExpr') -> None:
+    untrusted_bits = GpgServer.check_letter_bytes(b'nbits', untrusted_sexp)
+    sanitize_int(untrusted_bits, 1024, 4096)
+
+
+def check_curve_flags(untrusted_curve: bytes, untrusted_flags: List['SExpr']) -> None:
+    if untrusted_flags == [b'nocomp']:
+        # Always allowed
+        return
+    if untrusted_curve in known_eddsa_curves:
+        allowed_flags = (b'eddsa', b'comp')
+    elif untrusted_curve in known_safeecdh_curves:
+        allowed_flags = (b'comp', b'djb-tweak')
+    elif untrusted_curve in known_other_curves:
+        raise ValueError('Invalid flags for non-Edwards curve')
+    else:
+        raise ValueError('Unknown elliptic curve')
+    if len(untrusted_flags) > 2:
+        raise ValueError('Too many flags for Edwards curve')
+    if b'comp' not in untrusted_flags:
+        raise ValueError('Edwards curve keys must be compressed')
+    for untrusted_flag in untrusted_flags:
+        if untrusted_flag not in allowed_flags:
+            raise ValueError('Forbidden flag sent')
+
+
+def validate_keygen_sexp(*, untrusted_sexp: 'SExpr') -> None:
+    """
+    Check that the ``untrusted_sexp`` is a valid set of key generation
+    parameters.
+    """
+    untrusted_sexp = GpgServer.check_letter_list(b'genkey', untrusted_sexp)
+    if len(untrusted_sexp) < 2:
+        raise ValueError('No key parameters')
+    untrusted_alg = untrusted_sexp[0]
+    if untrusted_alg == b'ecc':
+        if len(untrusted_sexp) != 3:
+            raise ValueError('invalid elliptic curve parameters')
+        untrusted_curve = GpgServer.check_letter_bytes(b'curve', untrusted_sexp[1])
+        untrusted_flags = untrusted_sexp[2]
+        if not isinstance(untrusted_flags, list):
+            raise ValueError('Flags must be a list')
+        if len(untrusted_flags) < 2 or untrusted_flags[0] != b'flags':
+            raise ValueError(
+                    "Key generation flags must begin with b'flags'")
+        check_curve_flags(untrusted_curve, untrusted_flags[1:])
+    elif untrusted_alg in (b'rsa', b'openpgp-elg'):
+        if len(untrusted_sexp) != 2:
+            raise ValueError('invalid ElGamel or RSA parameters')
+        validate_bits_len(untrusted_sexp[1])
+    elif untrusted_alg == b'dsa':
+        if (len(untrusted_sexp) != 3 or
+            untrusted_sexp[2] != [b'qbits', b'256']):
+            raise ValueError('invalid DSA parameters')
+        validate_bits_len(untrusted_sexp[1])
+    else:
+        raise ValueError('refusing to generate key with unknown algorithm')
@@ -0,0 +1,322 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Keygrip index - maps keygrips of secret keys to the key description shown
+in the agent's confirmation prompt.
+
+The index is kept per GnuPG home directory, both in memory and on disk (in
+``$XDG_CACHE_HOME/split-gpg2``, not in the GnuPG home itself, so it doesn't
+affect its mtime used to trigger keyring sync). It is refreshed based on the
+modification times of ``private-keys-v1.d`` and the public keyring: when only
+secret keys were added, gpg is asked just about the new keygrips, keys
+removed from ``private-keys-v1.d`` are dropped without calling gpg at all.
+A change of the public keyring rebuilds the whole index.
+"""
+
+# pylint: disable=missing-function-docstring,too-few-public-methods
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import weakref
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set
+
+PUBRING_FILES = ('pubring.kbx', 'pubring.gpg')
+PRIVATE_KEYS_DIR = 'private-keys-v1.d'
+
+_keygrip_file_re = re.compile(r'\A[0-9A-F]{40}\.key\Z')
+
+
+class BaseKeyInfo:
+    """
+    Base class for KeyInfo and SubKeyInfo.  Do not use as a type for variables;
+    use ``Union[KeyInfo, SubKeyInfo]`` instead.
+    """
+    fingerprint: Optional[bytes]
+    keygrip: Optional[bytes]
+    capabilities: bytes
+    __slots__ = ('fingerprint', 'keygrip', 'capabilities')
+    def __init__(self, capabilities: bytes) -> None:
+        self.fingerprint = None
+        self.keygrip = None
+        self.capabilities = capabilities
+
+class SubKeyInfo(BaseKeyInfo):
+    key: 'KeyInfo'
+    __slots__ = ('key',)
+    def __init__(self, capabilities: bytes, key: 'KeyInfo'):
+        super().__init__(capabilities)
+        self.key = key
+
+class KeyInfo(BaseKeyInfo):
+    subkeys: List[SubKeyInfo]
+    first_uid: Optional[bytes]
+    __slots__ = ('subkeys', 'first_uid')
+    def __init__(self, capabilities: bytes):
+        super().__init__(capabilities)
+        self.first_uid = None
+        self.subkeys = []
+
+
+class KeyEntry(NamedTuple):
+    #: fingerprint of the primary key
+    fingerprint: bytes
+    first_uid: Optional[bytes]
+    #: fingerprint of the subkey, if the keygrip belongs to a subkey
+    subkey_fingerprint: Optional[bytes]
+
+
+def estream_unescape(escaped: bytes) -> bytes:
+    """Undo es_write_sanitized()"""
+
+    char_map = { b'\\': b'\\',
+                 b'n': b'\n',
+                 b'r': b'\r',
+                 b'f': b'\f',
+                 b'v': b'\v',
+                 b'b': b'\b',
+                 b'0': b'\0'}
+    def map_back(match: re.Match[bytes]) -> bytes:
+        char = match.group(1)
+        if char in char_map:
+            return char_map[char]
+        return bytes([int(char[1:2], 16)])
+
+
+    return re.sub(rb'\\(\\|n|r|f|v|b|0|x[0-9a-f]{2})', map_back, escaped)
+
+
+def parse_secret_keys(out: bytes) -> List[KeyInfo]:
+    """Parse ``gpg --list-secret-keys --with-colons`` output"""
+    keys: List[KeyInfo] = []
+    primary_key: Optional[KeyInfo] = None
+    subkey: Optional[SubKeyInfo] = None
+    for line in out.split(b"\n"):
+        fields = line.split(b":")
+        if fields[0] in [b"sec", b"ssb", b""]:
+            if subkey is not None:
+                assert primary_key is not None, 'bad output from GnuPG'
+                subkey.key = primary_key
+                primary_key.subkeys.append(subkey)
+                subkey = None
+        if fields[0] in [b"sec", b""] and primary_key is not None:
+            keys.append(primary_key)
+        if fields[0] == b"sec":
+            primary_key = KeyInfo(fields[11])
+        elif fields[0] == b"ssb":
+            assert primary_key is not None, 'subkey before primary key?'
+            subkey = SubKeyInfo(fields[11], primary_key)
+        elif fields[0] == b"fpr":
+            assert primary_key is not None, 'bad output from GnuPG'
+            if subkey is None:
+                primary_key.fingerprint = fields[9]
+            else:
+                subkey.fingerprint = fields[9]
+        elif fields[0] == b"grp":
+            assert primary_key is not None, 'bad output from GnuPG'
+            if subkey is None:
+                primary_key.keygrip = fields[9]
+            else:
+                subkey.keygrip = fields[9]
+        elif fields[0] == b"uid":
+            assert primary_key is not None, 'uid before primary key?'
+            if primary_key.first_uid is None:
+                primary_key.first_uid = estream_unescape(fields[9])
+    return keys
+
+
+def keygrip_entries(keys: Sequence[KeyInfo]) -> Dict[bytes, KeyEntry]:
+    entries: Dict[bytes, KeyEntry] = {}
+    for key in keys:
+        assert key.keygrip is not None, 'no keygrip'
+        assert key.fingerprint is not None, 'no fingerprint'
+        entries[key.keygrip] = KeyEntry(key.fingerprint, key.first_uid, None)
+        for subkey in key.subkeys:
+            assert subkey.keygrip is not None, 'no subkey keygrip'
+            entries[subkey.keygrip] = KeyEntry(
+                key.fingerprint, key.first_uid, subkey.fingerprint)
+    return entries
+
+
+class KeygripIndex:
+    # the index, what it was built from, and where it is persisted
+    # pylint: disable=too-many-instance-attributes
+    entries: Dict[bytes, KeyEntry]
+    #: keygrips of the files in private-keys-v1.d the index was built from
+    private_keys: Set[bytes]
+    #: (private-keys-v1.d mtime, public keyring mtimes), ``None`` if not
+    #: built yet
+    state: Optional[List[Optional[int]]]
+    #: incremented on each change of the entries
+    generation: int
+    #: serializes refreshes - the index is shared by all event loops of the
+    #: process, but a lock can't be
+    locks: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]'
+
+    def __init__(self, gnupghome: str) -> None:
+        self.gnupghome = gnupghome
+        self.entries = {}
+        self.private_keys = set()
+        self.state = None
+        self.generation = 0
+        self.locks = weakref.WeakKeyDictionary()
+        self.log = logging.getLogger('splitgpg2.KeygripIndex')
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.expanduser('~/.cache')
+        self.index_path = os.path.join(
+            cache_home, 'split-gpg2', 'keygrip-index',
+            hashlib.sha256(gnupghome.encode('utf-8', 'surrogateescape'))
+            .hexdigest()[:32] + '.json')
+        self.load()
+
+    def mtime(self, name: str) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.gnupghome, name)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def current_state(self) -> List[Optional[int]]:
+        return [self.mtime(PRIVATE_KEYS_DIR)] + \
+            [self.mtime(name) for name in PUBRING_FILES]
+
+    def list_private_keys(self) -> Set[bytes]:
+        try:
+            names = os.listdir(os.path.join(self.gnupghome, PRIVATE_KEYS_DIR))
+        except FileNotFoundError:
+            return set()
+        return {name[:40].encode('ascii')
+                for name in names if _keygrip_file_re.match(name)}
+
+    def load(self) -> None:
+        try:
+            with open(self.index_path, encoding='utf-8') as index_file:
+                data = json.load(index_file)
+            self.entries = {
+                grip.encode('ascii'): KeyEntry(
+                    fpr.encode('ascii'),
+                    None if uid is None else uid.encode('latin-1'),
+                    None if sub_fpr is None else sub_fpr.encode('ascii'))
+                for grip, (fpr, uid, sub_fpr) in data['entries'].items()}
+            self.private_keys = {grip.encode('ascii')
+                                 for grip in data['private_keys']}
+            self.state = data['state']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.log.warning('Ignoring broken keygrip index %s: %s',
+                             self.index_path, e)
+            self.entries = {}
+            self.private_keys = set()
+            self.state = None
+
+    def save(self) -> None:
+        data = {
+            'state': self.state,
+            'private_keys': sorted(grip.decode('ascii')
+                                   for grip in self.private_keys),
+            'entries': {
+                grip.decode('ascii'): (
+                    entry.fingerprint.decode('ascii'),
+                    None if entry.first_uid is None
+                    else entry.first_uid.decode('latin-1'),
+                    None if entry.subkey_fingerprint is None
+                    else entry.subkey_fingerprint.decode('ascii'))
+                for grip, entry in self.entries.items()},
+        }
+        tmp_path = '{}.{}'.format(self.index_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(tmp_path), 0o700, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as index_file:
+                json.dump(data, index_file)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # not fatal, the in-memory index still works
+            self.log.warning('Failed to save keygrip index: %s', e)
+
+    async def list_secret_keys(self, *patterns: bytes) -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            'gpg', '--homedir', self.gnupghome,
+            '--list-secret-keys', '--with-colons', *patterns,
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        stdout, _ = await proc.communicate()
+        # When searching for specific keygrips, gpg fails if any of them
+        # has no matching public key, but still lists the others.
+        if proc.returncode and not patterns:
+            raise subprocess.CalledProcessError(
+                proc.returncode, ['gpg', '--list-secret-keys'])
+        return stdout
+
+    def lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        try:
+            return self.locks[loop]
+        except KeyError:
+            lock = self.locks[loop] = asyncio.Lock()
+            return lock
+
+    async def refresh(self) -> None:
+        async with self.lock():
+            state = self.current_state()
+            if state == self.state:
+                return
+            private_keys = self.list_private_keys()
+            if self.state is None or state[1:] != self.state[1:]:
+                # public keyring changed (or no index yet), rebuild
+                self.log.info('Rebuilding keygrip index of %s', self.gnupghome)
+                entries = keygrip_entries(parse_secret_keys(
+                    await self.list_secret_keys()))
+            else:
+                entries = {
+                    grip: entry for grip, entry in self.entries.items()
+                    if grip in private_keys or grip not in self.private_keys}
+                added = sorted(private_keys - self.private_keys)
+                if added:
+                    entries.update(keygrip_entries(parse_secret_keys(
+                        await self.list_secret_keys(
+                            *(b'&' + grip for grip in added)))))
+            if entries != self.entries:
+                self.generation += 1
+            self.entries = entries
+            self.private_keys = private_keys
+            self.state = state
+            self.save()
+
+    async def lookup(self, keygrip: bytes) -> Optional[KeyEntry]:
+        await self.refresh()
+        return self.entries.get(keygrip)
+
+
+_indexes: Dict[str, KeygripIndex] = {}
+
+
+def keygrip_index(gnupghome: str) -> KeygripIndex:
+    """Keygrip index for *gnupghome*, shared by all connections"""
+    try:
+        return _indexes[gnupghome]
+    except KeyError:
+        index = _indexes[gnupghome] = KeygripIndex(gnupghome)
+        return index
+
+
+def drop_keygrip_indexes() -> None:
+    _indexes.clear()
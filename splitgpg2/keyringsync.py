@@ -0,0 +1,362 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Sync of the subkeys-only keyring (``qubes-auto-keyring``) with the source
+keyring.
+
+Instead of rebuilding the whole keyring whenever the source changes, each
+secret key of the source keyring gets a digest of its listing (subkeys,
+user IDs, expiration...) and of the modification times of its key files.
+The digests of the keys transferred last time are kept in a manifest in the
+target keyring. Only new or changed keys are exported (with
+``--export-secret-subkeys``) and imported, keys gone from the source keyring
+are deleted.
+
+The keyring in use is not changed key by key. The public keyring is copied
+to a directory next to it, and the changes are made there. Then the new
+secret key files are moved into the keyring in use, the public keyring is
+replaced in one rename, and only after that the secret key files of the
+keys gone are removed. So every key listed has its secret parts. A
+connection sees either the old or the new version of the keys, never a
+changed key missing. If the export fails, the old versions of the changed
+keys are kept, and the keys gone from the source keyring are still removed.
+
+Only the first sync of a keyring is waited for. After that, a change of the
+source keyring starts a sync in the background and connections use the
+keyring as it is until the new one is swapped in.
+"""
+
+# pylint: disable=missing-function-docstring,consider-using-f-string
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from .keyindex import PRIVATE_KEYS_DIR, PUBRING_FILES
+
+MANIFEST_NAME = 'split-gpg2-sync.json'
+
+XFER_FLAGS = ('gpg', '--no-armor', '--batch', '--with-colons', '--no-tty',
+              '--disable-dirmngr')
+
+
+def source_state(source_dir: str) -> List[Optional[int]]:
+    """Modification times telling whether the source keyring changed"""
+    state: List[Optional[int]] = []
+    # not the directory itself - merely using the keyring may change it
+    for name in (PRIVATE_KEYS_DIR,) + PUBRING_FILES:
+        try:
+            state.append(os.stat(os.path.join(source_dir, name)).st_mtime_ns)
+        except FileNotFoundError:
+            state.append(None)
+    return state
+
+
+def key_digests(gnupghome: str, listing: bytes) -> Dict[str, str]:
+    """Digests of secret keys, from ``gpg --list-secret-keys --with-colons
+    --with-keygrip`` output, by primary key fingerprint"""
+    digests: Dict[str, str] = {}
+    fingerprint: Optional[str] = None
+    digest = hashlib.sha256()
+    for line in listing.split(b'\n'):
+        fields = line.split(b':')
+        if fields[0] == b'sec':
+            if fingerprint is not None:
+                digests[fingerprint] = digest.hexdigest()
+            fingerprint = None
+            digest = hashlib.sha256()
+        elif fields[0] == b'fpr' and fingerprint is None:
+            fingerprint = fields[9].decode('ascii')
+        elif fields[0] == b'grp':
+            try:
+                mtime = os.stat(os.path.join(
+                    gnupghome, PRIVATE_KEYS_DIR,
+                    fields[9].decode('ascii') + '.key')).st_mtime_ns
+            except (FileNotFoundError, UnicodeDecodeError):
+                mtime = 0
+            digest.update(b'%d\n' % mtime)
+        digest.update(line + b'\n')
+    if fingerprint is not None:
+        digests[fingerprint] = digest.hexdigest()
+    return digests
+
+
+def key_keygrips(listing: bytes) -> Dict[str, Set[str]]:
+    """Keygrips of secret keys and their subkeys, from the same output as
+    :py:func:`key_digests`, by primary key fingerprint"""
+    keygrips: Dict[str, Set[str]] = {}
+    fingerprint: Optional[str] = None
+    for line in listing.split(b'\n'):
+        fields = line.split(b':')
+        if fields[0] == b'sec':
+            fingerprint = None
+        elif fields[0] == b'fpr' and fingerprint is None:
+            fingerprint = fields[9].decode('ascii')
+        elif fields[0] == b'grp' and fingerprint is not None:
+            keygrips.setdefault(fingerprint, set()).add(
+                fields[9].decode('ascii'))
+    return keygrips
+
+
+class KeyringSync:
+    task: Optional['asyncio.Task[None]']
+
+    def __init__(self, source_dir: str, target_dir: str) -> None:
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+        self.manifest_path = os.path.join(target_dir, MANIFEST_NAME)
+        self.task = None
+        self.log = logging.getLogger('splitgpg2.KeyringSync')
+
+    def load_manifest(self) -> Optional[Tuple[List[Optional[int]],
+                                              Dict[str, str]]]:
+        """State of the source keyring at the last sync, and the digests of
+        the keys transferred then"""
+        try:
+            with open(self.manifest_path, encoding='utf-8') as manifest:
+                data = json.load(manifest)
+            return list(data['state']), dict(data['keys'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            self.log.warning('Ignoring broken keyring sync manifest %s: %s',
+                             self.manifest_path, e)
+            return None
+
+    def save_manifest(self, state: List[Optional[int]],
+                      keys: Dict[str, str]) -> None:
+        tmp_path = '{}.{}'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as manifest:
+            json.dump({'state': state, 'keys': keys}, manifest)
+        os.replace(tmp_path, self.manifest_path)
+
+    async def ensure(self) -> None:
+        """Make sure the keyring can be used: wait for the first sync, only
+        start one in the background when the source keyring changed"""
+        manifest = self.load_manifest()
+        if manifest is not None and \
+                manifest[0] == source_state(self.source_dir):
+            return
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or \
+                self.task.get_loop() is not loop:
+            self.task = asyncio.ensure_future(self.sync())
+            self.task.add_done_callback(self.sync_done)
+        if manifest is None:
+            await asyncio.shield(self.task)
+
+    def sync_done(self, task: 'asyncio.Task[None]') -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error('Keyring sync of %r failed: %s', self.target_dir,
+                           task.exception())
+
+    async def flush(self) -> None:
+        """Wait for a sync in progress"""
+        if self.task is not None and \
+                self.task.get_loop() is asyncio.get_running_loop():
+            await asyncio.wait([self.task])
+
+    async def list_keys(self, gnupghome: str) -> Dict[str, str]:
+        return key_digests(gnupghome, await self.list_secret_keys(gnupghome))
+
+    @staticmethod
+    async def list_secret_keys(gnupghome: str) -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            'gpg', '--homedir', gnupghome, '--batch', '--no-tty',
+            '--list-secret-keys', '--with-colons', '--with-keygrip',
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        stdout, _ = await proc.communicate()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(
+                proc.returncode, ['gpg', '--list-secret-keys'])
+        return stdout
+
+    async def delete_keys(self, gnupghome: str,
+                          fingerprints: Sequence[str]) -> None:
+        """Delete public keys from the copy in *gnupghome*, their secret
+        key files are not there"""
+        proc = await asyncio.create_subprocess_exec(
+            *XFER_FLAGS, '--yes', '--homedir', gnupghome,
+            '--delete-keys', *fingerprints,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+        _, stderr = await proc.communicate()
+        if proc.returncode:
+            self.log.warning('Unable to remove keys from %r: %s',
+                             self.target_dir, stderr)
+
+    async def transfer_keys(self, gnupghome: str,
+                            fingerprints: Sequence[str]) -> bool:
+        """Export secret subkeys of given keys from the source keyring, and
+        import them into *gnupghome* - streamed through a pipe"""
+        read_fd, write_fd = os.pipe()
+        try:
+            exporter = await asyncio.create_subprocess_exec(
+                *XFER_FLAGS, '--homedir', self.source_dir,
+                '--export-secret-subkeys', *fingerprints,
+                stdin=subprocess.DEVNULL, stdout=write_fd,
+                stderr=subprocess.PIPE)
+            os.close(write_fd)
+            write_fd = -1
+            importer = await asyncio.create_subprocess_exec(
+                *XFER_FLAGS, '--homedir', gnupghome, '--import',
+                stdin=read_fd, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        finally:
+            os.close(read_fd)
+            if write_fd != -1:
+                os.close(write_fd)
+        (_, export_err), (import_out, import_err) = await asyncio.gather(
+            exporter.communicate(), importer.communicate())
+        if exporter.returncode or importer.returncode:
+            self.log.warning('Unable to export keys.  If your key has a '
+                             'passphrase, you might want to save it to a '
+                             'file and use passphrase-file and '
+                             'pinentry-mode loopback in gpg.conf.')
+            self.log.warning("Exporter output: %s", export_err)
+            self.log.warning("Importer output: %s %s", import_out, import_err)
+            return False
+        return True
+
+    async def build(self, build_dir: str, deleted: Sequence[str],
+                    changed: Sequence[str]) -> bool:
+        """Prepare the new keyring in *build_dir*: a copy of the public
+        keyring in use without the *deleted* keys, and the *changed* keys
+        exported again from the source keyring, with their secret key files.
+        Return whether the export worked."""
+        # from scratch, when trying again without the changed keys
+        shutil.rmtree(os.path.join(build_dir, PRIVATE_KEYS_DIR),
+                      ignore_errors=True)
+        for name in PUBRING_FILES:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(build_dir, name))
+            with contextlib.suppress(FileNotFoundError):
+                shutil.copy2(os.path.join(self.target_dir, name),
+                             os.path.join(build_dir, name))
+        if deleted:
+            await self.delete_keys(build_dir, deleted)
+        return not changed or await self.transfer_keys(build_dir, changed)
+
+    def swap_in(self, build_dir: str, dropped: Set[str]) -> None:
+        """Move the keyring prepared in *build_dir* into place, then remove
+        the secret key files of the *dropped* keygrips"""
+        key_dir = os.path.join(self.target_dir, PRIVATE_KEYS_DIR)
+        os.makedirs(key_dir, 0o700, exist_ok=True)
+        build_key_dir = os.path.join(build_dir, PRIVATE_KEYS_DIR)
+        try:
+            key_files = [name for name in os.listdir(build_key_dir)
+                         if name.endswith('.key')]
+        except FileNotFoundError:
+            key_files = []
+        # secret parts first, so the new public keyring has them all
+        for name in key_files:
+            os.replace(os.path.join(build_key_dir, name),
+                       os.path.join(key_dir, name))
+        for name in PUBRING_FILES:
+            with contextlib.suppress(FileNotFoundError):
+                os.replace(os.path.join(build_dir, name),
+                           os.path.join(self.target_dir, name))
+        for keygrip in dropped:
+            if keygrip + '.key' in key_files:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(key_dir, keygrip + '.key'))
+
+    @staticmethod
+    async def kill_agent(gnupghome: str) -> None:
+        proc = await asyncio.create_subprocess_exec(
+            'gpgconf', '--homedir', gnupghome, '--kill', 'gpg-agent',
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        await proc.wait()
+
+    async def sync(self) -> None:
+        # taken before looking at the keys, so that changes made in the
+        # meantime trigger another sync
+        state = source_state(self.source_dir)
+        manifest = self.load_manifest()
+        synced = manifest[1] if manifest is not None else {}
+        source_keys = await self.list_keys(self.source_dir)
+        target_listing = await self.list_secret_keys(self.target_dir)
+        target_keys = key_digests(self.target_dir, target_listing)
+
+        changed = sorted(fpr for fpr, digest in source_keys.items()
+                         if synced.get(fpr) != digest or
+                         fpr not in target_keys)
+        removed = sorted(fpr for fpr in target_keys
+                         if fpr not in source_keys)
+        if not changed and not removed and manifest is not None:
+            self.save_manifest(state, synced)
+            return
+        self.log.info('Syncing subkeys-only keyring %r with original keyring '
+                      '%r: %d keys changed, %d removed', self.target_dir,
+                      self.source_dir, len(changed), len(removed))
+        # a changed key may have lost subkeys or user IDs, which an import
+        # would keep
+        stale = [fpr for fpr in changed if fpr in target_keys]
+        build_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(self.target_dir) + '.',
+            dir=os.path.dirname(self.target_dir))
+        try:
+            transferred = await self.build(build_dir, removed + stale,
+                                           changed)
+            if not transferred:
+                # keep the old versions of the changed keys
+                stale = []
+                if removed:
+                    await self.build(build_dir, removed, [])
+            if transferred or removed:
+                target_keygrips = key_keygrips(target_listing)
+                kept = {keygrip for fpr, keygrips in target_keygrips.items()
+                        if fpr not in removed and fpr not in stale
+                        for keygrip in keygrips}
+                self.swap_in(build_dir, {
+                    keygrip for fpr in removed + stale
+                    for keygrip in target_keygrips.get(fpr, ())} - kept)
+        finally:
+            await self.kill_agent(build_dir)
+            shutil.rmtree(build_dir, ignore_errors=True)
+        self.save_manifest(state, {
+            fpr: digest for fpr, digest in source_keys.items()
+            if transferred or fpr not in changed})
+        self.log.info('Subkey-only keyring %r synced', self.target_dir)
+
+_syncs: Dict[Tuple[str, str], KeyringSync] = {}
+
+
+def keyring_sync(source_dir: str, target_dir: str) -> KeyringSync:
+    """Sync of *target_dir* from *source_dir*, shared by all connections"""
+    try:
+        return _syncs[(source_dir, target_dir)]
+    except KeyError:
+        sync = _syncs[(source_dir, target_dir)] = \
+            KeyringSync(source_dir, target_dir)
+        return sync
+
+
+async def flush_keyring_syncs() -> None:
+    for sync in list(_syncs.values()):
+        await sync.flush()
@@ -0,0 +1,257 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Command counters and latency histograms (see the ``metrics_textfile``
+option), written in the Prometheus text format - for example for the
+textfile collector of node_exporter.
+
+The time of each command is split into phases (:py:data:`PHASES`): waiting
+for the agent, for the keygrip index (``gpg --list-secret-keys``), for the
+user to confirm, and for the client (inquired data, or the client reading
+the response). What is left is the time spent in the filter itself. Agent
+responses to pipelined commands are read when the pipeline is flushed, and
+are counted for the command flushing it.
+
+Every server process (each ``qubes.Gpg2`` call, or the server daemon) adds
+its counts to a state file next to the textfile (``<textfile>.state``,
+locked while updated) and writes the textfile again. The per-call server
+does it once when the connection ends, the daemon at most every
+:py:data:`FLUSH_DELAY` seconds.
+
+This module is imported only when metrics are enabled.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import bisect
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+#: parts of the command time, ``total`` is all of it
+PHASES = ('total', 'filter', 'keyindex', 'prompt', 'agent', 'client')
+
+#: histogram bucket upper bounds, in seconds - waiting for the user can
+#: take long
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: seconds between textfile updates of a long-running process
+FLUSH_DELAY = 10.0
+
+STATE_VERSION = 1
+
+CounterKey = Tuple[str, str, str]
+
+
+class CommandTiming:
+    """Phases of a command being handled"""
+    __slots__ = ('command', 'start', 'phases')
+
+    def __init__(self, command: str) -> None:
+        self.command = command
+        self.start = time.perf_counter()
+        #: seconds spent in each phase other than ``total`` and ``filter``
+        self.phases = dict.fromkeys(PHASES[2:], 0.0)
+
+    def add(self, phase: str, start: float) -> None:
+        """Count the time since *start* (:py:func:`time.perf_counter`) for
+        *phase*"""
+        self.phases[phase] += time.perf_counter() - start
+
+
+class Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self, buckets: Optional[List[int]] = None,
+                 total: float = 0.0, count: int = 0) -> None:
+        #: observations in each bucket (not cumulative), the last one is
+        #: above all :py:data:`BUCKETS`
+        self.buckets = buckets or [0] * (len(BUCKETS) + 1)
+        self.sum = total
+        self.count = count
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram') -> None:
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(commands: Dict[CounterKey, int],
+           histograms: Dict[CounterKey, Histogram]) -> str:
+    """Metrics in the Prometheus text format"""
+    lines = [
+        '# HELP splitgpg2_commands_total Commands handled, by result: ok '
+        '(passed to the agent or answered, whatever the agent responded), '
+        'filtered or error.',
+        '# TYPE splitgpg2_commands_total counter',
+    ]
+    for (command, client, result), count in sorted(commands.items()):
+        lines.append(
+            'splitgpg2_commands_total{{command="{}",client="{}",'
+            'result="{}"}} {}'.format(
+                _label(command), _label(client), _label(result), count))
+    lines += [
+        '# HELP splitgpg2_command_duration_seconds Time handling commands '
+        'took, by phase.',
+        '# TYPE splitgpg2_command_duration_seconds histogram',
+    ]
+    for (command, client, phase), histogram in sorted(histograms.items()):
+        labels = 'command="{}",client="{}",phase="{}"'.format(
+            _label(command), _label(client), _label(phase))
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),),
+                                histogram.buckets):
+            cumulative += count
+            lines.append(
+                'splitgpg2_command_duration_seconds_bucket{{{},le="{}"}} {}'
+                .format(labels, '+Inf' if bound == float('inf')
+                        else repr(bound), cumulative))
+        lines.append('splitgpg2_command_duration_seconds_sum{{{}}} {!r}'
+                     .format(labels, histogram.sum))
+        lines.append('splitgpg2_command_duration_seconds_count{{{}}} {}'
+                     .format(labels, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """Counts of this process not written out yet, for one textfile"""
+    commands: Dict[CounterKey, int]
+    histograms: Dict[CounterKey, Histogram]
+    flush_handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self, path: str) -> None:
+        #: the textfile
+        self.path = path
+        self.state_path = path + '.state'
+        self.commands = {}
+        self.histograms = {}
+        self.flush_handle = None
+        self.log = logging.getLogger('splitgpg2.Metrics')
+
+    def observe(self, timing: CommandTiming, client_domain: str,
+                result: str) -> None:
+        total = time.perf_counter() - timing.start
+        key = (timing.command, client_domain, result)
+        self.commands[key] = self.commands.get(key, 0) + 1
+        phases = dict(timing.phases)
+        phases['total'] = total
+        phases['filter'] = max(0.0, total - sum(timing.phases.values()))
+        for phase, value in phases.items():
+            hkey = (timing.command, client_domain, phase)
+            histogram = self.histograms.get(hkey)
+            if histogram is None:
+                histogram = self.histograms[hkey] = Histogram()
+            histogram.observe(value)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                FLUSH_DELAY, self.flush)
+
+    def flush(self) -> None:
+        """Add the counts to the state file and write the textfile"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.commands:
+            return
+        tmp_path = '{}.{}'.format(self.path, os.getpid())
+        try:
+            with open(self.state_path, 'a+', encoding='utf-8') as state_file:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+                state_file.seek(0)
+                commands, histograms = _parse_state(state_file.read())
+                for key, count in self.commands.items():
+                    commands[key] = commands.get(key, 0) + count
+                for key, histogram in self.histograms.items():
+                    if key in histograms:
+                        histograms[key].merge(histogram)
+                    else:
+                        histograms[key] = histogram
+                with open(tmp_path, 'w', encoding='utf-8') as textfile:
+                    textfile.write(render(commands, histograms))
+                os.replace(tmp_path, self.path)
+                state_file.seek(0)
+                state_file.truncate()
+                json.dump({
+                    'version': STATE_VERSION,
+                    'commands': [[*key, count]
+                                 for key, count in commands.items()],
+                    'histograms': [
+                        [*key, h.buckets, h.sum, h.count]
+                        for key, h in histograms.items()],
+                }, state_file)
+        except OSError as e:
+            # keep the counts, to try again next time
+            self.log.warning('Failed to write metrics to %s: %s',
+                             self.path, e)
+            return
+        self.commands = {}
+        self.histograms = {}
+
+
+def _parse_state(data: str) -> \
+        Tuple[Dict[CounterKey, int], Dict[CounterKey, Histogram]]:
+    try:
+        state = json.loads(data)
+        if state['version'] != STATE_VERSION:
+            raise ValueError('unknown version')
+        commands = {(command, client, result): int(count)
+                    for command, client, result, count in state['commands']}
+        histograms = {}
+        for command, client, phase, buckets, total, count in \
+                state['histograms']:
+            if len(buckets) != len(BUCKETS) + 1:
+                raise ValueError('buckets changed')
+            histograms[(command, client, phase)] = Histogram(
+                [int(c) for c in buckets], float(total), int(count))
+        return commands, histograms
+    except (ValueError, TypeError, KeyError):
+        # missing or broken (for example written only partially) - start
+        # over, counters in Prometheus can be reset
+        return {}, {}
+
+
+_metrics: Dict[str, Metrics] = {}
+
+
+def metrics(path: str) -> Metrics:
+    """Metrics written to *path*, shared by all connections"""
+    try:
+        return _metrics[path]
+    except KeyError:
+        instance = _metrics[path] = Metrics(path)
+        return instance
+
+
+def flush_metrics() -> None:
+    for instance in _metrics.values():
+        instance.flush()
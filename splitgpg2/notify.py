@@ -0,0 +1,521 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Desktop notifications.
+
+Notifications are sent with the ``Notify`` method of
+org.freedesktop.Notifications, over one session bus connection kept for the
+whole process, instead of starting notify-send for each of them. Only the
+few types of the D-Bus wire format these calls need are implemented here.
+When there is no session bus, or the call fails, notify-send is started in
+the background instead.
+
+Bursts of the same notification are coalesced: when the same message for the
+same qube is repeated within :py:data:`COALESCE_WINDOW` seconds, the already
+shown notification is replaced (``replaces_id`` of ``Notify``) with one that
+includes a counter. notify-send does the same with ``--print-id`` and
+``--replace-id`` (libnotify 0.7.9 or later). With an older notify-send, the
+updates are shown as new notifications.
+"""
+
+# pylint: disable=missing-function-docstring,consider-using-f-string
+
+import asyncio
+import logging
+import os
+import struct
+import subprocess
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+COALESCE_WINDOW = 5.0
+#: how long to wait for the bus (or the notification daemon) to respond
+CALL_TIMEOUT = 5.0
+
+BUS_NAME = 'org.freedesktop.DBus'
+BUS_PATH = '/org/freedesktop/DBus'
+NOTIFICATIONS_NAME = 'org.freedesktop.Notifications'
+NOTIFICATIONS_PATH = '/org/freedesktop/Notifications'
+
+#: the limit of the D-Bus specification
+MAX_MESSAGE_SIZE = 128 * 1024 * 1024
+
+# message types
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+# header fields, and their types
+FIELD_PATH = 1
+FIELD_INTERFACE = 2
+FIELD_MEMBER = 3
+FIELD_ERROR_NAME = 4
+FIELD_REPLY_SERIAL = 5
+FIELD_DESTINATION = 6
+FIELD_SIGNATURE = 8
+FIELD_TYPES = {
+    FIELD_PATH: 'o',
+    FIELD_INTERFACE: 's',
+    FIELD_MEMBER: 's',
+    FIELD_ERROR_NAME: 's',
+    FIELD_REPLY_SERIAL: 'u',
+    FIELD_DESTINATION: 's',
+    FIELD_SIGNATURE: 'g',
+}
+
+HeaderFields = Dict[int, Union[str, int]]
+
+
+class DBusError(Exception):
+    """Error reply"""
+
+
+class Marshaller:
+    """Writes values in the little-endian D-Bus wire format"""
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def align(self, alignment: int) -> None:
+        self.data.extend(b'\0' * (-len(self.data) % alignment))
+
+    def byte(self, value: int) -> None:
+        self.data.append(value)
+
+    def uint32(self, value: int) -> None:
+        self.align(4)
+        self.data += struct.pack('<I', value)
+
+    def int32(self, value: int) -> None:
+        self.align(4)
+        self.data += struct.pack('<i', value)
+
+    def string(self, value: str) -> None:
+        encoded = value.encode('utf-8')
+        self.uint32(len(encoded))
+        self.data += encoded + b'\0'
+
+    def signature(self, value: str) -> None:
+        self.byte(len(value))
+        self.data += value.encode('ascii') + b'\0'
+
+    def empty_array(self, element_alignment: int) -> None:
+        self.uint32(0)
+        self.align(element_alignment)
+
+
+class Unmarshaller:
+    """Reads values in the D-Bus wire format, *offset* from the start of
+    the message"""
+    def __init__(self, data: bytes, offset: int, endian: str) -> None:
+        self.data = data
+        self.offset = offset
+        self.endian = endian
+
+    def align(self, alignment: int) -> None:
+        self.offset += -self.offset % alignment
+
+    def byte(self) -> int:
+        if self.offset >= len(self.data):
+            raise ValueError('truncated D-Bus message')
+        self.offset += 1
+        return self.data[self.offset - 1]
+
+    def uint32(self) -> int:
+        self.align(4)
+        try:
+            (value,) = struct.unpack_from(self.endian + 'I', self.data,
+                                          self.offset)
+        except struct.error as e:
+            raise ValueError('truncated D-Bus message') from e
+        self.offset += 4
+        return int(value)
+
+    def raw(self, length: int) -> bytes:
+        end = self.offset + length
+        if end >= len(self.data) or self.data[end] != 0:
+            raise ValueError('malformed D-Bus string')
+        value = self.data[self.offset:end]
+        self.offset = end + 1
+        return value
+
+    def string(self) -> str:
+        return self.raw(self.uint32()).decode('utf-8')
+
+    def signature(self) -> str:
+        return self.raw(self.byte()).decode('ascii')
+
+
+class Message(NamedTuple):
+    type: int
+    serial: int
+    fields: HeaderFields
+    #: positioned at the start of the body
+    body: Unmarshaller
+
+
+def message(msg_type: int, serial: int, fields: HeaderFields,
+            body: bytes = b'') -> bytes:
+    header = Marshaller()
+    for header_byte in (ord('l'), msg_type, 0, 1):
+        header.byte(header_byte)
+    header.uint32(len(body))
+    header.uint32(serial)
+    # a(yv), its length doesn't include the padding before the first field
+    header.uint32(0)
+    header.align(8)
+    start = len(header.data)
+    for code, value in fields.items():
+        header.align(8)
+        header.byte(code)
+        header.signature(FIELD_TYPES[code])
+        if isinstance(value, int):
+            header.uint32(value)
+        elif FIELD_TYPES[code] == 'g':
+            header.signature(value)
+        else:
+            header.string(value)
+    struct.pack_into('<I', header.data, 12, len(header.data) - start)
+    header.align(8)
+    return bytes(header.data) + body
+
+
+def parse_message(data: bytes) -> Message:
+    if data[:1] not in (b'l', b'B'):
+        raise ValueError('invalid D-Bus endianness marker')
+    reader = Unmarshaller(data, 4, '<' if data[:1] == b'l' else '>')
+    reader.uint32()
+    serial = reader.uint32()
+    fields_end = reader.uint32() + 16
+    fields: HeaderFields = {}
+    while reader.offset < fields_end:
+        reader.align(8)
+        code = reader.byte()
+        type_code = reader.signature()
+        if type_code == 'u':
+            fields[code] = reader.uint32()
+        elif type_code == 'g':
+            fields[code] = reader.signature()
+        elif type_code in ('s', 'o'):
+            fields[code] = reader.string()
+        else:
+            raise ValueError('unexpected D-Bus header field type')
+    reader.align(8)
+    return Message(data[1], serial, fields, reader)
+
+
+async def read_message(reader: asyncio.StreamReader) -> Message:
+    header = await reader.readexactly(16)
+    endian = '>' if header[:1] == b'B' else '<'
+    body_length, _, fields_length = struct.unpack_from(endian + 'III',
+                                                       header, 4)
+    fields_end = 16 + fields_length
+    length = fields_end + (-fields_end % 8) + body_length
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError('D-Bus message too long')
+    return parse_message(header + await reader.readexactly(length - 16))
+
+
+class DBusConnection:
+    """Connection to the session bus, just for calling methods"""
+    pending: Dict[int, 'asyncio.Future[Message]']
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.serial = 0
+        self.pending = {}
+        self.read_task = asyncio.ensure_future(self.read_messages())
+
+    @classmethod
+    async def open(cls, path: str) -> 'DBusConnection':
+        reader, writer = await asyncio.open_unix_connection(path)
+        try:
+            uid = str(os.getuid()).encode('ascii').hex().encode('ascii')
+            writer.write(b'\0AUTH EXTERNAL ' + uid + b'\r\n')
+            response = await reader.readline()
+            if not response.startswith(b'OK '):
+                raise ConnectionRefusedError(
+                    'D-Bus authentication rejected: {!r}'.format(response))
+            writer.write(b'BEGIN\r\n')
+        except BaseException:
+            writer.close()
+            raise
+        connection = cls(reader, writer)
+        try:
+            await connection.call(BUS_NAME, BUS_PATH, 'Hello')
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    @property
+    def closed(self) -> bool:
+        return self.read_task.done()
+
+    def close(self) -> None:
+        self.read_task.cancel()
+        self.writer.close()
+
+    async def call(self, service: str, path: str, member: str,
+                   signature: str = '', body: bytes = b'') -> Message:
+        """Call *member* of the interface named like the *service*"""
+        if self.closed:
+            raise ConnectionResetError('D-Bus connection closed')
+        self.serial += 1
+        serial = self.serial
+        fields: HeaderFields = {
+            FIELD_PATH: path,
+            FIELD_INTERFACE: service,
+            FIELD_MEMBER: member,
+            FIELD_DESTINATION: service,
+        }
+        if signature:
+            fields[FIELD_SIGNATURE] = signature
+        reply: 'asyncio.Future[Message]' = \
+            asyncio.get_running_loop().create_future()
+        self.pending[serial] = reply
+        try:
+            self.writer.write(message(METHOD_CALL, serial, fields, body))
+            return await reply
+        finally:
+            del self.pending[serial]
+
+    async def read_messages(self) -> None:
+        error: Exception = ConnectionResetError('D-Bus connection closed')
+        try:
+            while True:
+                msg = await read_message(self.reader)
+                # signals (like NameAcquired) are not interesting
+                reply = self.pending.get(
+                    int(msg.fields.get(FIELD_REPLY_SERIAL, 0)))
+                if reply is None or reply.done():
+                    continue
+                if msg.type == ERROR:
+                    reply.set_exception(
+                        DBusError(msg.fields.get(FIELD_ERROR_NAME)))
+                elif msg.type == METHOD_RETURN:
+                    reply.set_result(msg)
+        except (OSError, EOFError, ValueError) as e:
+            error = e
+        finally:
+            for reply in self.pending.values():
+                if not reply.done():
+                    reply.set_exception(error)
+            self.writer.close()
+
+
+def session_bus_path() -> Optional[str]:
+    """Socket path of the session bus, ``None`` if there is none"""
+    # pylint: disable=import-outside-toplevel
+    from . import runtime_dir
+    address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+    if address is None:
+        path = os.path.join(runtime_dir(), 'bus')
+        return path if os.path.exists(path) else None
+    for transport in address.split(';'):
+        method, _, params = transport.partition(':')
+        if method != 'unix':
+            continue
+        for param in params.split(','):
+            key, _, value = param.partition('=')
+            if key == 'path':
+                return unescape_address(value)
+            if key == 'abstract':
+                return '\0' + unescape_address(value)
+    return None
+
+
+def unescape_address(value: str) -> str:
+    """Undo the %-escaping of D-Bus address values"""
+    parts = value.split('%')
+    unescaped = [parts[0].encode('utf-8')]
+    for part in parts[1:]:
+        unescaped.append(bytes.fromhex(part[:2]) + part[2:].encode('utf-8'))
+    return b''.join(unescaped).decode('utf-8', 'surrogateescape')
+
+
+class Burst:
+    """Repetitions of the same notification, shown as a single one"""
+    __slots__ = ('start', 'count', 'shown', 'notification_id', 'task')
+
+    def __init__(self, start: float) -> None:
+        self.start = start
+        #: number of notify() calls
+        self.count = 0
+        #: count already displayed
+        self.shown = 0
+        self.notification_id = 0
+        #: task updating the displayed notification, if running
+        self.task: Optional['asyncio.Task[None]'] = None
+
+
+class Notifier:
+    recent: Dict[Tuple[str, str], Burst]
+    tasks: Set['asyncio.Task[None]']
+    #: opening (or open) session bus connection
+    connection: Optional['asyncio.Task[DBusConnection]']
+    loop: Optional[asyncio.AbstractEventLoop]
+
+    def __init__(self, window: float = COALESCE_WINDOW) -> None:
+        self.window = window
+        self.recent = {}
+        self.tasks = set()
+        self.connection = None
+        #: whether notify-send knows --print-id and --replace-id
+        self.replace_supported = True
+        self.loop = None
+        self.log = logging.getLogger('splitgpg2.Notifier')
+
+    def notify(self, msg: str, client_domain: str) -> None:
+        """Show a notification about *msg*, without waiting for it"""
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # the connection and tasks are bound to the event loop
+            self.loop = loop
+            self.connection = None
+            self.recent.clear()
+            self.tasks = set()
+        now = loop.time()
+        self.recent = {key: burst for key, burst in self.recent.items()
+                       if now - burst.start <= self.window or burst.task}
+        key = (msg, client_domain)
+        burst = self.recent.get(key)
+        if burst is None or now - burst.start > self.window:
+            burst = self.recent[key] = Burst(now)
+        burst.count += 1
+        if burst.task is None:
+            burst.task = asyncio.ensure_future(self.show(key, burst))
+            self.tasks.add(burst.task)
+            burst.task.add_done_callback(self.tasks.discard)
+
+    def summary(self, msg: str, count: int) -> str:
+        if count == 1:
+            return 'split-gpg2: {}'.format(msg)
+        return 'split-gpg2: {} ({} times in the last {:g} s)'.format(
+            msg, count, self.window)
+
+    async def show(self, key: Tuple[str, str], burst: Burst) -> None:
+        msg, client_domain = key
+        try:
+            # notify() calls made meanwhile are shown together by the
+            # next update
+            while burst.shown < burst.count:
+                count = burst.count
+                burst.notification_id = await self.send(
+                    self.summary(msg, count),
+                    "qube '{}'".format(client_domain),
+                    burst.notification_id)
+                burst.shown = count
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.warning('Failed to show notification: %s', e)
+        finally:
+            burst.task = None
+
+    async def connect(self) -> DBusConnection:
+        task = self.connection
+        if task is None or task.done() and (
+                task.cancelled() or task.exception() is not None or
+                task.result().closed):
+            path = session_bus_path()
+            if path is None:
+                raise ConnectionRefusedError('no session bus')
+            task = self.connection = asyncio.ensure_future(
+                asyncio.wait_for(DBusConnection.open(path), CALL_TIMEOUT))
+        # shared by all notifications, don't let one of them cancel it
+        return await asyncio.shield(task)
+
+    async def send(self, summary: str, body: str, replaces_id: int) -> int:
+        """Show or update a notification, return its ID (0 if unknown)"""
+        try:
+            connection = await self.connect()
+            args = Marshaller()
+            args.string('split-gpg2')
+            args.uint32(replaces_id)
+            # icon
+            args.string('')
+            args.string(summary)
+            args.string(body)
+            # actions (as), hints (a{sv})
+            args.empty_array(4)
+            args.empty_array(8)
+            # expiration timeout: the server's default
+            args.int32(-1)
+            reply = await asyncio.wait_for(connection.call(
+                NOTIFICATIONS_NAME, NOTIFICATIONS_PATH, 'Notify',
+                'susssasa{sv}i', bytes(args.data)), CALL_TIMEOUT)
+            return reply.body.uint32()
+        except (OSError, ValueError, DBusError, asyncio.TimeoutError) as e:
+            self.log.debug('D-Bus notification failed, using notify-send: %r',
+                           e)
+        # notification IDs are the same for both
+        return await self.notify_send(summary, body, replaces_id)
+
+    async def notify_send(self, summary: str, body: str,
+                          replaces_id: int) -> int:
+        args: List[str] = ['--app-name=split-gpg2']
+        if self.replace_supported:
+            args.append('--print-id')
+            if replaces_id:
+                args.append('--replace-id={}'.format(replaces_id))
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'notify-send', *args, summary, body,
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            return 0
+        stdout, stderr = await proc.communicate()
+        if proc.returncode and self.replace_supported and (
+                b'--print-id' in stderr or b'--replace-id' in stderr):
+            self.log.debug('notify-send cannot replace notifications')
+            self.replace_supported = False
+            return await self.notify_send(summary, body, 0)
+        try:
+            return int(stdout.split(b'\n', 1)[0])
+        except ValueError:
+            return 0
+
+    async def close(self) -> None:
+        """Close the session bus connection"""
+        task, self.connection = self.connection, None
+        if task is None or self.loop is not asyncio.get_running_loop():
+            return
+        # if still opening
+        task.cancel()
+        await asyncio.wait([task])
+        if not task.cancelled() and task.exception() is None:
+            connection = task.result()
+            connection.close()
+            await asyncio.wait([connection.read_task])
+
+    async def flush(self, timeout: float) -> None:
+        """Wait (up to *timeout* seconds) for pending notifications"""
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+
+_notifier: Optional[Notifier] = None  # pylint: disable=invalid-name
+
+
+def notifier() -> Notifier:
+    """Notifier shared by all connections"""
+    global _notifier  # pylint: disable=global-statement
+    if _notifier is None:
+        _notifier = Notifier()
+    return _notifier
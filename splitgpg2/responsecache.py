@@ -0,0 +1,99 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Cache of agent responses to read-only queries (GETINFO, HAVEKEY, KEYINFO),
+which clients tend to repeat a lot.
+
+Responses are stored as the exact lines the agent sent, to be replayed to
+the client. An entry is valid for :py:data:`TTL` seconds, and only as long as
+the keyring it was made for didn't change (see
+:py:meth:`splitgpg2.keyindex.KeygripIndex.current_state`).
+"""
+
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+TTL = 5.0
+MAX_ENTRIES = 1024
+
+# Errors that are a definite answer, not a failure (gpg-error codes):
+# GPG_ERR_NO_SECKEY, GPG_ERR_NOT_FOUND
+CACHEABLE_ERRORS = (17, 27)
+
+CacheKey = Tuple[str, bytes, Optional[bytes]]
+KeyringState = Sequence[Optional[int]]
+
+
+def cacheable(lines: Sequence[bytes]) -> bool:
+    """Whether a complete response (as recorded) can be cached"""
+    if not lines:
+        return False
+    last = lines[-1]
+    if last == b'OK\n' or last.startswith(b'OK '):
+        return True
+    if last.startswith(b'ERR '):
+        try:
+            code = int(last.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            return False
+        return code & 0xffff in CACHEABLE_ERRORS
+    return False
+
+
+class ResponseCache:
+    entries: Dict[CacheKey, Tuple[float, KeyringState, List[bytes]]]
+
+    def __init__(self, ttl: float = TTL) -> None:
+        self.ttl = ttl
+        self.entries = {}
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def get(self, key: CacheKey, state: KeyringState) -> Optional[List[bytes]]:
+        try:
+            expires, entry_state, lines = self.entries[key]
+        except KeyError:
+            return None
+        if expires <= time.monotonic() or entry_state != state:
+            del self.entries[key]
+            return None
+        return lines
+
+    def put(self, key: CacheKey, state: KeyringState,
+            lines: List[bytes]) -> None:
+        if not cacheable(lines):
+            return
+        now = time.monotonic()
+        if len(self.entries) >= MAX_ENTRIES:
+            self.entries = {k: entry for k, entry in self.entries.items()
+                            if entry[0] > now}
+            if len(self.entries) >= MAX_ENTRIES:
+                self.entries.clear()
+        self.entries[key] = (now + self.ttl, list(state), lines)
+
+
+_cache: Optional[ResponseCache] = None  # pylint: disable=invalid-name
+
+
+def response_cache() -> ResponseCache:
+    """Response cache shared by all connections"""
+    global _cache  # pylint: disable=global-statement
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import tempfile
+from typing import List
+from unittest import TestCase
+
+from .agentpool import AgentConnectionPool
+from .assuan import AssuanLineReader
+
+
+class TC_AgentConnectionPool(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.socket_path = self.tmp_dir.name + '/S.gpg-agent'
+        self.commands: List[bytes] = []
+        self.agent_writers: List[asyncio.StreamWriter] = []
+        server = self.loop.run_until_complete(asyncio.start_unix_server(
+            self.fake_agent, self.socket_path))
+        def cleanup() -> None:
+            server.close()
+            for writer in self.agent_writers:
+                writer.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.addCleanup(cleanup)
+
+    async def fake_agent(self, reader: asyncio.StreamReader,
+                         writer: asyncio.StreamWriter) -> None:
+        self.agent_writers.append(writer)
+        writer.write(b'OK Pleased to meet you\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.commands.append(line)
+            writer.write(b'OK\n')
+        writer.close()
+
+    @staticmethod
+    async def handshake(reader: AssuanLineReader) -> bytes:
+        line = await reader.readline()
+        assert line.startswith(b'OK ')
+        return line
+
+    def test_000_reuse(self) -> None:
+        pool = AgentConnectionPool(self.socket_path, self.handshake)
+        async def go() -> None:
+            conn = await pool.acquire()
+            pool.release(conn)
+            await asyncio.sleep(0.05)
+            self.assertIs(await pool.acquire(), conn)
+            # not returned, as it's in use
+            other = await pool.acquire()
+            self.assertIsNot(other, conn)
+            pool.release(conn)
+            pool.discard(other)
+            await asyncio.sleep(0.05)
+        self.loop.run_until_complete(go())
+        self.assertEqual(self.commands, [b'RESET\n', b'RESET\n'])
+        self.assertEqual(len(self.agent_writers), 2)
+        pool.close()
+
+    def test_001_health_check(self) -> None:
+        pool = AgentConnectionPool(self.socket_path, self.handshake)
+        async def go() -> None:
+            conn = await pool.acquire()
+            pool.release(conn)
+            await asyncio.sleep(0.05)
+            # agent restart
+            self.agent_writers[0].close()
+            await asyncio.sleep(0.05)
+            self.assertIsNot(await pool.acquire(), conn)
+        self.loop.run_until_complete(go())
+        pool.close()
+
+    def test_002_idle_eviction(self) -> None:
+        pool = AgentConnectionPool(self.socket_path, self.handshake,
+                                   idle_timeout=0.1)
+        async def go() -> None:
+            conn = await pool.acquire()
+            pool.release(conn)
+            await asyncio.sleep(0.05)
+            self.assertEqual(pool.idle, [conn])
+            await asyncio.sleep(0.2)
+            self.assertEqual(pool.idle, [])
+            self.assertTrue(conn.writer.is_closing())
+        self.loop.run_until_complete(go())
+        pool.close()
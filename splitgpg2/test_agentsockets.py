@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import socket
+import tempfile
+import time
+from unittest import TestCase
+
+from .agentsockets import AgentSocketCache, AgentSockets
+
+
+class TC_AgentSocketCache(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp_dir.name + '/cache/agent-sockets.json'
+        self.sockets = AgentSockets(self.tmp_dir.name + '/S.gpg-agent',
+                                    self.tmp_dir.name + '/S.gpg-agent.extra')
+        self.agent_socket = self.bind()
+
+    def tearDown(self) -> None:
+        self.agent_socket.close()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def bind(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.sockets.socket)
+        return sock
+
+    def test_000_persistent(self) -> None:
+        cache = AgentSocketCache(self.cache_path)
+        self.assertIsNone(cache.get('/home'))
+        cache.put('/home', self.sockets)
+        self.assertEqual(cache.get('/home'), self.sockets)
+        # another process
+        cache = AgentSocketCache(self.cache_path)
+        self.assertEqual(cache.get('/home'), self.sockets)
+        self.assertIsNone(cache.get('/other-home'))
+        cache.invalidate('/home')
+        self.assertIsNone(AgentSocketCache(self.cache_path).get('/home'))
+
+    def test_001_agent_restart(self) -> None:
+        cache = AgentSocketCache(self.cache_path)
+        cache.put('/home', self.sockets)
+        self.agent_socket.close()
+        os.unlink(self.sockets.socket)
+        self.assertIsNone(cache.get('/home'))
+        # same path, but a new socket
+        time.sleep(0.01)
+        self.agent_socket = self.bind()
+        self.assertIsNone(cache.get('/home'))
+        self.assertIsNone(AgentSocketCache(self.cache_path).get('/home'))
+
+    def test_002_memory_only(self) -> None:
+        cache = AgentSocketCache(None)
+        cache.put('/home', self.sockets)
+        self.assertEqual(cache.get('/home'), self.sockets)
+        self.assertFalse(os.path.exists(self.cache_path))
@@ -0,0 +1,83 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+from typing import List
+from unittest import TestCase
+
+from .assuan import AssuanLineReader, LINE_LIMIT
+
+
+class TC_AssuanLineReader(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def read_all(self, chunks: List[bytes], chunk_size: int) -> List[bytes]:
+        async def go() -> List[bytes]:
+            stream = asyncio.StreamReader()
+            for chunk in chunks:
+                stream.feed_data(chunk)
+            stream.feed_eof()
+            reader = AssuanLineReader(stream, chunk_size)
+            result: List[bytes] = []
+            while True:
+                lines = await reader.read_lines()
+                if not lines:
+                    self.assertTrue(reader.at_eof())
+                    return result
+                result.extend(lines)
+        return self.loop.run_until_complete(go())
+
+    def test_000_split(self) -> None:
+        data = b'OK hello\nD ' + b'x' * 100 + b'\nS PROGRESS\n\nOK\n'
+        for chunk_size in (1, 3, 7, 64, 4096):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read_all([data], chunk_size),
+                                 [b'OK hello', b'D ' + b'x' * 100,
+                                  b'S PROGRESS', b'', b'OK'])
+
+    def test_001_incomplete_at_eof(self) -> None:
+        self.assertEqual(self.read_all([b'OK\nERR 1'], 4), [b'OK', b'ERR 1'])
+        async def go() -> None:
+            stream = asyncio.StreamReader()
+            stream.feed_data(b'OK\nERR')
+            stream.feed_eof()
+            reader = AssuanLineReader(stream)
+            self.assertEqual(await reader.readline(), b'OK\n')
+            self.assertEqual(await reader.readline(), b'ERR')
+            self.assertEqual(await reader.readline(), b'')
+        self.loop.run_until_complete(go())
+
+    def test_002_unread(self) -> None:
+        async def go() -> None:
+            stream = asyncio.StreamReader()
+            stream.feed_data(b'D 1\nD 2\nOK\n')
+            reader = AssuanLineReader(stream)
+            lines = await reader.read_lines()
+            self.assertEqual(lines, [b'D 1', b'D 2', b'OK'])
+            reader.unread(lines[1:])
+            self.assertEqual(await reader.readline(), b'D 2\n')
+            stream.feed_data(b'D 3\n')
+            self.assertEqual(await reader.read_lines(), [b'OK'])
+            self.assertEqual(await reader.read_lines(), [b'D 3'])
+        self.loop.run_until_complete(go())
+
+    def test_003_line_limit(self) -> None:
+        with self.assertRaises(ValueError):
+            self.read_all([b'D ' + b'x' * LINE_LIMIT], 4096)
@@ -0,0 +1,113 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from .autoaccept import AutoacceptStore, Grant
+
+
+class TC_AutoacceptStore(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.socket_path = self.tmp_dir.name + '/S.gpg-agent.extra'
+
+    def test_000_persistent(self) -> None:
+        store = AutoacceptStore()
+        timestamp_path = (self.socket_path +
+                          '_split-gpg2-timestamp_PKSIGN_test_vm')
+        async def go() -> None:
+            self.assertIsNone(
+                store.granted_at(self.socket_path, 'PKSIGN', 'test_vm'))
+            store.grant(self.socket_path, 'PKSIGN', 'test_vm', 1000000.0)
+            await store.flush()
+        self.loop.run_until_complete(go())
+        # same format as always, to survive restarts and updates
+        self.assertEqual(os.stat(timestamp_path).st_mtime, 1000000.0)
+
+        # after restart
+        store = AutoacceptStore()
+        self.assertEqual(
+            store.granted_at(self.socket_path, 'PKSIGN', 'test_vm'),
+            1000000.0)
+        # removing the file by hand revokes it
+        os.unlink(timestamp_path)
+        self.assertIsNone(
+            store.granted_at(self.socket_path, 'PKSIGN', 'test_vm'))
+        self.assertEqual(store.list('test_vm'), [])
+        # and so does touching it extend it
+        with open(timestamp_path, 'w', encoding='ascii'):
+            pass
+        os.utime(timestamp_path, (2000000.0, 2000000.0))
+        self.assertEqual(
+            store.granted_at(self.socket_path, 'PKSIGN', 'test_vm'),
+            2000000.0)
+
+    def test_001_list_revoke(self) -> None:
+        store = AutoacceptStore()
+        async def go() -> None:
+            store.grant(self.socket_path, 'PKSIGN', 'vm1', 1000.0)
+            store.grant(self.socket_path, 'PKDECRYPT', 'vm1', 2000.0)
+            store.grant(self.socket_path, 'PKSIGN', 'vm2', 3000.0)
+            await store.flush()
+        self.loop.run_until_complete(go())
+
+        # a restarted store picks up approvals from disk
+        store = AutoacceptStore()
+        store.granted_at(self.socket_path, 'PKSIGN', 'vm2')
+        self.assertEqual(store.list('vm1'), [
+            Grant(self.socket_path, 'PKDECRYPT', 'vm1', 2000.0),
+            Grant(self.socket_path, 'PKSIGN', 'vm1', 1000.0),
+        ])
+        async def revoke() -> None:
+            self.assertEqual(store.revoke('vm1', 'PKSIGN'), [
+                Grant(self.socket_path, 'PKSIGN', 'vm1', 1000.0)])
+            await store.flush()
+        self.loop.run_until_complete(revoke())
+        self.assertEqual(store.list('vm1'), [
+            Grant(self.socket_path, 'PKDECRYPT', 'vm1', 2000.0)])
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), [
+            'S.gpg-agent.extra_split-gpg2-timestamp_PKDECRYPT_vm1',
+            'S.gpg-agent.extra_split-gpg2-timestamp_PKSIGN_vm2',
+        ])
+
+    def test_002_unsaved(self) -> None:
+        store = AutoacceptStore()
+        async def go() -> None:
+            with mock.patch('splitgpg2.autoaccept._write_timestamp',
+                            side_effect=lambda *args: time.sleep(0.1)):
+                store.grant(self.socket_path, 'PKSIGN', 'vm1', 1000.0)
+                # not on disk yet
+                self.assertEqual(
+                    store.granted_at(self.socket_path, 'PKSIGN', 'vm1'),
+                    1000.0)
+                store.clear()
+                self.assertEqual(store.list('vm1'), [
+                    Grant(self.socket_path, 'PKSIGN', 'vm1', 1000.0)])
+                await store.flush()
+            self.assertEqual(store.unsaved, {})
+            self.assertIsNone(
+                store.granted_at(self.socket_path, 'PKSIGN', 'vm1'))
+        self.loop.run_until_complete(go())
@@ -0,0 +1,280 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import os
+import sys
+import tempfile
+from typing import Callable, List, Tuple
+from unittest import TestCase
+
+from .client import ClientAgent, serve
+
+# Stands in for a qubes.Gpg2 call: a minimal Assuan server, logging what it
+# gets
+FAKE_SERVER = r'''
+import os, sys
+log = open(sys.argv[1], 'a', buffering=1)
+log.write('open %d\n' % os.getpid())
+def send(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+send('OK Pleased to meet you')
+for line in sys.stdin:
+    line = line.rstrip('\n')
+    log.write(line + '\n')
+    if line == 'GETINFO pid':
+        send('D %d' % os.getpid())
+        send('OK')
+    elif line == 'PKDECRYPT':
+        send('INQUIRE CIPHERTEXT')
+        data = []
+        for line in sys.stdin:
+            line = line.rstrip('\n')
+            if line == 'END':
+                break
+            data.append(line[2:])
+        send('S PADDING 0')
+        send('D ' + ''.join(data))
+        send('OK')
+    elif line.startswith('KEYINFO '):
+        send('S KEYINFO %s D - - - P - - -' % line.split()[1])
+        send('OK')
+    elif line == 'HAVEKEY missing':
+        send('ERR 67108881 No secret key <GPG Agent>')
+    elif line == 'HANG':
+        pass
+    elif line == 'QUIT':
+        break
+    else:
+        send('OK')
+log.write('close %d\n' % os.getpid())
+'''
+
+
+class TC_ClientAgent(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.socket_path = tmp_dir.name + '/S.gpg-agent'
+        self.log_path = tmp_dir.name + '/server.log'
+        server_path = tmp_dir.name + '/server.py'
+        with open(server_path, 'w', encoding='utf-8') as f:
+            f.write(FAKE_SERVER)
+        self.command = [sys.executable, server_path, self.log_path]
+
+    def start(self, **kwargs: float) -> ClientAgent:
+        agent = ClientAgent(self.command, **kwargs)  # type: ignore
+        serve_task = self.loop.create_task(serve(agent, self.socket_path))
+        def stop() -> None:
+            serve_task.cancel()
+            self.loop.run_until_complete(
+                asyncio.wait([serve_task]))
+            # connections still being handled close (or keep) their
+            # channels late
+            def handled() -> bool:
+                return not any(
+                    getattr(task.get_coro(), '__name__', None) ==
+                    'handle_connection'
+                    for task in asyncio.all_tasks(self.loop))
+            self.wait_for(handled)
+            self.loop.run_until_complete(agent.close())
+        self.addCleanup(stop)
+        self.wait_for(lambda: os.path.exists(self.socket_path))
+        return agent
+
+    def wait_for(self, condition: Callable[[], bool]) -> None:
+        for _ in range(100):
+            if condition():
+                return
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.fail('timeout')
+
+    def server_log(self) -> List[str]:
+        try:
+            with open(self.log_path, encoding='utf-8') as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def session(self, lines: List[bytes], responses: int,
+                close: bool = True) -> Tuple[List[bytes], int]:
+        """Send *lines*, read greeting and *responses* final responses,
+        return all lines read and the server pid"""
+        async def run() -> Tuple[List[bytes], int]:
+            reader, writer = await asyncio.open_unix_connection(
+                self.socket_path)
+            received = [await reader.readline()]
+            writer.writelines(line + b'\n' for line in lines)
+            pid = 0
+            while responses > sum(line.startswith((b'OK', b'ERR'))
+                                  for line in received[1:]):
+                line = await reader.readline()
+                if not line:
+                    break
+                received.append(line)
+                if line.startswith(b'D ') and line[2:-1].isdigit():
+                    pid = int(line[2:-1])
+            if close:
+                writer.close()
+            return received, pid
+        return self.loop.run_until_complete(run())
+
+    def test_000_reuse(self) -> None:
+        self.start(reuse=True)
+        received, pid1 = self.session([b'GETINFO pid'], 1)
+        self.assertEqual(received[0], b'OK Pleased to meet you\n')
+        self.assertEqual(received[-1], b'OK\n')
+        self.wait_for(lambda: 'RESET' in self.server_log())
+        _, pid2 = self.session([b'OPTION ttyname=/dev/pts/0', b'GETINFO pid'],
+                               2)
+        self.assertEqual(pid1, pid2)
+        self.assertEqual(sum(line.startswith('open')
+                             for line in self.server_log()), 1)
+
+    def test_001_bye(self) -> None:
+        self.start(reuse=True)
+        received, pid1 = self.session([b'GETINFO pid', b'BYE'], 2)
+        self.assertEqual(received[-1], b'OK closing connection\n')
+        self.assertNotIn('BYE', self.server_log())
+        self.wait_for(lambda: 'RESET' in self.server_log())
+        _, pid2 = self.session([b'GETINFO pid'], 1)
+        self.assertEqual(pid1, pid2)
+
+    def test_002_inquire(self) -> None:
+        self.start()
+        received, _ = self.session(
+            [b'PKDECRYPT', b'D (7:enc-val', b'D )', b'END'], 1)
+        self.assertEqual(received[1:], [
+            b'INQUIRE CIPHERTEXT\n',
+            b'S PADDING 0\n',
+            b'D (7:enc-val)\n',
+            b'OK\n',
+        ])
+
+    def test_003_interrupted(self) -> None:
+        self.start(reuse=True)
+        _, pid1 = self.session([b'GETINFO pid', b'HANG'], 1)
+        # the channel is in the middle of a command, can't be reused
+        self.wait_for(lambda: 'close {}'.format(pid1) in self.server_log())
+        self.assertNotIn('RESET', self.server_log())
+        _, pid2 = self.session([b'GETINFO pid'], 1)
+        self.assertNotEqual(pid1, pid2)
+
+    def test_004_server_gone(self) -> None:
+        agent = self.start(reuse=True)
+        _, pid1 = self.session([b'GETINFO pid'], 1)
+        self.wait_for(lambda: bool(agent.idle))
+        # the server closes an idle channel
+        agent.idle[0].write([b'QUIT'])
+        self.wait_for(lambda: not agent.idle)
+        _, pid2 = self.session([b'GETINFO pid'], 1)
+        self.assertNotEqual(pid1, pid2)
+
+    def test_005_idle_timeout(self) -> None:
+        agent = self.start(idle_timeout=0.1, reuse=True)
+        _, pid = self.session([b'GETINFO pid'], 1)
+        self.wait_for(lambda: 'close {}'.format(pid) in self.server_log())
+        self.assertEqual(agent.idle, [])
+
+    def test_006_prewarm(self) -> None:
+        agent = self.start(prewarm=2, reuse=True)
+        self.wait_for(lambda: len(agent.idle) == 2)
+        self.session([b'GETINFO pid'], 1)
+        # replaced the one taken, which is then kept too
+        self.wait_for(lambda: len(agent.idle) == 3)
+        self.assertEqual(sum(line.startswith('open')
+                             for line in self.server_log()), 3)
+
+    def test_007_concurrent(self) -> None:
+        self.start()
+        async def run() -> None:
+            conns = [await asyncio.open_unix_connection(self.socket_path)
+                     for _ in range(3)]
+            for reader, _ in conns:
+                await reader.readline()
+            for reader, writer in conns:
+                writer.write(b'NOP\n')
+                self.assertEqual(await reader.readline(), b'OK\n')
+            for _, writer in conns:
+                writer.close()
+        self.loop.run_until_complete(run())
+        self.assertEqual(sum(line.startswith('open')
+                             for line in self.server_log()), 3)
+
+    def test_008_cache(self) -> None:
+        self.start()
+        for _ in range(2):
+            received, _ = self.session(
+                [b'KEYINFO 1234', b'HAVEKEY missing', b'KEYINFO 5678'], 3)
+            self.assertEqual(received[1:], [
+                b'S KEYINFO 1234 D - - - P - - -\n',
+                b'OK\n',
+                b'ERR 67108881 No secret key <GPG Agent>\n',
+                b'S KEYINFO 5678 D - - - P - - -\n',
+                b'OK\n',
+            ])
+        log = self.server_log()
+        self.assertEqual(log.count('KEYINFO 1234'), 1)
+        self.assertEqual(log.count('HAVEKEY missing'), 1)
+        self.assertEqual(log.count('KEYINFO 5678'), 1)
+
+    def test_009_cache_invalidated(self) -> None:
+        agent = self.start()
+        self.session([b'KEYINFO 1234'], 1)
+        self.session([b'GENKEY', b'KEYINFO 1234'], 2)
+        self.assertEqual(self.server_log().count('KEYINFO 1234'), 2)
+        self.session([b'KEYINFO 1234'], 1)
+        self.assertEqual(self.server_log().count('KEYINFO 1234'), 2)
+        agent.invalidate_cache()
+        self.session([b'KEYINFO 1234'], 1)
+        self.assertEqual(self.server_log().count('KEYINFO 1234'), 3)
+
+    def test_010_cache_expired(self) -> None:
+        self.start(cache_ttl=0.1)
+        self.session([b'KEYINFO 1234'], 1)
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.session([b'KEYINFO 1234'], 1)
+        self.assertEqual(self.server_log().count('KEYINFO 1234'), 2)
+
+    def test_011_cache_disabled(self) -> None:
+        self.start(cache_ttl=0)
+        self.session([b'KEYINFO 1234'], 1)
+        self.session([b'KEYINFO 1234'], 1)
+        self.assertEqual(self.server_log().count('KEYINFO 1234'), 2)
+
+    def test_012_no_reuse(self) -> None:
+        self.start()
+        _, pid1 = self.session([b'GETINFO pid', b'BYE'], 2)
+        # a new qubes.Gpg2 call, checked against the policy again
+        self.wait_for(lambda: 'close {}'.format(pid1) in self.server_log())
+        self.assertNotIn('RESET', self.server_log())
+        _, pid2 = self.session([b'GETINFO pid'], 1)
+        self.assertNotEqual(pid1, pid2)
+
+    def test_013_prewarm_no_reuse(self) -> None:
+        agent = self.start(prewarm=1)
+        self.wait_for(lambda: len(agent.idle) == 1)
+        _, pid = self.session([b'GETINFO pid'], 1)
+        # the channel opened in advance is used once, and replaced
+        self.wait_for(lambda: 'close {}'.format(pid) in self.server_log())
+        self.wait_for(lambda: len(agent.idle) == 1)
+        self.assertEqual(sum(line.startswith('open')
+                             for line in self.server_log()), 2)
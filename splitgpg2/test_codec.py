@@ -0,0 +1,174 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import random
+import re
+import string
+from typing import List
+from unittest import TestCase, mock
+
+from . import GpgServer
+from . import codec
+
+# the previous implementations - the output must not change
+
+def reference_log_io(untrusted_msg: bytes) -> str:
+    allowed = string.printable.\
+        replace('\t', '').\
+        replace('\n', '').\
+        replace('\r', '').\
+        replace('\f', '').\
+        replace('\v', '')
+    allowed_bytes = allowed.encode('ascii')
+    return ''.join(chr(c) if c in allowed_bytes else '.'
+                   for c in untrusted_msg.strip())
+
+
+def reference_sanitize_key_desc(client_domain: str,
+                                untrusted_args: bytes) -> bytes:
+    untrusted_args = untrusted_args.replace(b'+', b' ')
+    untrusted_args = re.sub(
+        rb'%[0-9A-F]{2}',
+        lambda m: bytes([int(m.group(0)[1:].decode('ascii'), 16)]),
+        untrusted_args
+    )
+    allowed_ascii = list(range(0x20, 0x7e)) + [0x0a]
+    args = "Message from '{}':\n{}".format(
+        client_domain,
+        ''.join((chr(c) if c in allowed_ascii else '.')
+                for c in untrusted_args)
+    )
+    return args.replace('%', '%25').\
+        replace('+', '%2B').\
+        replace('\n', '%0A').\
+        replace(' ', '+').\
+        encode('ascii')
+
+
+def reference_unescape_D(untrusted_arg: bytes) -> bytes:
+    return re.sub(
+        rb'%[0-9A-F]{2}',
+        lambda m: bytes([int(m.group(0)[1:], 16)]),
+        untrusted_arg
+    )
+
+
+def reference_escape_D(data: bytes) -> bytes:
+    return data.replace(b'%', b'%25').\
+                replace(b'\r', b'%0d').\
+                replace(b'\n', b'%0a')
+
+
+def reference_percent_plus_escape(to_escape: bytes) -> bytes:
+    unescaped_ascii = [
+        c for c in range(0x20, 0x7e)
+        if c not in list(b'+"% ')]
+    def esc(char: int) -> bytes:
+        if char in unescaped_ascii:
+            return bytes([char])
+        if char == ord(' '):
+            return b'+'
+        return b'%%%02x' % char
+    return b''.join(esc(c) for c in to_escape)
+
+
+class TC_Escaping(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = GpgServer(mock.Mock(), mock.Mock(), 'testvm')
+        rng = random.Random(1234)
+        self.samples: List[bytes] = [bytes(range(256)), b'', b' \n ',
+                                     b'%41+%4a%0A%%2+%ZZ']
+        for _ in range(1000):
+            self.samples.append(bytes(
+                rng.choice(b'%+ \n\r\t0A9Fafz~\x7f\x80\xff')
+                if rng.random() < 0.7 else rng.randrange(256)
+                for _ in range(rng.randint(0, 40))))
+
+    def test_000_log_io(self) -> None:
+        self.server.log_io_enable = True
+        for sample in self.samples:
+            with self.subTest(sample=sample), \
+                    self.assertLogs('splitgpg2.Server') as logs:
+                self.server.log_io('C >>>', sample)
+                self.assertEqual(logs.records[0].getMessage(),
+                                 'C >>>: ' + reference_log_io(sample))
+
+    def test_001_sanitize_key_desc(self) -> None:
+        for sample in self.samples:
+            with self.subTest(sample=sample):
+                self.assertEqual(
+                    self.server.sanitize_key_desc(sample),
+                    reference_sanitize_key_desc('testvm', sample))
+
+    def test_002_percent_plus_escape(self) -> None:
+        for sample in self.samples:
+            with self.subTest(sample=sample):
+                self.assertEqual(GpgServer.percent_plus_escape(sample),
+                                 reference_percent_plus_escape(sample))
+
+
+class TC_Codec(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.rng = random.Random(1234)
+
+    def random_data(self, alphabet: bytes = b'') -> bytes:
+        length = self.rng.randint(0, 60)
+        if alphabet:
+            return bytes(self.rng.choice(alphabet) for _ in range(length))
+        return self.rng.randbytes(length)
+
+    def test_000_unescape_same_as_reference(self) -> None:
+        for _ in range(5000):
+            data = self.random_data(b'%%%0129AFafgZ\n')
+            with self.subTest(data=data):
+                self.assertEqual(codec.percent_unescape(data),
+                                 reference_unescape_D(data))
+                self.assertEqual(codec.percent_unescape(memoryview(data)),
+                                 reference_unescape_D(data))
+
+    def test_001_escape_same_as_reference(self) -> None:
+        for _ in range(5000):
+            data = self.random_data()
+            with self.subTest(data=data):
+                self.assertEqual(codec.escape_D(data),
+                                 reference_escape_D(data))
+
+    def test_002_round_trip(self) -> None:
+        for _ in range(5000):
+            data = self.random_data()
+            # gpg escapes with upper case hex digits
+            escaped = re.sub(rb'[%\r\n]',
+                             lambda m: b'%%%02X' % m.group()[0], data)
+            with self.subTest(data=data):
+                self.assertEqual(codec.percent_unescape(escaped), data)
+                self.assertEqual(
+                    codec.percent_unescape(codec.escape_D(data).upper()),
+                    data.upper())
+                self.assertNotRegex(codec.escape_D(data), rb'[\r\n]')
+
+    def test_003_percent_plus_escape_round_trip(self) -> None:
+        for _ in range(5000):
+            data = self.random_data()
+            with self.subTest(data=data):
+                escaped = codec.percent_plus_escape(data)
+                self.assertRegex(escaped, rb'\A[\x21-\x7d]*\Z')
+                self.assertEqual(
+                    codec.percent_unescape(
+                        escaped.replace(b'+', b' ').upper()),
+                    data.upper())
@@ -0,0 +1,152 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from . import config as config_module
+from .config import ConfigSnapshots, ServerConfig
+
+
+class TC_ConfigSnapshots(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.conf_dir = tmp_dir.name + '/qubes-split-gpg2'
+        os.makedirs(self.conf_dir + '/conf.d')
+        env = mock.patch.dict(os.environ, {
+            'XDG_CONFIG_HOME': tmp_dir.name,
+            'GNUPGHOME': tmp_dir.name + '/gnupg',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        self.snapshots = ConfigSnapshots(tmp_dir.name + '/run')
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nallow_keygen = yes\n')
+
+    def write(self, name: str, content: str, age: float = 60) -> None:
+        path = os.path.join(self.conf_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def load(self) -> ServerConfig:
+        """Load the config, asserting whether the files were parsed"""
+        with mock.patch.object(config_module, 'load_config_files',
+                               wraps=config_module.load_config_files) as parse:
+            try:
+                return self.snapshots.load('testvm')
+            finally:
+                self.parsed = parse.called
+
+    def test_000_snapshot_used(self) -> None:
+        config = self.load()
+        self.assertTrue(self.parsed)
+        self.assertTrue(config.allow_keygen)
+        self.assertEqual(config.gnupghome, os.environ['GNUPGHOME'])
+        self.assertEqual(self.load(), config)
+        self.assertFalse(self.parsed)
+        # another client domain
+        self.assertFalse(self.snapshots.load('othervm').allow_keygen)
+
+    def test_001_invalidated(self) -> None:
+        self.load()
+        # changed content (and size)
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nallow_keygen = no\n')
+        self.assertFalse(self.load().allow_keygen)
+        self.assertTrue(self.parsed)
+        # same size, different mtime
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nallow_keygen = on\n', age=30)
+        with self.assertRaises(ValueError):
+            self.load()
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nallow_keygen = no\n')
+        self.load()
+        # new drop-in file
+        self.write('conf.d/00_test.conf', '[DEFAULT]\nautoaccept = yes\n')
+        self.assertEqual(self.load().timer_delay['PKSIGN'], -1)
+        self.assertTrue(self.parsed)
+        # environment the config depends on
+        self.load()
+        self.assertFalse(self.parsed)
+        with mock.patch.dict(os.environ, {'GNUPGHOME': '/nonexistent'}):
+            self.assertEqual(self.load().gnupghome, '/nonexistent')
+            self.assertTrue(self.parsed)
+
+    def test_002_recently_modified(self) -> None:
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nallow_keygen = yes\n', age=0)
+        self.load()
+        self.load()
+        # could be changed again without a different mtime
+        self.assertTrue(self.parsed)
+
+    def test_003_invalid_not_cached(self) -> None:
+        self.write('qubes-split-gpg2.conf',
+                   '[client:testvm]\nautoaccept = 0\n')
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                self.load()
+            self.assertTrue(self.parsed)
+
+    def test_004_broken_snapshot(self) -> None:
+        config = self.load()
+        path = self.snapshots.snapshot_path('testvm')
+        assert path is not None
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"key": ')
+        self.assertEqual(self.load(), config)
+        self.assertTrue(self.parsed)
+
+    def test_005_no_snapshot_dir(self) -> None:
+        self.snapshots = ConfigSnapshots(None)
+        self.load()
+        self.load()
+        self.assertTrue(self.parsed)
+
+    def test_006_metrics_textfile(self) -> None:
+        self.assertIsNone(self.load().metrics_textfile)
+        self.write('qubes-split-gpg2.conf',
+                   '[DEFAULT]\nmetrics_textfile = ~/split-gpg2.prom\n')
+        self.assertEqual(self.load().metrics_textfile,
+                         os.path.expanduser('~/split-gpg2.prom'))
+        self.write('qubes-split-gpg2.conf',
+                   '[DEFAULT]\nmetrics_textfile = split-gpg2.prom\n', age=30)
+        with self.assertRaises(ValueError):
+            self.load()
+
+    def test_007_trace(self) -> None:
+        config = self.load()
+        self.assertIsNone(config.trace_log)
+        self.assertEqual(config.trace_redact, 'data')
+        self.write('qubes-split-gpg2.conf',
+                   '[DEFAULT]\ntrace_log = ~/trace.jsonl\n'
+                   'trace_redact = args\n')
+        config = self.load()
+        self.assertEqual(config.trace_log,
+                         os.path.expanduser('~/trace.jsonl'))
+        self.assertEqual(config.trace_redact, 'args')
+        self.write('qubes-split-gpg2.conf',
+                   '[DEFAULT]\ntrace_redact = all\n')
+        with self.assertRaises(ValueError):
+            self.load()
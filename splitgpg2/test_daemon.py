@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from typing import List
+
+
+# Test the server daemon together with the handoff script, the same way
+# qubes.Gpg2.service uses them.
+class TC_Daemon(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.test_env = os.environ.copy()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        gpg_home = self.tmp_dir.name + "/gpg-home"
+        self.test_env["GNUPGHOME"] = gpg_home
+        os.mkdir(gpg_home, mode=0o700)
+
+        xdg_conf_dir = self.tmp_dir.name + "/xdg-config"
+        os.makedirs(xdg_conf_dir + "/qubes-split-gpg2")
+        self.test_env["XDG_CONFIG_HOME"] = xdg_conf_dir
+        with open(xdg_conf_dir + "/qubes-split-gpg2/qubes-split-gpg2.conf",
+                  "wb") as f:
+            f.write(b"[DEFAULT]\nsource_keyring_dir = no\n")
+
+        runtime_dir = self.tmp_dir.name + "/run"
+        os.mkdir(runtime_dir, mode=0o700)
+        self.test_env["XDG_RUNTIME_DIR"] = runtime_dir
+        self.socket_path = runtime_dir + "/split-gpg2/server.sock"
+
+        path_dir = self.tmp_dir.name + "/path"
+        os.mkdir(path_dir)
+        self.test_env["PATH"] = path_dir + ":" + self.test_env["PATH"]
+        with open(path_dir + "/notify-send", "wb") as f:
+            f.write(b"#!/bin/sh\n")
+        os.chmod(path_dir + "/notify-send", 0o755)
+
+        self.test_env["QREXEC_REMOTE_DOMAIN"] = "testvm"
+
+        self.top_dir = os.path.dirname(os.path.dirname(__file__))
+        self.test_env["PYTHONPATH"] = ":".join(
+            [self.top_dir] + self.test_env.get("PYTHONPATH", "").split(":"))
+
+        self.handoff_path = self.top_dir + "/split-gpg2-handoff"
+
+    def tearDown(self) -> None:
+        subprocess.run(["gpgconf", "--kill", "gpg-agent"], env=self.test_env)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def start_daemon(self) -> None:
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "splitgpg2.daemon"],
+            env=self.test_env,
+            stdin=subprocess.DEVNULL,
+        )
+        def cleanup() -> None:
+            daemon.terminate()
+            daemon.wait()
+        self.addCleanup(cleanup)
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("daemon did not create its socket")
+
+    def handoff(self, commands: bytes) -> subprocess.CompletedProcess[bytes]:
+        return subprocess.run(
+            [sys.executable, "-S", self.handoff_path, self.socket_path],
+            env=self.test_env,
+            input=commands,
+            stdout=subprocess.PIPE,
+            timeout=30,
+        )
+
+    def test_000_handoff(self) -> None:
+        self.start_daemon()
+        # the second connection is served with the warm state of the first
+        for _ in range(2):
+            p = self.handoff(b"GETINFO version\nBYE\n")
+            self.assertEqual(p.returncode, 0)
+            lines: List[bytes] = p.stdout.splitlines()
+            self.assertRegex(lines[0], rb"\AOK\s")
+            self.assertRegex(lines[1], rb"\AD\s")
+            self.assertEqual(lines[2], b"OK")
+            self.assertEqual(lines[3][:2], b"OK")
+
+    def test_001_filtered(self) -> None:
+        self.start_daemon()
+        p = self.handoff(b"GETINFO asdf\n")
+        self.assertEqual(p.stdout.splitlines()[1],
+                         b"ERR 67109888 Command filtered by split-gpg2.")
+
+    def test_002_no_daemon(self) -> None:
+        p = self.handoff(b"GETINFO version\n")
+        self.assertEqual(p.returncode, 75)
+        self.assertEqual(p.stdout, b"")
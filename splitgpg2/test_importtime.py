@@ -0,0 +1,80 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import subprocess
+import sys
+from typing import Dict
+from unittest import TestCase
+
+# imported only when needed, not for each qrexec call
+LAZY_MODULES = (
+    'configparser',
+    'glob',
+    'concurrent.futures.thread',
+    'splitgpg2.autoaccept',
+    'splitgpg2.keygen',
+    'splitgpg2.keyringsync',
+    'splitgpg2.metrics',
+    'splitgpg2.trace',
+)
+
+# cumulative import time of the splitgpg2 package alone (asyncio imported
+# before), in microseconds - way above the actual time, to not fail on a
+# loaded machine
+IMPORT_TIME_BUDGET = 150000
+
+
+class TC_ImportTime(TestCase):
+    def import_times(self) -> Dict[str, int]:
+        """Cumulative import times of all modules imported by ``import
+        splitgpg2``, in microseconds"""
+        top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import asyncio; import splitgpg2'],
+            cwd=top_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            check=True).stderr.decode()
+        times = {}
+        imported_asyncio = False
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            name = name.strip()
+            if imported_asyncio:
+                times[name] = int(cumulative)
+            imported_asyncio |= name == 'asyncio'
+        return times
+
+    def test_000_lazy_modules(self) -> None:
+        times = self.import_times()
+        self.assertIn('splitgpg2', times)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, times)
+
+    def test_001_budget(self) -> None:
+        best = min(self.import_times()['splitgpg2'] for _ in range(3))
+        self.assertLess(best, IMPORT_TIME_BUDGET)
+
+    def test_002_lazy_names(self) -> None:
+        code = ('import sys, splitgpg2; '
+                'assert "splitgpg2.keygen" not in sys.modules; '
+                'assert b"Ed25519" in splitgpg2.known_eddsa_curves; '
+                'assert "splitgpg2.keygen" in sys.modules')
+        top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', code], cwd=top_dir, check=True)
@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Any, List, Tuple
+from unittest import TestCase, mock
+
+from .keyindex import KeygripIndex
+
+
+class TC_KeygripIndex(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gnupghome = self.tmp_dir.name + '/gnupg'
+        os.mkdir(self.gnupghome, mode=0o700)
+        mock.patch.dict(os.environ,
+                        {'XDG_CACHE_HOME': self.tmp_dir.name + '/cache'}).start()
+
+    def tearDown(self) -> None:
+        subprocess.run(['gpgconf', '--homedir', self.gnupghome,
+                        '--kill', 'gpg-agent'], check=False)
+        mock.patch.stopall()
+        self.tmp_dir.cleanup()
+        self.loop.close()
+        super().tearDown()
+
+    def gpg(self, *args: str) -> bytes:
+        return subprocess.check_output(
+            ('gpg', '--homedir', self.gnupghome, '--batch', '--with-colons')
+            + args, stderr=subprocess.DEVNULL)
+
+    def genkey(self, uid: str) -> Tuple[bytes, List[bytes]]:
+        self.gpg('--passphrase', '', '--quick-gen-key', uid,
+                 'ed25519', 'sign', 'never')
+        fpr = b''
+        grips = []
+        for line in self.gpg('--with-keygrip', '-K', uid).splitlines():
+            fields = line.split(b':')
+            if fields[0] == b'fpr' and not fpr:
+                fpr = fields[9]
+            elif fields[0] == b'grp':
+                grips.append(fields[9])
+        return fpr, grips
+
+    def lookup(self, index: KeygripIndex, keygrip: bytes) -> Any:
+        return self.loop.run_until_complete(index.lookup(keygrip))
+
+    def test_000_incremental(self) -> None:
+        fpr1, grips1 = self.genkey('first@localhost')
+        index = KeygripIndex(self.gnupghome)
+        with mock.patch.object(index, 'list_secret_keys',
+                               wraps=index.list_secret_keys) as list_keys:
+            entry = self.lookup(index, grips1[0])
+            self.assertEqual(entry.fingerprint, fpr1)
+            self.assertEqual(entry.first_uid, b'first@localhost')
+            self.assertIsNone(entry.subkey_fingerprint)
+            list_keys.assert_called_once_with()
+            # a miss doesn't call gpg again
+            self.assertIsNone(self.lookup(index, b'0' * 40))
+            list_keys.assert_called_once_with()
+
+        # the secret key was removed; nothing to ask gpg about
+        os.unlink('{}/private-keys-v1.d/{}.key'.format(
+            self.gnupghome, grips1[0].decode()))
+        with mock.patch.object(index, 'list_secret_keys') as list_keys:
+            self.assertIsNone(self.lookup(index, grips1[0]))
+            list_keys.assert_not_called()
+
+    def test_001_persistent(self) -> None:
+        fpr, grips = self.genkey('first@localhost')
+        self.lookup(KeygripIndex(self.gnupghome), grips[0])
+        index = KeygripIndex(self.gnupghome)
+        with mock.patch.object(index, 'list_secret_keys') as list_keys:
+            self.assertEqual(self.lookup(index, grips[0]).fingerprint, fpr)
+            list_keys.assert_not_called()
+
+    def test_002_added_secret_key(self) -> None:
+        fpr, grips = self.genkey('first@localhost')
+        index = KeygripIndex(self.gnupghome)
+        self.assertEqual(self.lookup(index, grips[0]).fingerprint, fpr)
+        # a secret key without public key, as after keygen by a client
+        new_grip = b'0123456789ABCDEF0123456789ABCDEF01234567'
+        shutil.copy('{}/private-keys-v1.d/{}.key'.format(
+                        self.gnupghome, grips[0].decode()),
+                    '{}/private-keys-v1.d/{}.key'.format(
+                        self.gnupghome, new_grip.decode()))
+        with mock.patch.object(index, 'list_secret_keys',
+                               wraps=index.list_secret_keys) as list_keys:
+            self.assertIsNone(self.lookup(index, new_grip))
+            list_keys.assert_called_once_with(b'&' + new_grip)
+            self.assertEqual(self.lookup(index, grips[0]).fingerprint, fpr)
+            list_keys.assert_called_once_with(b'&' + new_grip)
+
+    def test_003_event_loops(self) -> None:
+        fpr, grips = self.genkey('first@localhost')
+        index = KeygripIndex(self.gnupghome)
+        # shared by connections of several event loops (like of the daemon
+        # and of the tests), concurrent lookups wait for each other
+        async def go() -> None:
+            entries = await asyncio.gather(index.lookup(grips[0]),
+                                           index.lookup(grips[0]))
+            self.assertEqual([entry and entry.fingerprint
+                              for entry in entries], [fpr, fpr])
+        self.loop.run_until_complete(go())
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        os.utime(self.gnupghome + '/pubring.kbx')
+        loop.run_until_complete(go())
@@ -0,0 +1,163 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import os
+import subprocess
+import tempfile
+from typing import Dict, List, Sequence
+from unittest import TestCase, mock
+
+from .keyringsync import KeyringSync
+
+
+class TC_KeyringSync(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.source_dir = self.tmp_dir.name + '/source'
+        self.target_dir = self.source_dir + '/qubes-auto-keyring'
+        os.mkdir(self.source_dir, 0o700)
+        os.mkdir(self.target_dir, 0o700)
+        for gnupghome in (self.source_dir, self.target_dir):
+            self.addCleanup(subprocess.run,
+                            ['gpgconf', '--homedir', gnupghome,
+                             '--kill', 'gpg-agent'], check=False)
+        self.sync = KeyringSync(self.source_dir, self.target_dir)
+
+    def gpg(self, gnupghome: str, *args: str) -> bytes:
+        return subprocess.check_output(
+            ('gpg', '--homedir', gnupghome, '--batch', '--yes',
+             '--passphrase', '') + args, stderr=subprocess.DEVNULL)
+
+    def genkey(self, uid: str) -> str:
+        self.gpg(self.source_dir, '--quick-gen-key', uid)
+        listing = self.gpg(self.source_dir, '--with-colons',
+                           '--list-secret-keys', uid)
+        return [line.split(b':')[9] for line in listing.splitlines()
+                if line.startswith(b'fpr:')][0].decode()
+
+    def build_dirs(self) -> List[str]:
+        return [name for name in os.listdir(self.source_dir)
+                if name.startswith('qubes-auto-keyring.')]
+
+    def key_files(self) -> List[str]:
+        return sorted(os.listdir(self.target_dir + '/private-keys-v1.d'))
+
+    def synced_keys(self) -> Dict[str, str]:
+        return self.loop.run_until_complete(
+            self.sync.list_keys(self.target_dir))
+
+    def test_000_incremental(self) -> None:
+        fpr1 = self.genkey('one@localhost')
+        fpr2 = self.genkey('two@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        self.assertEqual(set(self.synced_keys()), {fpr1, fpr2})
+
+        transfer_keys = mock.patch.object(
+            self.sync, 'transfer_keys', wraps=self.sync.transfer_keys).start()
+        delete_keys = mock.patch.object(
+            self.sync, 'delete_keys', wraps=self.sync.delete_keys).start()
+        self.addCleanup(mock.patch.stopall)
+        # nothing changed
+        first_sync = self.sync.task
+        self.loop.run_until_complete(self.sync.ensure())
+        self.assertIs(self.sync.task, first_sync)
+
+        # one key changed - only that one is transferred again
+        self.gpg(self.source_dir, '--quick-add-uid', fpr2, 'new@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        self.loop.run_until_complete(self.sync.flush())
+        transfer_keys.assert_called_once_with(mock.ANY, [fpr2])
+        delete_keys.assert_called_once_with(mock.ANY, [fpr2])
+        self.assertIn(b'new@localhost', self.gpg(
+            self.target_dir, '--list-secret-keys', fpr2))
+
+        # one key removed
+        transfer_keys.reset_mock()
+        delete_keys.reset_mock()
+        self.gpg(self.source_dir, '--delete-secret-and-public-keys', fpr1)
+        self.loop.run_until_complete(self.sync.ensure())
+        self.loop.run_until_complete(self.sync.flush())
+        transfer_keys.assert_not_called()
+        delete_keys.assert_called_once_with(mock.ANY, [fpr1])
+        self.assertEqual(set(self.synced_keys()), {fpr2})
+        # the keyring was prepared next to the one in use, and cleaned up
+        self.assertEqual(self.build_dirs(), [])
+
+    def test_001_background(self) -> None:
+        self.genkey('one@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        # only the first sync is waited for
+        self.genkey('two@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        assert self.sync.task is not None
+        self.assertFalse(self.sync.task.done())
+        self.loop.run_until_complete(self.sync.flush())
+        self.assertEqual(len(self.synced_keys()), 2)
+
+    def test_002_swapped_in(self) -> None:
+        fpr = self.genkey('one@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        key_files = self.key_files()
+        pubring = os.stat(self.target_dir + '/pubring.kbx')
+        transfer = self.sync.transfer_keys
+        async def check_transfer(gnupghome: str,
+                                 fingerprints: Sequence[str]) -> bool:
+            # the keyring in use is left alone until the new one is ready
+            self.assertNotEqual(gnupghome, self.target_dir)
+            self.assertEqual(self.key_files(), key_files)
+            self.assertEqual(os.stat(self.target_dir + '/pubring.kbx'),
+                             pubring)
+            return await transfer(gnupghome, fingerprints)
+        mock.patch.object(self.sync, 'transfer_keys',
+                          side_effect=check_transfer).start()
+        self.addCleanup(mock.patch.stopall)
+        self.gpg(self.source_dir, '--quick-add-uid', fpr, 'new@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        self.loop.run_until_complete(self.sync.flush())
+        self.assertIn(b'new@localhost', self.gpg(
+            self.target_dir, '--list-secret-keys', fpr))
+        self.assertEqual(self.key_files(), key_files)
+
+    def test_003_export_failed(self) -> None:
+        fpr1 = self.genkey('one@localhost')
+        fpr2 = self.genkey('two@localhost')
+        self.loop.run_until_complete(self.sync.ensure())
+        key_files = self.key_files()
+        mock.patch.object(self.sync, 'transfer_keys',
+                          return_value=False).start()
+        self.addCleanup(mock.patch.stopall)
+        self.gpg(self.source_dir, '--quick-add-uid', fpr2, 'new@localhost')
+        self.gpg(self.source_dir, '--delete-secret-and-public-keys', fpr1)
+        self.loop.run_until_complete(self.sync.ensure())
+        self.loop.run_until_complete(self.sync.flush())
+        # the old version is kept, the removed key is still removed
+        self.assertEqual(set(self.synced_keys()), {fpr2})
+        self.assertNotIn(b'new@localhost', self.gpg(
+            self.target_dir, '--list-secret-keys', fpr2))
+        # only the secret key file of the removed key is gone
+        self.assertLess(set(self.key_files()), set(key_files))
+        self.assertEqual(len(self.key_files()), len(key_files) - 1)
+        # and tried again next time
+        manifest = self.sync.load_manifest()
+        assert manifest is not None
+        self.assertEqual(manifest[1], {})
+        self.assertEqual(self.build_dirs(), [])
@@ -0,0 +1,195 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import os
+import socket
+import tempfile
+import time
+from typing import Dict, List
+from unittest import TestCase, mock
+
+from . import GpgServer, autoaccept_store
+from . import metrics as metrics_module
+from .config import ServerConfig
+from .metrics import CommandTiming, Metrics, flush_metrics
+
+
+def parse_textfile(path: str) -> Dict[str, float]:
+    values = {}
+    with open(path, encoding='utf-8') as textfile:
+        for line in textfile:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+    return values
+
+
+class TC_Metrics(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.path = tmp_dir.name + '/split-gpg2.prom'
+
+    def observe(self, metrics: Metrics, command: str, agent: float) -> None:
+        async def go() -> None:
+            timing = CommandTiming(command)
+            timing.start -= agent + 0.002
+            timing.phases['agent'] = agent
+            metrics.observe(timing, 'testvm', 'ok')
+        self.loop.run_until_complete(go())
+
+    def test_000_textfile(self) -> None:
+        metrics = Metrics(self.path)
+        self.observe(metrics, 'PKSIGN', 0.03)
+        self.observe(metrics, 'PKSIGN', 0.3)
+        metrics.flush()
+        values = parse_textfile(self.path)
+        self.assertEqual(values['splitgpg2_commands_total{command="PKSIGN",'
+                                'client="testvm",result="ok"}'], 2)
+        labels = 'command="PKSIGN",client="testvm",phase="agent"'
+        self.assertEqual(values['splitgpg2_command_duration_seconds_bucket{'
+                                + labels + ',le="0.05"}'], 1)
+        self.assertEqual(values['splitgpg2_command_duration_seconds_bucket{'
+                                + labels + ',le="0.5"}'], 2)
+        self.assertEqual(values['splitgpg2_command_duration_seconds_bucket{'
+                                + labels + ',le="+Inf"}'], 2)
+        self.assertAlmostEqual(values['splitgpg2_command_duration_seconds_sum{'
+                                      + labels + '}'], 0.33)
+        # the rest is the filter
+        labels = 'command="PKSIGN",client="testvm",phase="filter"'
+        self.assertEqual(values['splitgpg2_command_duration_seconds_count{'
+                                + labels + '}'], 2)
+        self.assertLess(values['splitgpg2_command_duration_seconds_sum{'
+                               + labels + '}'], 0.03)
+
+    def test_001_processes_add_up(self) -> None:
+        first = Metrics(self.path)
+        second = Metrics(self.path)
+        self.observe(first, 'PKSIGN', 0.01)
+        self.observe(second, 'PKSIGN', 0.01)
+        self.observe(second, 'PKDECRYPT', 0.01)
+        first.flush()
+        second.flush()
+        # nothing new
+        first.flush()
+        values = parse_textfile(self.path)
+        self.assertEqual(values['splitgpg2_commands_total{command="PKSIGN",'
+                                'client="testvm",result="ok"}'], 2)
+        self.assertEqual(values['splitgpg2_commands_total{command='
+                                '"PKDECRYPT",client="testvm",result="ok"}'],
+                         1)
+
+    def test_002_broken_state(self) -> None:
+        with open(self.path + '.state', 'w', encoding='utf-8') as f:
+            f.write('{"version": 1, "commands": [[')
+        metrics = Metrics(self.path)
+        self.observe(metrics, 'PKSIGN', 0.01)
+        metrics.flush()
+        values = parse_textfile(self.path)
+        self.assertEqual(values['splitgpg2_commands_total{command="PKSIGN",'
+                                'client="testvm",result="ok"}'], 1)
+
+    def test_003_write_failed(self) -> None:
+        metrics = Metrics(self.tmp_dir + '/nonexistent/split-gpg2.prom')
+        self.observe(metrics, 'PKSIGN', 0.01)
+        with self.assertLogs('splitgpg2.Metrics', 'WARNING'):
+            metrics.flush()
+        # kept for later
+        self.assertEqual(sum(metrics.commands.values()), 1)
+
+    def test_004_server(self) -> None:
+        path_dir = self.tmp_dir + '/path'
+        os.mkdir(path_dir)
+        with open(path_dir + '/zenity', 'w', encoding='ascii') as f:
+            f.write('#!/bin/sh\nsleep 0.2\n')
+        os.chmod(path_dir + '/zenity', 0o755)
+        mock.patch.dict(os.environ, {
+            'PATH': path_dir + ':' + os.environ['PATH'],
+            'XDG_RUNTIME_DIR': self.tmp_dir,
+            'XDG_CACHE_HOME': self.tmp_dir}).start()
+        mock.patch.object(GpgServer, 'notify').start()
+        self.addCleanup(mock.patch.stopall)
+        # pylint: disable=protected-access
+        self.addCleanup(metrics_module._metrics.clear)
+        agent_socket = self.tmp_dir + '/S.gpg-agent'
+
+        async def fake_agent(reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+            writer.write(b'OK Pleased to meet you\n')
+            while await reader.readline():
+                await asyncio.sleep(0.1)
+                writer.write(b'OK\n')
+            writer.close()
+
+        async def go() -> List[bytes]:
+            agent = await asyncio.start_unix_server(fake_agent, agent_socket)
+            client_sock, server_sock = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server_sock)
+            server = GpgServer(reader, writer, 'testvm')
+            server.apply_config(ServerConfig(
+                timer_delay={'PKSIGN': None, 'PKDECRYPT': None},
+                verbose_notifications=False,
+                allow_keygen=False,
+                gnupghome=self.tmp_dir + '/gnupg',
+                source_keyring_dir=None,
+                debug_log=None,
+                metrics_textfile=self.path,
+                trace_log=None,
+                trace_redact='data',
+                unsupported_options=()))
+            server.agent_socket_path = agent_socket
+            server.agent_unrestricted_socket_path = agent_socket
+            server_task = asyncio.ensure_future(server.run())
+            reader, writer = await asyncio.open_connection(sock=client_sock)
+            lines = [await reader.readline()]
+            for command in (b'NOP', b'GETINFO version', b'PKSIGN', b'BOGUS'):
+                writer.write(command + b'\n')
+                lines.append(await reader.readline())
+            await server_task
+            await autoaccept_store().flush()
+            writer.close()
+            agent.close()
+            await agent.wait_closed()
+            return lines
+
+        start = time.perf_counter()
+        lines = self.loop.run_until_complete(go())
+        elapsed = time.perf_counter() - start
+        self.assertEqual(lines[1:4], [b'OK\n'] * 3)
+        self.assertTrue(lines[4].startswith(b'ERR '))
+        flush_metrics()
+        values = parse_textfile(self.path)
+        for command, result in (('NOP', 'ok'), ('GETINFO', 'ok'),
+                                ('PKSIGN', 'ok'), ('unknown', 'filtered')):
+            self.assertEqual(values[
+                'splitgpg2_commands_total{{command="{}",client="testvm",'
+                'result="{}"}}'.format(command, result)], 1)
+        def phase_sum(command: str, phase: str) -> float:
+            return values['splitgpg2_command_duration_seconds_sum{{'
+                          'command="{}",client="testvm",phase="{}"}}'
+                          .format(command, phase)]
+        self.assertEqual(phase_sum('NOP', 'agent'), 0)
+        self.assertGreaterEqual(phase_sum('GETINFO', 'agent'), 0.1)
+        self.assertEqual(phase_sum('GETINFO', 'prompt'), 0)
+        self.assertGreaterEqual(phase_sum('PKSIGN', 'prompt'), 0.2)
+        self.assertGreaterEqual(phase_sum('PKSIGN', 'agent'), 0.1)
+        self.assertLess(phase_sum('PKSIGN', 'total'), elapsed)
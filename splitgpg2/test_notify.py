@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import tempfile
+import unittest
+from typing import List, Tuple
+from unittest import mock
+
+from .notify import Notifier, Marshaller, message, read_message, \
+    BUS_NAME, BUS_PATH, ERROR, METHOD_RETURN, SIGNAL, FIELD_ERROR_NAME, \
+    FIELD_INTERFACE, FIELD_MEMBER, FIELD_PATH, FIELD_REPLY_SERIAL, \
+    FIELD_SIGNATURE, HeaderFields
+
+# logs the arguments, one per line, and prints the notification ID
+NOTIFY_SEND = """#!/bin/sh
+log={log}
+id=$(($(grep -c '^--app-name' "$log" 2>/dev/null) + 1))
+for arg; do
+    case "$arg" in
+        --replace-id=*) id=${{arg#--replace-id=}};;
+    esac
+    echo "$arg" >> "$log"
+done
+case "$2" in
+    --print-id) echo "$id";;
+esac
+# make the caller wait a bit, so that notifications pile up
+sleep 0.05
+"""
+
+
+class FakeBus:
+    """Session bus with a notification daemon behind it, just enough for
+    :py:class:`Notifier`"""
+    def __init__(self, fail: bool = False) -> None:
+        #: return errors for Notify
+        self.fail = fail
+        self.connections = 0
+        #: (replaces_id, summary, body) of each Notify call
+        self.notifications: List[Tuple[int, str, str]] = []
+        self.serial = 0
+
+    def reply(self, writer: asyncio.StreamWriter, msg_type: int,
+              fields: HeaderFields, body: bytes = b'') -> None:
+        self.serial += 1
+        writer.write(message(msg_type, self.serial, fields, body))
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        assert (await reader.readline()).startswith(b'\0AUTH EXTERNAL ')
+        writer.write(b'OK 0123456789abcdef0123456789abcdef\r\n')
+        assert await reader.readline() == b'BEGIN\r\n'
+        while True:
+            try:
+                msg = await read_message(reader)
+            except asyncio.IncompleteReadError:
+                break
+            args = Marshaller()
+            if msg.fields[FIELD_MEMBER] == 'Hello':
+                args.string(':1.1')
+                self.reply(writer, METHOD_RETURN, {
+                    FIELD_REPLY_SERIAL: msg.serial, FIELD_SIGNATURE: 's'},
+                           bytes(args.data))
+                # not a reply, to be skipped
+                self.reply(writer, SIGNAL, {
+                    FIELD_PATH: BUS_PATH, FIELD_INTERFACE: BUS_NAME,
+                    FIELD_MEMBER: 'NameAcquired', FIELD_SIGNATURE: 's'},
+                           bytes(args.data))
+            elif self.fail:
+                self.reply(writer, ERROR, {
+                    FIELD_REPLY_SERIAL: msg.serial,
+                    FIELD_ERROR_NAME:
+                        'org.freedesktop.DBus.Error.ServiceUnknown'})
+            else:
+                assert msg.body.string() == 'split-gpg2'
+                replaces_id = msg.body.uint32()
+                msg.body.string()
+                self.notifications.append(
+                    (replaces_id, msg.body.string(), msg.body.string()))
+                args.uint32(replaces_id or len(self.notifications))
+                self.reply(writer, METHOD_RETURN, {
+                    FIELD_REPLY_SERIAL: msg.serial, FIELD_SIGNATURE: 'u'},
+                           bytes(args.data))
+        writer.close()
+
+
+# libnotify before 0.7.9
+NOTIFY_SEND_OLD = """#!/bin/sh
+for arg; do
+    case "$arg" in
+        --print-id|--replace-id*)
+            echo "Unknown option $arg" >&2
+            exit 1;;
+    esac
+done
+""" + NOTIFY_SEND.split('\n', 1)[1]
+
+
+class TC_Notifier(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.notifier = Notifier()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path_dir = self.tmp_dir.name + '/path'
+        os.mkdir(self.path_dir)
+        self.log_path = self.tmp_dir.name + '/notify-send.log'
+        self.bus_path = self.tmp_dir.name + '/bus'
+        # no session bus, unless started by the test
+        mock.patch.dict(os.environ, {
+            'PATH': self.path_dir + ':' + os.environ['PATH'],
+            'DBUS_SESSION_BUS_ADDRESS': 'unix:path=' + self.bus_path}).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(self.loop.run_until_complete, self.notifier.close())
+
+    def start_bus(self, fail: bool = False) -> FakeBus:
+        bus = FakeBus(fail)
+        server = self.loop.run_until_complete(
+            asyncio.start_unix_server(bus.handle, self.bus_path))
+        def cleanup() -> None:
+            # its connection first
+            self.loop.run_until_complete(self.notifier.close())
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.addCleanup(cleanup)
+        return bus
+
+    def install_notify_send(self, script: str) -> None:
+        with open(self.path_dir + '/notify-send', 'w',
+                  encoding='ascii') as f:
+            f.write(script.format(log=self.log_path))
+        os.chmod(self.path_dir + '/notify-send', 0o755)
+
+    def notifications(self) -> List[List[str]]:
+        """Arguments of each notify-send call"""
+        calls: List[List[str]] = []
+        with open(self.log_path, encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('--app-name'):
+                    calls.append([])
+                calls[-1].append(line.rstrip('\n'))
+        return calls
+
+    def test_000_coalesce(self) -> None:
+        self.install_notify_send(NOTIFY_SEND)
+        notifier = self.notifier
+        async def go() -> None:
+            notifier.notify('command PKSIGN allowed', 'testvm')
+            # shown together with the first one, as that's still pending
+            notifier.notify('command PKSIGN allowed', 'testvm')
+            notifier.notify('command PKSIGN allowed', 'testvm')
+            await notifier.flush(5)
+            notifier.notify('command PKSIGN allowed', 'othervm')
+            await notifier.flush(5)
+            notifier.notify('command PKSIGN allowed', 'testvm')
+            await notifier.flush(5)
+        self.loop.run_until_complete(go())
+        self.assertEqual(self.notifications(), [
+            ['--app-name=split-gpg2', '--print-id',
+             'split-gpg2: command PKSIGN allowed (3 times in the last 5 s)',
+             "qube 'testvm'"],
+            ['--app-name=split-gpg2', '--print-id',
+             'split-gpg2: command PKSIGN allowed', "qube 'othervm'"],
+            ['--app-name=split-gpg2', '--print-id', '--replace-id=1',
+             'split-gpg2: command PKSIGN allowed (4 times in the last 5 s)',
+             "qube 'testvm'"],
+        ])
+
+    def test_001_window(self) -> None:
+        self.install_notify_send(NOTIFY_SEND)
+        notifier = self.notifier
+        notifier.window = 0.1
+        async def go() -> None:
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+            await asyncio.sleep(0.2)
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+        self.loop.run_until_complete(go())
+        self.assertEqual(self.notifications(), [
+            ['--app-name=split-gpg2', '--print-id', 'split-gpg2: connected',
+             "qube 'testvm'"],
+        ] * 2)
+
+    def test_002_old_notify_send(self) -> None:
+        self.install_notify_send(NOTIFY_SEND_OLD)
+        notifier = self.notifier
+        async def go() -> None:
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+        self.loop.run_until_complete(go())
+        self.assertFalse(notifier.replace_supported)
+        self.assertEqual(self.notifications(), [
+            ['--app-name=split-gpg2', 'split-gpg2: connected',
+             "qube 'testvm'"],
+            ['--app-name=split-gpg2',
+             'split-gpg2: connected (2 times in the last 5 s)',
+             "qube 'testvm'"],
+        ])
+
+    def test_003_no_notify_send(self) -> None:
+        notifier = self.notifier
+        async def go() -> None:
+            with mock.patch.dict(os.environ, {'PATH': self.path_dir}):
+                notifier.notify('connected', 'testvm')
+                await notifier.flush(5)
+        # nothing shown, but no failure either
+        self.loop.run_until_complete(go())
+        self.assertTrue(notifier.replace_supported)
+
+    def test_004_dbus(self) -> None:
+        bus = self.start_bus()
+        self.install_notify_send(NOTIFY_SEND)
+        notifier = self.notifier
+        async def go() -> None:
+            for _ in range(3):
+                notifier.notify('command PKSIGN allowed', 'testvm')
+            await notifier.flush(5)
+            notifier.notify('command PKSIGN allowed', 'othervm')
+            await notifier.flush(5)
+            notifier.notify('command PKSIGN allowed', 'testvm')
+            await notifier.flush(5)
+        self.loop.run_until_complete(go())
+        self.assertEqual(bus.notifications, [
+            (0, 'split-gpg2: command PKSIGN allowed (3 times in the last 5 s)',
+             "qube 'testvm'"),
+            (0, 'split-gpg2: command PKSIGN allowed', "qube 'othervm'"),
+            (1, 'split-gpg2: command PKSIGN allowed (4 times in the last 5 s)',
+             "qube 'testvm'"),
+        ])
+        # all over one connection, without notify-send
+        self.assertEqual(bus.connections, 1)
+        self.assertFalse(os.path.exists(self.log_path))
+
+    def test_005_dbus_error(self) -> None:
+        bus = self.start_bus(fail=True)
+        self.install_notify_send(NOTIFY_SEND)
+        notifier = self.notifier
+        async def go() -> None:
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+            notifier.notify('connected', 'testvm')
+            await notifier.flush(5)
+        self.loop.run_until_complete(go())
+        self.assertEqual(bus.connections, 1)
+        self.assertEqual(self.notifications(), [
+            ['--app-name=split-gpg2', '--print-id', 'split-gpg2: connected',
+             "qube 'testvm'"],
+            ['--app-name=split-gpg2', '--print-id', '--replace-id=1',
+             'split-gpg2: connected (2 times in the last 5 s)',
+             "qube 'testvm'"],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import time
+from unittest import TestCase
+
+from .responsecache import ResponseCache
+
+
+class TC_ResponseCache(TestCase):
+    def test_000_ttl_and_state(self) -> None:
+        cache = ResponseCache(ttl=0.1)
+        key = ('/run/S.gpg-agent', b'GETINFO', b'version')
+        cache.put(key, [1, 2, None], [b'D 2.2.40\n', b'OK\n'])
+        self.assertEqual(cache.get(key, [1, 2, None]),
+                         [b'D 2.2.40\n', b'OK\n'])
+        self.assertIsNone(cache.get(key, [1, 3, None]))
+        # dropped on a state mismatch
+        self.assertIsNone(cache.get(key, [1, 2, None]))
+        cache.put(key, [1, 2, None], [b'D 2.2.40\n', b'OK\n'])
+        time.sleep(0.15)
+        self.assertIsNone(cache.get(key, [1, 2, None]))
+
+    def test_001_cacheable(self) -> None:
+        cache = ResponseCache()
+        key = ('/run/S.gpg-agent', b'HAVEKEY', b'0' * 40)
+        for lines, cached in (
+                ([b'OK\n'], True),
+                ([b'ERR 67108881 No secret key <GPG Agent>\n'], True),
+                ([b'ERR 67108891 Not found <GPG Agent>\n'], True),
+                ([b'ERR 67109139 Unknown IPC command <GPG Agent>\n'], False),
+                ([b'S PROGRESS x\n'], False),
+                ([], False)):
+            with self.subTest(lines=lines):
+                cache.clear()
+                cache.put(key, [], lines)
+                self.assertEqual(cache.get(key, []) is not None, cached)
@@ -23,12 +23,18 @@ import os
 import shutil
 import subprocess
 import tempfile
+import time
 import unittest
 import base64
 import re
 from unittest import TestCase
 from unittest import mock
-from . import GpgServer, load_config_files
+from . import GpgServer, load_config_files, open_pipe_connection, \
+    CLIENT_WRITE_HIGH_WATER, ASSUAN_LINELENGTH
+from . import agentpool
+from .agentpool import close_agent_pools
+from .assuan import AssuanLineReader, READ_CHUNK_SIZE
+from .autoaccept import autoaccept_store
 from typing import Union, Optional, Sequence, Tuple, List, Mapping, Any
 
 class SimplePinentry(asyncio.Protocol):
@@ -111,6 +117,12 @@ class TC_Server(TestCase):
         self.socket_path = [l.split(':', 1)[1]
                             for l in gpgconf_output.splitlines()
                             if l.startswith('agent-socket:')][0]
+        mock.patch.dict(os.environ,
+                        {'XDG_CACHE_HOME': self.gpg_dir.name + '/cache'}).start()
+        # keep the agent socket cache out of the real runtime dir
+        mock.patch('splitgpg2.runtime_dir',
+                   return_value=self.gpg_dir.name).start()
+        mock.patch('splitgpg2._agent_socket_cache', None).start()
         # environment for the server and real gpg-agent
         os.environ['GNUPGHOME'] = self.gpg_dir.name + '/server'
         os.mkdir(os.environ['GNUPGHOME'], mode=0o700)
@@ -590,6 +602,118 @@ Name-Email: {}
             await writer.wait_closed()
         self.loop.run_until_complete(go())
 
+    def test_014_list_pooled(self) -> None:
+        self.genkey()
+        open_unix_connection = mock.patch(
+            'asyncio.open_unix_connection',
+            wraps=asyncio.open_unix_connection).start()
+        async def go() -> None:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            self.assertEqual((await reader.readline())[:2], b'OK')
+            for _ in range(3):
+                writer.write(b'KEYINFO --list\n')
+                lines = []
+                while True:
+                    line = await reader.readline()
+                    if not line.startswith(b'S '):
+                        break
+                    lines.append(line)
+                self.assertEqual(line, b'OK\n')
+                self.assertEqual(len(lines), 2)
+                # let the connection be RESET and returned to the pool
+                await asyncio.sleep(0.1)
+            writer.close()
+            await writer.wait_closed()
+            # let the server finish
+            await asyncio.sleep(0.1)
+        self.loop.run_until_complete(go())
+        # test client, restricted agent connection and a single pooled one
+        self.assertEqual(open_unix_connection.call_count, 3)
+        # the pool doesn't keep the server of the first connection alive
+        # pylint: disable=protected-access
+        for pool in agentpool._pools.values():
+            self.assertIs(pool.handshake, GpgServer.read_hello)
+        close_agent_pools()
+
+    def test_015_cached_queries(self) -> None:
+        self.genkey()
+        keygrips = subprocess.check_output(
+            ['gpg', '--with-colons', '--with-keygrip', '-K'])
+        keygrip = [line.split(b':')[9] for line in keygrips.splitlines()
+                   if line.startswith(b'grp:')][0]
+        agent_write = mock.patch.object(
+            GpgServer, 'agent_write', autospec=True,
+            side_effect=GpgServer.agent_write).start()
+        async def query(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter,
+                        command: bytes) -> List[bytes]:
+            writer.write(command + b'\n')
+            lines = []
+            while True:
+                line = await reader.readline()
+                lines.append(line)
+                if not line.startswith((b'S ', b'D ')):
+                    return lines
+        async def go() -> None:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            self.assertEqual((await reader.readline())[:2], b'OK')
+            first = [await query(reader, writer, b'GETINFO version'),
+                     await query(reader, writer, b'HAVEKEY ' + keygrip),
+                     await query(reader, writer, b'HAVEKEY ' + b'0' * 40),
+                     await query(reader, writer, b'KEYINFO --list')]
+            self.assertEqual(agent_write.call_count, 4)
+            self.assertEqual(first[1], [b'OK\n'])
+            self.assertRegex(first[2][0], rb'\AERR \d+ No secret key')
+            second = [await query(reader, writer, b'GETINFO version'),
+                      await query(reader, writer, b'HAVEKEY ' + keygrip),
+                      await query(reader, writer, b'HAVEKEY ' + b'0' * 40),
+                      await query(reader, writer, b'KEYINFO --list')]
+            # served from the cache, exactly the same
+            self.assertEqual(agent_write.call_count, 4)
+            self.assertEqual(first, second)
+            # keyring change
+            os.unlink(os.environ['GNUPGHOME'] + '/private-keys-v1.d/' +
+                      keygrip.decode() + '.key')
+            self.assertRegex(
+                (await query(reader, writer, b'HAVEKEY ' + keygrip))[0],
+                rb'\AERR \d+ No secret key')
+            self.assertEqual(agent_write.call_count, 5)
+            writer.close()
+            await writer.wait_closed()
+            await asyncio.sleep(0.1)
+        self.loop.run_until_complete(go())
+
+    def test_016_pipelined(self) -> None:
+        agent_write = mock.patch.object(
+            GpgServer, 'agent_write', autospec=True,
+            side_effect=GpgServer.agent_write).start()
+        async def go() -> None:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            self.assertEqual((await reader.readline())[:2], b'OK')
+            writer.write(b'RESET\n'
+                         b'NOP\n'
+                         b'GETINFO restricted\n'
+                         b'SCD SERIALNO\n'
+                         b'HAVEKEY ' + b'0' * 40 + b'\n'
+                         b'OPTION pinentry-mode=ask\n')
+            self.assertEqual(await reader.readline(), b'OK\n')
+            self.assertEqual(await reader.readline(), b'OK\n')
+            self.assertEqual(await reader.readline(), b'OK\n')
+            self.assertRegex(await reader.readline(),
+                             rb'\AERR \d+ No SmartCard daemon')
+            self.assertRegex(await reader.readline(),
+                             rb'\AERR \d+ No secret key')
+            self.assertEqual(await reader.readline(), b'OK\n')
+            # all the agent commands in one go
+            self.assertEqual(agent_write.call_count, 1)
+            self.assertEqual(agent_write.call_args[0][1],
+                             b'RESET\nGETINFO restricted\nHAVEKEY ' +
+                             b'0' * 40 + b'\n')
+            writer.close()
+            await writer.wait_closed()
+            await asyncio.sleep(0.1)
+        self.loop.run_until_complete(go())
+
 class TC_Config(TestCase):
     key_uid = 'user@localhost'
 
@@ -626,6 +750,12 @@ class TC_Config(TestCase):
                             if l.startswith('agent-socket:')][0]
         self.server_gpghome = self.gpg_dir.name + '/server'
         os.mkdir(self.server_gpghome, mode=0o700)
+        mock.patch.dict(os.environ,
+                        {'XDG_CACHE_HOME': self.gpg_dir.name + '/cache'}).start()
+        # keep the agent socket cache out of the real runtime dir
+        mock.patch('splitgpg2.runtime_dir',
+                   return_value=self.gpg_dir.name).start()
+        mock.patch('splitgpg2._agent_socket_cache', None).start()
 
 
     def tearDown(self) -> None:
@@ -836,6 +966,7 @@ Name-Email: user@localhost
             gnupghome = {self.gpg_dir.name}/test-dir
             """)
         gpg_server.load_config(config['DEFAULT'])
+        self.loop.run_until_complete(gpg_server.sync_keyring())
         self.assertEqual(gpg_server.source_keyring_dir, self.gpg_dir.name)
         self.assertEqual(gpg_server.gnupghome, f'{self.gpg_dir.name}/test-dir/qubes-auto-keyring')
         self.assertIsNot(gpg_server.gnupghome, None)
@@ -856,3 +987,175 @@ Name-Email: user@localhost
             if i.startswith('ssb:-:'):
                 found_subkey = True
         self.assertTrue(found_subkey, f'Subkey not exported: not found in {stdout.decode()}')
+
+
+class TC_RequestTimer(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        path_dir = self.tmp_dir.name + '/path'
+        os.mkdir(path_dir)
+        mock.patch.dict(os.environ, {
+            'PATH': path_dir + ':' + os.environ['PATH']}).start()
+        self.zenity_path = path_dir + '/zenity'
+        self.notify_mock = mock.patch.object(GpgServer, 'notify').start()
+
+    def tearDown(self) -> None:
+        mock.patch.stopall()
+        super().tearDown()
+
+    def fake_zenity(self, script: str) -> None:
+        with open(self.zenity_path, 'w', encoding='ascii') as f:
+            f.write('#!/bin/sh\necho $$ > {}.pid\n{}\n'.format(
+                self.zenity_path, script))
+        os.chmod(self.zenity_path, 0o755)
+
+    def server(self) -> Tuple[GpgServer, asyncio.StreamReader]:
+        reader = asyncio.StreamReader()
+        server = GpgServer(reader, mock.Mock(), 'testvm')
+        server.agent_socket_path = self.tmp_dir.name + '/S.gpg-agent'
+        def cleanup() -> None:
+            if not reader.at_eof():
+                reader.feed_eof()
+            if server.client_lookahead is not None:
+                self.loop.run_until_complete(server.client_lookahead)
+            self.loop.run_until_complete(autoaccept_store().flush())
+        self.addCleanup(cleanup)
+        return server, reader
+
+    def test_000_allowed(self) -> None:
+        self.fake_zenity('exit 0')
+        server, _ = self.server()
+        self.loop.run_until_complete(server.request_timer('PKSIGN'))
+        self.notify_mock.assert_called_with('command PKSIGN allowed')
+
+    def test_001_denied(self) -> None:
+        self.fake_zenity('exit 1')
+        server, _ = self.server()
+        with self.assertRaises(Exception):
+            self.loop.run_until_complete(server.request_timer('PKSIGN'))
+        self.notify_mock.assert_not_called()
+
+    def test_002_does_not_block(self) -> None:
+        self.fake_zenity('sleep 1; exit 0')
+        servers = [self.server()[0] for _ in range(3)]
+        start = time.monotonic()
+        self.loop.run_until_complete(asyncio.gather(
+            *(server.request_timer('PKSIGN') for server in servers)))
+        self.assertLess(time.monotonic() - start, 2.5)
+
+    def test_003_disconnect(self) -> None:
+        self.fake_zenity('exec sleep 30')
+        server, reader = self.server()
+        async def go() -> None:
+            task = asyncio.ensure_future(server.request_timer('PKSIGN'))
+            while not os.path.exists(self.zenity_path + '.pid'):
+                await asyncio.sleep(0.05)
+            reader.feed_eof()
+            with self.assertRaises(ConnectionResetError):
+                await asyncio.wait_for(task, 5)
+        self.loop.run_until_complete(go())
+        with open(self.zenity_path + '.pid', encoding='ascii') as f:
+            pid = int(f.read())
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+        # the connection is still usable for reading (EOF)
+        self.assertEqual(
+            self.loop.run_until_complete(server.read_one_line_from_client()),
+            b'')
+
+    def test_004_autoaccept(self) -> None:
+        self.fake_zenity('exit 0')
+        server, _ = self.server()
+        server.timer_delay['PKDECRYPT'] = 300
+        async def go() -> None:
+            await server.request_timer('PKDECRYPT')
+            self.notify_mock.assert_called_with('command PKDECRYPT allowed')
+            self.fake_zenity('exit 1')
+            await server.request_timer('PKDECRYPT')
+            self.notify_mock.assert_called_with(
+                'command PKDECRYPT automatically allowed')
+            self.assertEqual(list(server.autoaccept_grants()), ['PKDECRYPT'])
+            server.revoke_autoaccept()
+            self.assertEqual(server.autoaccept_grants(), {})
+            with self.assertRaises(Exception):
+                await server.request_timer('PKDECRYPT')
+        self.loop.run_until_complete(go())
+
+
+class TC_ClientBackpressure(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_000_slow_client(self) -> None:
+        line = b'D ' + b'x' * 998 + b'\n'
+        count = 2000
+        async def go() -> None:
+            client_in_r, client_in_w = os.pipe()
+            client_out_r, client_out_w = os.pipe()
+            self.addCleanup(os.close, client_in_w)
+            reader, writer = await open_pipe_connection(
+                open(client_in_r, 'rb', buffering=0),
+                open(client_out_w, 'wb', buffering=0))
+            server = GpgServer(reader, writer, 'testvm')
+            agent_stream = asyncio.StreamReader()
+            agent_stream.feed_data(line * count + b'OK\n')
+            agent_stream.feed_eof()
+            agent_reader = AssuanLineReader(agent_stream)
+
+            # a client reading 4 KiB every millisecond
+            slow_reader = asyncio.StreamReader()
+            await asyncio.get_running_loop().connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(slow_reader),
+                open(client_out_r, 'rb', buffering=0))
+            async def consume() -> int:
+                received = 0
+                while True:
+                    data = await slow_reader.read(4096)
+                    if not data:
+                        return received
+                    received += len(data)
+                    await asyncio.sleep(0.001)
+            consumer = asyncio.ensure_future(consume())
+
+            transport = writer.transport
+            max_buffered = 0
+            while await server.handle_agent_response({}, agent_reader):
+                max_buffered = max(max_buffered,
+                                   transport.get_write_buffer_size())
+            writer.close()
+            self.assertEqual(await consumer, len(line) * count + 3)
+            self.assertLessEqual(max_buffered, CLIENT_WRITE_HIGH_WATER +
+                                 READ_CHUNK_SIZE + ASSUAN_LINELENGTH)
+        self.loop.run_until_complete(asyncio.wait_for(go(), 60))
+
+    def test_001_bulk_relay(self) -> None:
+        async def go() -> None:
+            client_writer = mock.Mock()
+            client_writer.is_closing.return_value = False
+            client_writer.drain = mock.AsyncMock()
+            server = GpgServer(mock.Mock(), client_writer, 'testvm')
+            agent_stream = asyncio.StreamReader()
+            agent_stream.feed_data(b'S PROGRESS\n# comment\n' +
+                                   b'D data\n' * 100 +
+                                   b'OK\nD next command\n')
+            agent_reader = AssuanLineReader(agent_stream)
+            recorded: List[bytes] = []
+            # all available at once, handled in a single call
+            self.assertFalse(await server.handle_agent_response(
+                {}, agent_reader, recorded))
+            # the D/S run in one go, then OK
+            client_writer.writelines.assert_called_once_with(
+                [b'S PROGRESS\n'] + [b'D data\n'] * 100)
+            client_writer.write.assert_called_once_with(b'OK\n')
+            self.assertEqual(len(recorded), 102)
+            # stopped exactly at OK
+            self.assertEqual(await agent_reader.readline(),
+                             b'D next command\n')
+        self.loop.run_until_complete(go())
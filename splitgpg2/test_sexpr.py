@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import random
+import re
+import time
+import unittest
+from typing import Callable, List, Tuple, Type, Union, TYPE_CHECKING
+from unittest import mock
+
+from . import GpgServer, Filtered, SExprParser, sanitize_int, \
+    ASSUAN_LINELENGTH, MAX_INQUIRE_DATA_LINES
+
+if TYPE_CHECKING:
+    from . import SExpr
+
+
+def reference_parse_sexpr(untrusted_arg: bytes) -> 'SExpr':
+    """The previous, recursive parser - the grammar must not change"""
+    def parse(untrusted_arg: bytes,
+              nesting: int) -> Tuple[List['SExpr'], bytes]:
+        if not untrusted_arg:
+            if nesting > 0:
+                raise ValueError("missing closing parenthesis")
+            return ([], b'')
+        if untrusted_arg[0] == ord(')'):
+            if nesting == 0:
+                return ([], untrusted_arg)
+            if nesting > 20:
+                raise ValueError("sexpr has too big nesting depth")
+            return ([], untrusted_arg[1:].lstrip(b' '))
+        rest: bytes
+        value: Union[List['SExpr'], bytes]
+        if 0x30 <= untrusted_arg[0] <= 0x40:
+            length_s, rest = untrusted_arg.split(b':', 1)
+            length = sanitize_int(length_s, 1, len(rest))
+            value, rest = rest[0:length], rest[length:]
+        elif untrusted_arg[0] == ord('('):
+            value, rest = parse(untrusted_arg[1:], nesting + 1)
+        else:
+            match = re.match(rb'\A([0-9a-zA-Z-_]+) ?(.*)\Z', untrusted_arg)
+            if match is None:
+                raise ValueError("Invalid literal")
+            value, rest = match.group(1), match.group(2)
+        rest_parsed, new_rest = parse(rest, nesting)
+        return ([value] + rest_parsed, new_rest)
+
+    if len(untrusted_arg) == 0:
+        raise ValueError("no sexpr")
+    sexpr, rest = parse(untrusted_arg, 0)
+    if len(rest) != 0:
+        raise ValueError("garbage at end of sexpr")
+    if len(sexpr) != 1:
+        raise ValueError("sexpr top level shold have exactly one element")
+    if not isinstance(sexpr[0], list):
+        raise ValueError("sexpr top level shold be a list")
+    return sexpr[0]
+
+
+def outcome(parser: Callable[[bytes], 'SExpr'],
+            data: bytes) -> Union['SExpr', Type[BaseException]]:
+    try:
+        return parser(data)
+    except (ValueError, Filtered) as e:
+        return type(e)
+
+
+class TC_ParseSexpr(unittest.TestCase):
+    def test_000_valid(self) -> None:
+        for data, expected in (
+                (b'(3:abc)', [b'abc']),
+                (b'(7:enc-val(3:rsa(1:a3:\0\n\r)))',
+                 [b'enc-val', [b'rsa', [b'a', b'\0\n\r']]]),
+                (b'(genkey (ecc (curve Ed25519)(flags eddsa)))',
+                 [b'genkey', [b'ecc', [b'curve', b'Ed25519'],
+                              [b'flags', b'eddsa']]]),
+                (b'(a)  ', [b'a']),
+                ):
+            with self.subTest(data=data):
+                self.assertEqual(GpgServer.parse_sexpr(data), expected)
+        # nesting limit
+        nested: 'SExpr' = []
+        for _ in range(19):
+            nested = [nested]
+        self.assertEqual(GpgServer.parse_sexpr(b'(' * 20 + b')' * 20),
+                         nested)
+
+    def test_001_invalid(self) -> None:
+        for data, error in (
+                (b'', ValueError),
+                (b'(', ValueError),
+                (b'(a))', ValueError),
+                (b'(a)(b)', ValueError),
+                (b'3:abc', ValueError),
+                (b'(5:abc)', Filtered),
+                (b'(0:)', Filtered),
+                (b'(03:abc)', Filtered),
+                (b'(3abc)', ValueError),
+                (b'(a\tb)', ValueError),
+                # literal with a newline anywhere after it
+                (b'(a(1:\n))', ValueError),
+                (b'(' * 21 + b')' * 21, ValueError),
+                ):
+            with self.subTest(data=data), self.assertRaises(error):
+                GpgServer.parse_sexpr(data)
+
+    def test_002_same_as_reference(self) -> None:
+        rng = random.Random(1234)
+        alphabet = b'()  ::0123456789aZ_-\n\t~'
+        for _ in range(20000):
+            data = bytes(rng.choice(alphabet)
+                         for _ in range(rng.randint(1, 30)))
+            with self.subTest(data=data):
+                self.assertEqual(outcome(GpgServer.parse_sexpr, data),
+                                 outcome(reference_parse_sexpr, data))
+
+    def test_003_many_elements(self) -> None:
+        # used to hit the recursion limit
+        data = b'(7:enc-val' + b'(1:a1:b)' * 50000 + b')'
+        sexpr = GpgServer.parse_sexpr(data)
+        self.assertEqual(len(sexpr), 50001)
+        self.assertEqual(GpgServer.serialize_sexpr(sexpr), data)
+
+    def test_004_linear(self) -> None:
+        def measure(count: int) -> float:
+            data = b'(7:enc-val' + b'(1:a1:b)' * count + b')'
+            start = time.perf_counter()
+            GpgServer.parse_sexpr(data)
+            return time.perf_counter() - start
+        small = min(measure(2000) for _ in range(3))
+        big = min(measure(20000) for _ in range(3))
+        # 10x the input, allow for plenty of noise
+        self.assertLess(big, small * 30)
+
+    def test_005_chunks(self) -> None:
+        def parse_chunks(data: bytes) -> 'SExpr':
+            parser = SExprParser()
+            for pos in range(0, len(data), step):
+                parser.feed(data[pos:pos + step])
+            return parser.finish()
+        rng = random.Random(1234)
+        alphabet = b'()  ::0123456789aZ_-\n\t~'
+        for _ in range(5000):
+            data = bytes(rng.choice(alphabet)
+                         for _ in range(rng.randint(1, 30)))
+            step = rng.randint(1, 5)
+            with self.subTest(data=data, step=step):
+                expected = outcome(GpgServer.parse_sexpr, data)
+                actual = outcome(parse_chunks, data)
+                # the error may be noticed at a different point
+                if isinstance(expected, type):
+                    self.assertIsInstance(actual, type)
+                else:
+                    self.assertEqual(actual, expected)
+
+    def test_006_max_size(self) -> None:
+        parser = SExprParser(10)
+        parser.feed(b'(a')
+        with self.assertRaises(Filtered):
+            parser.feed(b'(20:')
+        parser = SExprParser(10)
+        parser.feed(b'(5:ab')
+        with self.assertRaises(ValueError):
+            parser.feed(b'cdefghij)')
+
+    def test_007_complete(self) -> None:
+        parser = SExprParser()
+        parser.feed(b'(a(b')
+        self.assertFalse(parser.complete)
+        parser.feed(b'))')
+        self.assertTrue(parser.complete)
+        parser.feed(b'  ')
+        self.assertEqual(parser.finish(), [b'a', [b'b']])
+
+
+class TC_InquireData(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.server = GpgServer(mock.Mock(), mock.Mock(), 'testvm')
+        self.server.agent_writer = mock.Mock()
+        # as done by send_inquire
+        self.server.inquire_data = None
+        self.server.inquire_data_lines = 0
+        self.server.inquire_data_sent = False
+
+    def send(self, line: bytes) -> bool:
+        command, args = line.split(b' ', 1) if b' ' in line else (line, b'')
+        if command == b'D':
+            coro = self.server.inquire_command_D_CIPHERTEXT(
+                untrusted_args=args)
+        else:
+            coro = self.server.inquire_command_END(untrusted_args=args)
+        return self.loop.run_until_complete(coro)
+
+    def sent(self) -> bytes:
+        assert isinstance(self.server.agent_writer, mock.Mock)
+        return b''.join(call.args[0] for call
+                        in self.server.agent_writer.write.call_args_list)
+
+    def test_000_multiline(self) -> None:
+        # RSA-8192 ciphertext, with bytes needing escaping
+        value = bytes(range(256)) * 4
+        data = b'(7:enc-val(3:rsa(1:a1024:' + value + b')))'
+        # like gpg does it
+        escaped = re.sub(rb'[%\r\n]',
+                         lambda m: b'%%%02X' % m.group()[0], data)
+        for pos in range(0, len(escaped), 600):
+            self.assertTrue(self.send(b'D ' + escaped[pos:pos + 600]))
+        self.assertFalse(self.send(b'END'))
+        lines = GpgServer.escape_D_lines(data)
+        self.assertGreater(len(lines), 1)
+        for line in lines:
+            self.assertLessEqual(len(line), ASSUAN_LINELENGTH)
+        self.assertEqual(self.sent(), b''.join(lines) + b'END\n')
+
+    def test_001_invalid_rejected_early(self) -> None:
+        self.assertTrue(self.send(b'D (7:enc-val(3:rsa'))
+        with self.assertRaises(Filtered):
+            self.send(b'D (1:b1:c)))')
+        self.assertEqual(self.sent(), b'')
+
+    def test_002_garbage_after(self) -> None:
+        self.send(b'D (7:enc-val(3:rsa(1:a1:b)))')
+        self.assertTrue(self.send(b'D (a)'))
+        with self.assertRaises(Filtered):
+            self.send(b'END')
+        self.assertNotIn(b'END', self.sent())
+
+    def test_003_incomplete(self) -> None:
+        self.send(b'D (7:enc-val(3:rsa(1:a1:b))')
+        with self.assertRaises(Filtered):
+            self.send(b'END')
+        self.assertEqual(self.sent(), b'')
+
+    def test_004_too_many_lines(self) -> None:
+        self.send(b'D (7:enc-val(3:rsa(1:a')
+        for _ in range(MAX_INQUIRE_DATA_LINES - 1):
+            self.send(b'D 1')
+        with self.assertRaises(Filtered):
+            self.send(b'D 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import json
+import os
+import tempfile
+from typing import Any, Dict, List
+from unittest import TestCase, mock
+
+from . import GpgServer
+from . import trace as trace_module
+from .trace import Tracer, tracer
+
+
+class TC_Trace(TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.path = tmp_dir.name + '/trace.jsonl'
+        # pylint: disable=protected-access
+        self.addCleanup(trace_module._tracers.clear)
+
+    def read(self) -> List[Dict[str, Any]]:
+        with open(self.path, encoding='ascii') as trace_file:
+            return [json.loads(line) for line in trace_file]
+
+    def test_000_records(self) -> None:
+        tr = Tracer(self.path)
+        conn = tr.connection('testvm', 'no')
+        conn.record('C >>>', b'SETHASH 8 0123\n')
+        conn.record('A <<<', b'OPTION ttyname=/dev/pts/0\nHAVEKEY 0123\n')
+        conn.record('A >>>', b'D \x00\xff%25')
+        tr.close()
+        records = self.read()
+        self.assertEqual([record['dir'] for record in records],
+                         ['open', 'C>>>', 'A<<<', 'A<<<', 'A>>>'])
+        self.assertEqual(records[0]['client'], 'testvm')
+        self.assertEqual({record['conn'] for record in records},
+                         {'{}-1'.format(os.getpid())})
+        self.assertEqual(records[1]['line'], 'SETHASH 8 0123')
+        self.assertEqual(records[1]['len'], 14)
+        self.assertEqual(records[3]['line'], 'HAVEKEY 0123')
+        self.assertEqual(records[4]['line'].encode('latin-1'),
+                         b'D \x00\xff%25')
+        timestamps = [record['t'] for record in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_001_redact(self) -> None:
+        tr = Tracer(self.path)
+        for policy in ('no', 'data', 'args'):
+            conn = tr.connection('testvm', policy)
+            conn.record('A >>>', b'D (7:sig-val')
+            conn.record('A >>>', b'ERR 67108881 No secret key')
+        tr.close()
+        records = [record for record in self.read()
+                   if record['dir'] != 'open']
+        self.assertEqual([record['line'] for record in records], [
+            'D (7:sig-val', 'ERR 67108881 No secret key',
+            'D', 'ERR 67108881 No secret key',
+            'D', 'ERR',
+        ])
+        self.assertEqual({record['len'] for record in records[0::2]}, {12})
+        self.assertEqual(len({record['conn'] for record in records}), 3)
+
+    def test_002_append(self) -> None:
+        with open(self.path, 'w', encoding='ascii') as trace_file:
+            trace_file.write('{}\n')
+        # like two processes
+        first = Tracer(self.path)
+        second = Tracer(self.path)
+        first.connection('vm1').record('C >>>', b'NOP')
+        second.connection('vm2').record('C >>>', b'NOP')
+        first.close()
+        second.close()
+        self.assertEqual(len(self.read()), 5)
+
+    def test_003_write_failed(self) -> None:
+        tr = Tracer(self.tmp_dir + '/nonexistent/trace.jsonl')
+        with self.assertLogs('splitgpg2.Tracer', 'WARNING'):
+            tr.connection('testvm').record('C >>>', b'NOP')
+            tr.close()
+
+    def test_004_server(self) -> None:
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        server = GpgServer(asyncio.StreamReader(loop=loop), mock.Mock(),
+                           'testvm')
+        server.trace = tracer(self.path).connection('testvm')
+        with mock.patch.object(server.log, 'warning') as log_warning:
+            server.log_io('C >>>', b'PKDECRYPT')
+            server.client_writelines([b'S PADDING 0\n', b'D secret\n',
+                                      b'OK\n'])
+        # debug_log is independent
+        log_warning.assert_not_called()
+        trace_module.close_tracers()
+        self.assertEqual([(record['dir'], record['line'])
+                          for record in self.read()[1:]], [
+            ('C>>>', 'PKDECRYPT'),
+            ('C<<<', 'S PADDING 0'),
+            ('C<<<', 'D'),
+            ('C<<<', 'OK'),
+        ])
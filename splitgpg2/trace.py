@@ -0,0 +1,189 @@
+#
+# Copyright (C) 2025 Invisible Things Lab
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+I/O trace (see the ``trace_log`` option) - every Assuan line passed between
+the client, split-gpg2 and the agent, one JSON object per line::
+
+    {"t": 1735689600.123456, "conn": "1234-1", "dir": "C>>>", "len": 6,
+     "line": "PKSIGN"}
+
+``dir`` is ``C>>>`` (from the client), ``C<<<`` (to the client), ``A>>>``
+(from the agent) or ``A<<<`` (to the agent); ``open`` records start a
+connection and name the client qube. ``conn`` is the server process ID and
+the connection number in it, ``len`` the length of the whole line, even if
+``line`` is redacted (see :py:data:`REDACT_POLICIES`). Lines are decoded as
+Latin-1, so the original bytes can be recovered.
+
+The server only queues the lines, a background thread formats them and
+appends them to the file in batches. Each batch is a single write of whole
+records, so connections of several processes can share the file.
+
+This module is imported only when tracing is enabled.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import itertools
+import json
+import json.encoder
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+#: what is recorded of each line:
+#:  - ``no`` - everything, including data that may be confidential
+#:  - ``data`` - everything but the payload of D lines (signatures,
+#:    decrypted session keys, ciphertexts)
+#:  - ``args`` - only the command or response keyword
+REDACT_POLICIES = ('no', 'data', 'args')
+
+#: seconds to collect records for before writing them
+WRITE_DELAY = 0.1
+
+#: (time, connection ID, redact policy, direction, data)
+Record = Tuple[float, str, str, str, bytes]
+
+_RECORD_FORMAT = '{"t": %.6f, "conn": "%s", "dir": "%s", "len": %d, ' \
+    '"line": %s}\n'
+
+
+def redact(line: bytes, policy: str) -> bytes:
+    if policy == 'args':
+        return line.split(b' ', 1)[0]
+    if policy == 'data' and line[:2] == b'D ':
+        return b'D'
+    return line
+
+
+def format_records(records: List[Record]) -> Iterator[str]:
+    for timestamp, conn, policy, direction, data in records:
+        if direction == 'open':
+            yield json.dumps({'t': timestamp, 'conn': conn, 'dir': 'open',
+                              'client': data.decode('ascii')}) + '\n'
+            continue
+        direction = direction.replace(' ', '')
+        # a single write may hold several lines (pipelined commands)
+        for line in data.rstrip(b'\n').split(b'\n'):
+            # way faster than json.dumps() of a dict - only the line needs
+            # escaping
+            yield _RECORD_FORMAT % (
+                timestamp, conn, direction, len(line),
+                json.encoder.encode_basestring_ascii(
+                    redact(line, policy).decode('latin-1')))
+
+
+class Tracer:
+    """Background writer of one trace file"""
+    queue: 'queue.SimpleQueue[Optional[Record]]'
+    thread: Optional[threading.Thread]
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.connections = itertools.count(1)
+        self.log = logging.getLogger('splitgpg2.Tracer')
+
+    def connection(self, client_domain: str,
+                   policy: str = 'data') -> 'ConnectionTrace':
+        """Start tracing a new connection"""
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name='split-gpg2 trace', daemon=True)
+            self.thread.start()
+        trace = ConnectionTrace(
+            self, '{}-{}'.format(os.getpid(), next(self.connections)), policy)
+        self.queue.put((time.time(), trace.conn, policy, 'open',
+                        client_domain.encode('ascii')))
+        return trace
+
+    def run(self) -> None:
+        trace_fd: Optional[int] = None
+        stopped = False
+        while not stopped:
+            # wait for something to write, then take all there is - and
+            # wait a bit more, to not wake up for each line
+            records = [self.queue.get()]
+            if records[0] is not None:
+                time.sleep(WRITE_DELAY)
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stopped = None in records
+            batch = ''.join(format_records(
+                [record for record in records if record is not None]))
+            if not batch:
+                continue
+            try:
+                if trace_fd is None:
+                    trace_fd = os.open(self.path,
+                                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                data = batch.encode('ascii')
+                while data:
+                    data = data[os.write(trace_fd, data):]
+            except OSError as e:
+                # tracing is best effort, don't break the connections
+                self.log.warning('Failed to write trace to %s: %s',
+                                 self.path, e)
+        if trace_fd is not None:
+            os.close(trace_fd)
+
+    def close(self) -> None:
+        """Write out the queued records and stop the writer thread"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class ConnectionTrace:
+    """Trace of a single connection"""
+    __slots__ = ('owner', 'conn', 'policy')
+
+    def __init__(self, owner: Tracer, conn: str, policy: str) -> None:
+        self.owner = owner
+        self.conn = conn
+        self.policy = policy
+
+    def record(self, direction: str, untrusted_data: bytes) -> None:
+        """Queue *untrusted_data* for writing, *direction* as given to
+        :py:meth:`splitgpg2.GpgServer.log_io`"""
+        self.owner.queue.put((time.time(), self.conn, self.policy,
+                               direction, untrusted_data))
+
+
+_tracers: Dict[str, Tracer] = {}
+
+
+def tracer(path: str) -> Tracer:
+    """Tracer writing to *path*, shared by all connections"""
+    try:
+        return _tracers[path]
+    except KeyError:
+        instance = _tracers[path] = Tracer(path)
+        return instance
+
+
+def close_tracers() -> None:
+    for instance in _tracers.values():
+        instance.close()